@@ -32,6 +32,7 @@ from soweego.importer import cli as importer_cli
 from soweego.ingester import cli as ingester_cli
 from soweego.linker import cli as linker_cli
 from soweego.validator import cli as validator_cli
+from soweego.wikidata import sparql_cache
 
 CLI_COMMANDS = {
     'importer': importer_cli.cli,
@@ -54,9 +55,19 @@ CLI_COMMANDS = {
         'Multiple pairs allowed.'
     ),
 )
+@click.option(
+    '--sparql-offline',
+    is_flag=True,
+    help=(
+        'Use cached Wikidata SPARQL results of properties and class hierarchies, '
+        'regardless of their age. Never query the endpoint for them, '
+        'and fail if they are not cached.'
+    ),
+)
 @click.pass_context
-def cli(ctx, log_level):
+def cli(ctx, log_level, sparql_offline):
     """Link Wikidata to large catalogs."""
     commons.logging.setup()
+    sparql_cache.set_offline(sparql_offline)
     for module, level in log_level:
         commons.logging.set_log_level(module, level)
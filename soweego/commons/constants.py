@@ -41,6 +41,36 @@ HTTP_USER_AGENT = (
     'soweego/2.0 ([[:m:Grants:Project/Hjfocs/soweego_2]]; [[:m:User:Hjfocs]])'
 )
 
+# Wikidata Web API client, see `soweego.wikidata.api_client`.
+# Upper bound of concurrent requests
+WIKIDATA_API_MAX_CONCURRENCY = 8
+# Back off when the replication lag exceeds 5 seconds, see
+# https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+WIKIDATA_API_MAXLAG = 5
+WIKIDATA_API_MAX_RETRIES = 10
+# Seconds during which stored entities are trusted
+# without checking their revision, see `soweego.wikidata.entity_cache`
+WD_ENTITY_CACHE_TTL = 3600
+
+# Wikidata SPARQL endpoint, see `soweego.wikidata.sparql_queries`.
+# There can't be more than 5 concurrent requests per IP
+SPARQL_MAX_CONCURRENT_REQUESTS = 5
+SPARQL_MAX_RETRIES = 10
+# Paged queries run over this amount of QID ranges
+SPARQL_QID_RANGES = 16
+# Upper bound of QID numbers to split into ranges.
+# QIDs above it fall into the last range, so nothing gets lost
+SPARQL_QID_RANGE_BOUND = 140_000_000
+# Completed pages of paged queries waiting to be consumed.
+# The higher, the more results in memory
+SPARQL_PAGE_QUEUE_SIZE = 2 * SPARQL_MAX_CONCURRENT_REQUESTS
+# Time to live of cached responses by query type, in seconds.
+# Properties and class hierarchies change on a timescale of days
+SPARQL_CACHE_TTL = {'pids': 3 * 24 * 3600, 'class_hierarchy': 3 * 24 * 3600}
+# Expired responses are still served for this long,
+# while being refreshed in the background
+SPARQL_CACHE_STALE_WINDOW = 7 * 24 * 3600
+
 # Wikidata items & properties regexes
 QID_REGEX = r'Q\d+'
 PID_REGEX = r'P\d+'
@@ -55,6 +85,7 @@ WORK_DIR = 'work'
 WD_DIR = 'wikidata'
 SAMPLES_DIR = 'samples'
 FEATURES_DIR = 'features'
+BLOCKING_DIR = 'blocking'
 MODELS_DIR = 'models'
 RESULTS_DIR = 'results'
 NN_CHECKPOINT_DIR = 'best_model_checkpoint'
@@ -69,15 +100,24 @@ EVALUATION_PREDICTIONS_FILENAME = '{}_{}_{}_evaluation_links.csv.gz'
 RESULT_FILENAME = '{}_{}_{}_links.csv.gz'
 NESTED_CV_BEST_MODEL_FILENAME = '{}_{}_{}_best_model_k{:02}.pkl'
 MODEL_FILENAME = '{}_{}_{}_model.pkl'
-FEATURES_FILENAME = '{}_{}_{}_features{:02}.pkl.gz'
-SAMPLES_FILENAME = '{}_{}_{}_samples{:02}.pkl.gz'
-WD_CLASSIFICATION_SET_FILENAME = 'wikidata_{}_{}_classification_set.jsonl.gz'
-WD_TRAINING_SET_FILENAME = 'wikidata_{}_{}_training_set.jsonl.gz'
+# Content-addressed cache entries, named after their key
+CACHE_FILENAME = '{}.pkl.gz'
+BLOCKING_INDEX_FILENAME = '{}_{}_blocking_index_{}.joblib'
+WD_SET_JSONL_EXTENSION = '.jsonl.gz'
+WD_SET_PARQUET_EXTENSION = '.parquet'
+WD_CLASSIFICATION_SET_FILENAME = (
+    'wikidata_{}_{}_classification_set' + WD_SET_JSONL_EXTENSION
+)
+WD_TRAINING_SET_FILENAME = 'wikidata_{}_{}_training_set' + WD_SET_JSONL_EXTENSION
+WD_DUMP_SUBSET_FILENAME = 'wikidata_{}_{}_{}_dump_subset' + WD_SET_JSONL_EXTENSION
 EXTRACTED_LINKS_FILENAME = '{}_{}_extracted_links.csv'
 BASELINE_PERFECT_FILENAME = '{}_{}_baseline_perfect_names.csv'
 BASELINE_LINKS_FILENAME = '{}_{}_baseline_similar_links.csv'
 BASELINE_NAMES_FILENAME = '{}_{}_baseline_similar_names.csv'
 WIKIDATA_API_SESSION = 'wd_api_session.pkl'
+WD_ENTITY_CACHE_FILENAME = 'wikidata_entities.sqlite'
+SPARQL_CACHE_FILENAME = 'sparql_responses.sqlite'
+OCCUPATIONS_HIERARCHY_DIRNAME = 'occupations_hierarchy'
 WORKS_BY_PEOPLE_STATEMENTS = '%s_works_by_%s_statements.csv'
 
 #######
@@ -92,8 +132,14 @@ USER_CREDENTIALS = os.path.join(ROOT_DIR, CREDENTIALS_FILENAME)
 
 WD_TRAINING_SET = os.path.join(WD_DIR, WD_TRAINING_SET_FILENAME)
 WD_CLASSIFICATION_SET = os.path.join(WD_DIR, WD_CLASSIFICATION_SET_FILENAME)
-SAMPLES = os.path.join(SAMPLES_DIR, SAMPLES_FILENAME)
-FEATURES = os.path.join(FEATURES_DIR, FEATURES_FILENAME)
+WD_DUMP_SUBSET = os.path.join(WD_DIR, WD_DUMP_SUBSET_FILENAME)
+WD_ENTITY_CACHE = os.path.join(WD_DIR, WD_ENTITY_CACHE_FILENAME)
+SPARQL_CACHE = os.path.join(WD_DIR, SPARQL_CACHE_FILENAME)
+OCCUPATIONS_HIERARCHY = os.path.join(WD_DIR, OCCUPATIONS_HIERARCHY_DIRNAME)
+# Cache entries are spread into sub-folders by key prefix
+SAMPLES = os.path.join(SAMPLES_DIR, '{}', CACHE_FILENAME)
+FEATURES = os.path.join(FEATURES_DIR, '{}', CACHE_FILENAME)
+BLOCKING_INDEX = os.path.join(BLOCKING_DIR, BLOCKING_INDEX_FILENAME)
 LINKER_MODEL = os.path.join(MODELS_DIR, MODEL_FILENAME)
 LINKER_NESTED_CV_BEST_MODEL = os.path.join(MODELS_DIR, NESTED_CV_BEST_MODEL_FILENAME)
 LINKER_RESULT = os.path.join(RESULTS_DIR, RESULT_FILENAME)
@@ -353,6 +399,29 @@ PARAMETER_GRIDS = {
     },
 }
 
+# Blocking
+BLOCKING_ENGINES = (keys.FULLTEXT, keys.BATCHED_FULLTEXT, keys.INVERTED_INDEX)
+# Top candidates per Wikidata item
+BLOCKING_LIMIT = 5
+# Wikidata items per batched full-text query
+BLOCKING_BUCKET_SIZE = 100
+# Maximum amount of parallel DB connections for batched full-text queries.
+# Keep it low to comply with the Toolforge connection handling policy, see
+# https://wikitech.wikimedia.org/wiki/Help:Toolforge/Database#Connection_handling_policy
+BLOCKING_MAX_CONNECTIONS = 4
+
+# Linker pipeline: chunks waiting between two stages.
+# The higher, the more chunks in memory
+PIPELINE_QUEUE_SIZE = 1
+# Worker threads per linker pipeline stage
+PIPELINE_WORKERS = {'blocking': 1, 'target': 1, 'features': 1}
+
+# Wikidata set storage formats
+WD_SET_FORMATS = (keys.JSONL, keys.PARQUET)
+# Mimic the default MariaDB InnoDB full-text settings, see
+# https://mariadb.com/kb/en/library/full-text-index-overview/
+FULLTEXT_MIN_TOKEN_SIZE = 3
+
 CLASSIFICATION_RETURN_SERIES = ('classification.return_type', 'series')
 CLASSIFICATION_RETURN_INDEX = ('classification.return_type', 'index')
 CONFIDENCE_THRESHOLD = 0.5
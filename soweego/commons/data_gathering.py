@@ -18,12 +18,13 @@ from typing import Iterable, Iterator, Optional
 from urllib.parse import unquote
 
 import regex
-from sqlalchemy import or_
+from sqlalchemy import inspect, or_
 from tqdm import tqdm
 
 from soweego.commons import constants, keys, target_database, text_utils, url_utils
 from soweego.commons.db_manager import DBManager
 from soweego.importer import models
+from soweego.importer.models.import_log import IMPORT_LOG_TABLE, ImportLogEntity
 from soweego.wikidata import api_requests, sparql_queries, vocabulary
 
 LOGGER = logging.getLogger(__name__)
@@ -90,24 +91,63 @@ def tokens_fulltext_search(
                 .limit(limit)
             )
 
-        count = query.count()
-        if count == 0:
+        # No need for a `count()` round trip, just iterate the result
+        found = False
+        for row in query:
+            found = True
+            yield row
+        session.commit()
+
+        if not found:
             LOGGER.debug(
                 "No result from full-text index query to %s. Terms: '%s'",
                 target_entity.__name__,
                 terms,
             )
-            session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def get_import_timestamp(target_entity: constants.DB_ENTITY) -> Optional[str]:
+    """Get the time of the latest import of a target catalog table.
+
+    The :mod:`importer` logs it each time loaded rows get visible,
+    including incremental imports that update tables in place,
+    so this is a reliable fingerprint of the latest catalog import.
+
+    :param target_entity: an ORM entity (AKA table) of the target catalog
+    :return: the ``%Y%m%d_%H%M%S_%f`` import timestamp, or ``None``
+      if not available
+    """
+    session = DBManager.connect_to_db()
+    try:
+        # Nothing was imported yet
+        if not inspect(session.get_bind()).has_table(IMPORT_LOG_TABLE):
+            timestamp = None
         else:
-            for row in query:
-                yield row
-            session.commit()
+            timestamp = (
+                session.query(ImportLogEntity.timestamp)
+                .filter_by(table_name=target_entity.__tablename__)
+                .scalar()
+            )
+        session.commit()
     except:
         session.rollback()
         raise
     finally:
         session.close()
 
+    if timestamp is None:
+        LOGGER.warning(
+            'No import timestamp available for table %s',
+            target_entity.__tablename__,
+        )
+
+    return timestamp
+
 
 def name_fulltext_search(
     target_entity: constants.DB_ENTITY, query: str
@@ -501,6 +541,8 @@ def extract_ids_from_urls(to_be_added, ext_id_pids_to_urls):
     LOGGER.info('Starting extraction of IDs from target links to be added ...')
     ext_ids_to_add = []
     urls_to_add = []
+    # Index formatters once for all URLs
+    matcher = url_utils.ExternalIdMatcher(ext_id_pids_to_urls)
     for (
         qid,
         tid,
@@ -509,7 +551,7 @@ def extract_ids_from_urls(to_be_added, ext_id_pids_to_urls):
             (
                 ext_id,
                 pid,
-            ) = url_utils.get_external_id_from_url(url, ext_id_pids_to_urls)
+            ) = matcher.match(url)
             if ext_id is not None:
                 # Percent-decode IDs
                 if '%' in ext_id:
@@ -59,6 +59,15 @@ BIODATA = 'biodata'
 FEMALE = 'female'
 MALE = 'male'
 
+# Blocking engines
+FULLTEXT = 'fulltext'
+BATCHED_FULLTEXT = 'batch'
+INVERTED_INDEX = 'index'
+
+# Wikidata set storage formats
+JSONL = 'jsonl'
+PARQUET = 'parquet'
+
 # SPARQL queries
 CLASS_QUERY = 'class_query'
 OCCUPATION_QUERY = 'occupation_query'
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Staged pipeline executor.
+
+Each stage runs in its own worker threads and works on a different item,
+so that stages stressing different resources overlap in time.
+Stages are connected through bounded queues: a slow stage makes
+the upstream ones wait, thus keeping memory usage under control.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, Sequence, Tuple
+
+from soweego.commons import constants
+
+LOGGER = logging.getLogger(__name__)
+
+# How often blocked threads check whether the pipeline was stopped, in seconds
+_POLL_INTERVAL = 0.5
+
+# Marks the end of the input
+_DONE = object()
+
+
+def run(
+    source: Iterable,
+    stages: Sequence[Tuple[Callable[[Any], Any], int]],
+    queue_size: int = constants.PIPELINE_QUEUE_SIZE,
+) -> Iterator:
+    """Pipe items of a source through a sequence of stages.
+
+    Output items keep the same order as input ones,
+    regardless of the amount of workers per stage.
+    If any stage fails, the whole pipeline stops and the error is raised
+    to the caller.
+
+    :param source: an iterable of input items.
+      It is consumed in a dedicated thread
+    :param stages: a sequence of ``(function, workers)`` pairs.
+      Each function takes the output of the previous stage,
+      and runs in the given amount of worker threads
+    :param queue_size: (optional) how many items can wait between two stages
+    :return: the generator yielding the output of the last stage
+    """
+    for function, workers in stages:
+        if workers < 1:
+            err_msg = (
+                f'Bad amount of workers for pipeline stage {_name(function)}: '
+                f'{workers}. It should be at least 1'
+            )
+            LOGGER.critical(err_msg)
+            raise ValueError(err_msg)
+
+    stop, errors = threading.Event(), []
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    threads = [
+        threading.Thread(
+            target=_feed, args=(source, queues[0], stop, errors), daemon=True
+        )
+    ]
+    for (function, workers), inbox, outbox in zip(stages, queues, queues[1:]):
+        # Shared by workers of the same stage:
+        # the last one to finish tells the next stage
+        running = [workers, threading.Lock()]
+        threads.extend(
+            threading.Thread(
+                target=_work,
+                args=(function, inbox, outbox, running, stop, errors),
+                name=f'{_name(function)}-{i}',
+                daemon=True,
+            )
+            for i in range(workers)
+        )
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        yield from _reorder(queues[-1], stop, errors)
+    finally:
+        # Also release threads when the caller stops consuming early
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _feed(source, outbox, stop, errors):
+    try:
+        for item in enumerate(source):
+            if not _put(outbox, item, stop):
+                return
+    except BaseException as error:
+        # Also `SystemExit` & co.: an uncaught one would only end
+        # this thread, leaving the caller waiting for the next item forever
+        _fail(error, stop, errors)
+        return
+
+    _put(outbox, _DONE, stop)
+
+
+def _work(function, inbox, outbox, running, stop, errors):
+    while True:
+        item = _get(inbox, stop)
+        if item is None:
+            return
+
+        if item is _DONE:
+            # Let sibling workers know too
+            _put(inbox, _DONE, stop)
+            break
+
+        sequence, value = item
+        try:
+            result = function(value)
+        except BaseException as error:
+            # Same as `_feed`: any error must stop the pipeline
+            _fail(error, stop, errors)
+            return
+
+        if not _put(outbox, (sequence, result), stop):
+            return
+
+    lock = running[1]
+    with lock:
+        running[0] -= 1
+        last = running[0] == 0
+    if last:
+        _put(outbox, _DONE, stop)
+
+
+def _reorder(inbox, stop, errors):
+    pending, expected = {}, 0
+    while True:
+        item = _get(inbox, stop)
+        if item is None:
+            if errors:
+                raise errors[0]
+            return
+
+        if item is _DONE:
+            break
+
+        sequence, value = item
+        pending[sequence] = value
+        while expected in pending:
+            yield pending.pop(expected)
+            expected += 1
+
+
+def _name(function):
+    # `functools.partial` objects have no name
+    return getattr(function, '__name__', type(function).__name__)
+
+
+def _fail(error, stop, errors):
+    LOGGER.error(
+        'Pipeline stage %s failed: %s', threading.current_thread().name, error
+    )
+    errors.append(error)
+    stop.set()
+
+
+def _put(outbox: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            outbox.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _get(inbox: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return inbox.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+
+    return None
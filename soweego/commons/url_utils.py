@@ -11,8 +11,9 @@ __copyright__ = 'Copyleft 2021, Hjfocs'
 
 import logging
 import re
+from collections import defaultdict
 from functools import lru_cache
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from urllib.parse import unquote, urlsplit
 
 import regex
@@ -30,6 +31,19 @@ READ_TIMEOUT = 10
 TOP_LEVEL_DOMAINS = set(['com', 'org', 'net', 'info', 'fm'])
 DOMAIN_PREFIXES = set(['www', 'm', 'mobile'])
 
+# Source of full URL regexes whose matches must end with a literal domain,
+# e.g., ^https?://(?:www\.)?imdb\.com/name/(nm\d+)
+# Only an optional group of literal subdomains may precede the domain,
+# and a path must follow it.
+# It only looks at the first top-level alternative of a regex,
+# so regexes with more are treated as matching any domain
+URL_REGEX_HOST = re.compile(
+    r'\^?http(?:s\??)?://'
+    r'(?:\((?:\?:)?(?:[A-Za-z0-9|-]|\\\.)*\)\?)?'
+    r'(?P<host>(?:[A-Za-z0-9-]+\\\.)+[A-Za-z0-9-]+)'
+    r'(?:/|\\/)'
+)
+
 # Used to check whether a URL is a wiki link
 # From https://wikimediafoundation.org/our-work/wikimedia-projects/
 WIKI_PROJECTS = [
@@ -212,120 +226,263 @@ def tokenize(url, domain_only=False) -> set:
 
 
 def get_external_id_from_url(url, ext_id_pids_to_urls):
-    LOGGER.debug('Trying to extract an identifier from <%s>', url)
+    """Try to extract an external identifier from a URL.
+
+    :param url: a URL
+    :param ext_id_pids_to_urls: a
+      ``{PID: {formatter_URL: (id_regex, url_regex,)} }`` dict,
+      or an :class:`ExternalIdMatcher` built upon it.
+      Build the matcher once when extracting from many URLs
+    :return: the ``(identifier, PID)`` pair,
+      or ``(None, None)`` if nothing could be extracted
+    """
+    matcher = (
+        ext_id_pids_to_urls
+        if isinstance(ext_id_pids_to_urls, ExternalIdMatcher)
+        else ExternalIdMatcher(ext_id_pids_to_urls)
+    )
 
-    # Tidy up: remove trailing slash & use HTTPS
-    tidy = url.rstrip('/')
-    if not tidy.startswith('https'):
-        tidy = tidy.replace('http', 'https', 1)
+    return matcher.match(url)
 
-    # Start extraction
-    for pid, formatters in ext_id_pids_to_urls.items():
-        for formatter_url, (
-            id_regex,
-            url_regex,
-        ) in formatters.items():
-
-            # Optimal case: match the original input URL against a full URL regex
-            if url_regex is not None:
-                match = (
-                    re.match(url_regex, url)
-                    if isinstance(url_regex, re.Pattern)
-                    else regex.match(url_regex, url)
-                )
-                if match is not None:
-                    groups = match.groups()
-                    # This shouldn't happen, but who knows?
-                    # For some reason, we have plenty of groups
-                    # with `None` as the second element
-                    if len(groups) > 1 and groups[1] is not None:
-                        LOGGER.warning(
-                            'Found multiple matching groups in <%s>: '
-                            'Will use the first of %s',
-                            url,
-                            groups,
-                        )
-                    ext_id = groups[0]
-                    LOGGER.debug(
-                        'Input URL matches the full URL regex. '
-                        'URL: %s -> ID: %s - URL regex: %s',
-                        url,
-                        ext_id,
-                        url_regex,
-                    )
-                    return (
-                        ext_id,
-                        pid,
-                    )
-
-            # No URL regex: best matching effort using the tidy URL
-            # Look for matching head & tail
-            before, _, after = formatter_url.partition('$1')
-            after = after.rstrip('/')
-            if tidy.startswith(before) and tidy.endswith(after):
-                LOGGER.debug(
-                    'Clean URL matches external ID formatter URL: <%s> -> <%s>',
-                    tidy,
-                    formatter_url,
-                )
-                url_fragment = (
-                    tidy[len(before) : -len(after)]
-                    if len(after)
-                    else tidy[len(before) :]
-                )
 
-                # No ID regex: use the partitioned substring
-                if id_regex is None:
-                    LOGGER.debug(
-                        'Missing ID regex, '
-                        'will assume the URL substring as the ID. '
-                        'URL: %s -> substring: %s',
-                        tidy,
-                        url_fragment,
-                    )
-                    return url_fragment, pid
-
-                # Use `re.match` instead of `re.search`
-                # More precision, less recall:
-                # valid IDs may be left in the URLs output
-                match = (
-                    re.match(id_regex, url_fragment)
-                    if isinstance(id_regex, re.Pattern)
-                    else regex.match(id_regex, url_fragment)
-                )
-                # Give up if the ID regex doesn't match
-                if match is None:
-                    LOGGER.debug(
-                        "Skipping clean URL <%s> with substring '%s' "
-                        "not matching the expected ID regex %s",
-                        tidy,
-                        url_fragment,
-                        id_regex.pattern,
-                    )
-                    return (
-                        None,
-                        None,
-                    )
-
-                ext_id = match.group()
-                LOGGER.debug(
-                    'Clean URL: %s -> ID: %s - substring: %s - ID regex: %s',
-                    tidy,
-                    ext_id,
-                    url_fragment,
-                    id_regex,
-                )
-                return (
-                    ext_id,
-                    pid,
+class ExternalIdMatcher:
+    """Extract external identifiers from URLs, given formatter URLs and
+    regular expressions of Wikidata external ID properties.
+
+    Formatters are indexed by Web domain, so that a URL only goes through
+    those of its own domain, plus those whose domain can't be told upfront.
+    Formatters are still tried in the same order as the input dict,
+    hence matches are the same as trying all of them.
+
+    A matcher holds plain data structures and compiled patterns only,
+    so it can be pickled and shared across processes.
+
+    :param ext_id_pids_to_urls: a
+      ``{PID: {formatter_URL: (id_regex, url_regex,)} }`` dict.
+      Returned by
+      :func:`gather_relevant_pids() <soweego.commons.data_gathering.gather_relevant_pids>`
+    """
+
+    def __init__(self, ext_id_pids_to_urls: Dict):
+        # (PID, formatter URL, ID regex, URL regex) tuples, in input order
+        self.formatters = []
+        # Domain -> formatter indices
+        self.by_domain = defaultdict(list)
+        # Indices of formatters that may match URLs of any domain
+        self.anywhere = []
+
+        for pid, formatters in ext_id_pids_to_urls.items():
+            for formatter_url, (id_regex, url_regex) in formatters.items():
+                index = len(self.formatters)
+                self.formatters.append((pid, formatter_url, id_regex, url_regex))
+
+                domains = _formatter_domains(formatter_url, url_regex)
+                if domains is None:
+                    self.anywhere.append(index)
+                else:
+                    for domain in domains:
+                        self.by_domain[domain].append(index)
+
+        LOGGER.debug(
+            'Indexed %d external ID formatters by %d Web domains, '
+            '%d formatters match any domain',
+            len(self.formatters),
+            len(self.by_domain),
+            len(self.anywhere),
+        )
+
+    def match(self, url: str) -> Tuple[Optional[str], Optional[str]]:
+        """Try to extract an external identifier from a URL.
+
+        :param url: a URL
+        :return: the ``(identifier, PID)`` pair,
+          or ``(None, None)`` if nothing could be extracted
+        """
+        LOGGER.debug('Trying to extract an identifier from <%s>', url)
+
+        # Tidy up: remove trailing slash & use HTTPS
+        tidy = url.rstrip('/')
+        if not tidy.startswith('https'):
+            tidy = tidy.replace('http', 'https', 1)
+
+        candidates = set(self.anywhere)
+        for domain in _domain_suffixes(url) | _domain_suffixes(tidy):
+            candidates.update(self.by_domain.get(domain, ()))
+
+        # Start extraction
+        for index in sorted(candidates):
+            result = _match_formatter(url, tidy, *self.formatters[index])
+            if result is not None:
+                return result
+
+        # Nothing worked: give up
+        LOGGER.debug('Could not extract any identifier from <%s>', url)
+        return (
+            None,
+            None,
+        )
+
+
+def _match_formatter(url, tidy, pid, formatter_url, id_regex, url_regex):
+    # Return `None` if the formatter doesn't apply to the URL,
+    # an `(ID, PID)` pair otherwise, or `(None, None)` to give up
+    # Optimal case: match the original input URL against a full URL regex
+    if url_regex is not None:
+        match = (
+            re.match(url_regex, url)
+            if isinstance(url_regex, re.Pattern)
+            else regex.match(url_regex, url)
+        )
+        if match is not None:
+            groups = match.groups()
+            # This shouldn't happen, but who knows?
+            # For some reason, we have plenty of groups
+            # with `None` as the second element
+            if len(groups) > 1 and groups[1] is not None:
+                LOGGER.warning(
+                    'Found multiple matching groups in <%s>: '
+                    'Will use the first of %s',
+                    url,
+                    groups,
                 )
+            ext_id = groups[0]
+            LOGGER.debug(
+                'Input URL matches the full URL regex. '
+                'URL: %s -> ID: %s - URL regex: %s',
+                url,
+                ext_id,
+                url_regex,
+            )
+            return (
+                ext_id,
+                pid,
+            )
 
-    # Nothing worked: give up
-    LOGGER.debug('Could not extract any identifier from <%s>', url)
-    return (
-        None,
-        None,
-    )
+    # No URL regex: best matching effort using the tidy URL
+    # Look for matching head & tail
+    before, _, after = formatter_url.partition('$1')
+    after = after.rstrip('/')
+    if tidy.startswith(before) and tidy.endswith(after):
+        LOGGER.debug(
+            'Clean URL matches external ID formatter URL: <%s> -> <%s>',
+            tidy,
+            formatter_url,
+        )
+        url_fragment = (
+            tidy[len(before) : -len(after)]
+            if len(after)
+            else tidy[len(before) :]
+        )
+
+        # No ID regex: use the partitioned substring
+        if id_regex is None:
+            LOGGER.debug(
+                'Missing ID regex, '
+                'will assume the URL substring as the ID. '
+                'URL: %s -> substring: %s',
+                tidy,
+                url_fragment,
+            )
+            return url_fragment, pid
+
+        # Use `re.match` instead of `re.search`
+        # More precision, less recall:
+        # valid IDs may be left in the URLs output
+        match = (
+            re.match(id_regex, url_fragment)
+            if isinstance(id_regex, re.Pattern)
+            else regex.match(id_regex, url_fragment)
+        )
+        # Give up if the ID regex doesn't match
+        if match is None:
+            LOGGER.debug(
+                "Skipping clean URL <%s> with substring '%s' "
+                "not matching the expected ID regex %s",
+                tidy,
+                url_fragment,
+                id_regex.pattern,
+            )
+            return (
+                None,
+                None,
+            )
+
+        ext_id = match.group()
+        LOGGER.debug(
+            'Clean URL: %s -> ID: %s - substring: %s - ID regex: %s',
+            tidy,
+            ext_id,
+            url_fragment,
+            id_regex,
+        )
+        return (
+            ext_id,
+            pid,
+        )
+
+    return None
+
+
+# Web domains where a formatter can match, or `None` if any
+def _formatter_domains(formatter_url, url_regex):
+    domains = set()
+
+    # The formatter URL head must be a prefix of the tidy URL:
+    # its domain is known only if a path, query, or fragment follows
+    before = formatter_url.partition('$1')[0]
+    _, separator, rest = before.partition('://')
+    netloc = re.match(r'[^/?#]+(?=[/?#])', rest)
+    if not separator or netloc is None:
+        return None
+    domains.add(netloc.group().lower())
+
+    if url_regex is not None:
+        # Other alternatives may match any domain
+        if _has_top_level_alternation(url_regex.pattern):
+            return None
+
+        match = URL_REGEX_HOST.match(url_regex.pattern)
+        if match is None:
+            return None
+        domains.add(match.group('host').replace('\\.', '.').lower())
+
+    return domains
+
+
+# Whether a regex has a `|` outside of any group or character class,
+# e.g., ^https?://a\.com/(\d+)|^https?://b\.com/(\d+)
+def _has_top_level_alternation(pattern):
+    depth, in_class, escaped = 0, False, False
+
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+
+    return False
+
+
+# All dot-separated suffixes of a URL domain,
+# e.g., www.imdb.com -> {www.imdb.com, imdb.com, com}
+def _domain_suffixes(url):
+    try:
+        netloc = urlsplit(url).netloc.lower()
+    except ValueError:
+        return set()
+
+    labels = netloc.split('.')
+    return {'.'.join(labels[i:]) for i in range(len(labels))}
 
 
 def is_wiki_link(url):
@@ -26,13 +26,18 @@ class BaseDumpExtractor:
     populate a database instance.
     """
 
-    def extract_and_populate(self, dump_file_paths: List[str], resolve: bool) -> None:
+    def extract_and_populate(
+        self, dump_file_paths: List[str], resolve: bool, incremental: bool = False
+    ) -> None:
         """Extract relevant data and populate
         `SQLAlchemy <https://www.sqlalchemy.org/>`_ ORM entities accordingly.
         Entities will be then persisted to a database instance.
 
         :param dump_file_paths: paths to downloaded catalog dumps
         :param resolve: whether to resolve URLs found in catalog dumps or not
+        :param incremental: whether to only write what changed
+          since the previous import or not. See
+          :class:`~soweego.importer.bulk_loader.BulkLoader`
         """
         raise NotImplementedError
 
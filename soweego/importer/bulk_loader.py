@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Bulk loading of `SQLAlchemy <https://www.sqlalchemy.org/>`_ ORM entities
+into a database instance.
+
+ORM entities are turned into plain rows, written to tab-separated
+staging files, and loaded through
+`LOAD DATA LOCAL INFILE <https://dev.mysql.com/doc/refman/8.0/en/load-data.html>`_.
+Databases other than MySQL, or servers that don't allow local files,
+get multi-row ``INSERT`` statements instead.
+
+On MySQL, rows go to *shadow* copies of the target tables. When loading
+is over, shadow tables replace the target ones through a single
+`RENAME TABLE <https://dev.mysql.com/doc/refman/8.0/en/rename-table.html>`_,
+so readers never see a half-loaded catalog.
+Secondary indexes of shadow tables, including full-text ones,
+are dropped before the first load, and rebuilt once when loading is over.
+
+An *incremental* load leaves target tables and their indexes in place:
+it only reads their rows to tell which ones changed.
+New rows go to small *delta* tables, and are applied to the target ones
+in a single transaction along with the deletion of stale rows,
+so that only changed rows cost writes and index updates.
+
+Either way, the time when loaded rows get visible is logged
+in the :class:`~soweego.importer.models.import_log.ImportLogEntity` table,
+as a fingerprint of the latest import of each target table.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import logging
+import os
+import tempfile
+from collections import defaultdict
+from datetime import date, datetime
+from functools import lru_cache
+from hashlib import blake2b
+from typing import Dict, Iterable, List
+
+import numpy as np
+from sqlalchemy import Integer, MetaData, bindparam, create_engine, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import NullPool
+
+from soweego.commons.db_manager import DBManager
+from soweego.importer.models.import_log import TIMESTAMP_FORMAT, ImportLogEntity
+
+LOGGER = logging.getLogger(__name__)
+
+# Value of NULL fields in staging files
+NULL = '\\N'
+# Characters that `LOAD DATA` expects to be escaped in staging files
+_ESCAPES = str.maketrans(
+    {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'}
+)
+# Name suffixes of tables being loaded, of replaced ones,
+# and of those holding new rows of incremental loads
+SHADOW_SUFFIX = '__shadow'
+OLD_SUFFIX = '__old'
+DELTA_SUFFIX = '__delta'
+# Rows read or deleted per statement when diffing tables
+DIFF_CHUNK_SIZE = 10_000
+# Warnings of a staging file load that get logged
+MAX_LOGGED_WARNINGS = 10
+
+
+class BulkLoader:
+    """Load ORM entities into their tables in bulk.
+
+    Use it as a context manager, so that tables get ready when entering,
+    and loaded rows get visible when leaving:
+
+    >>> with BulkLoader(DBManager(), tables) as loader:
+    ...     loader.save(entities)
+
+    If an error occurs, target tables are left untouched.
+
+    :param db_manager: a database manager
+    :param tables: ORM entity classes of the tables to be loaded.
+      They will hold exactly the rows loaded
+    :param incremental: whether to only write the rows that differ
+      from those target tables already hold, instead of all rows.
+      Target tables are then updated in place, within one transaction
+    """
+
+    def __init__(
+        self, db_manager: DBManager, tables: Iterable, incremental: bool = False
+    ):
+        self.engine = db_manager.get_engine()
+        self._db_manager = db_manager
+        self._tables = list(tables)
+        self._entity_classes = {
+            entity_class.__table__: entity_class for entity_class in self._tables
+        }
+        self._use_load_data = self.engine.dialect.name == 'mysql'
+        # Only MySQL swaps tables in one atomic statement
+        self._use_shadow = self._use_load_data
+        if self._use_load_data:
+            # The client must explicitly allow local files
+            self.engine = create_engine(
+                self.engine.url,
+                poolclass=NullPool,
+                connect_args={'local_infile': True},
+            )
+
+        self.incremental = incremental
+        if incremental and not self._use_shadow:
+            LOGGER.warning(
+                'Incremental loading needs MySQL, will load all rows instead'
+            )
+            self.incremental = False
+
+        # Target table -> table that rows go to:
+        # itself, a shadow table, or a delta one
+        self._targets = {}
+        # Target table -> index of rows it holds, for incremental loads
+        self._row_indexes = {}
+        # Table -> dropped indexes to be rebuilt
+        self._dropped_indexes = {}
+
+    def __enter__(self):
+        self.prepare()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def prepare(self) -> None:
+        """Get tables ready to be loaded.
+
+        This is done automatically when entering the context manager.
+        """
+        # Target tables must exist to be swapped or updated
+        self._db_manager.create(self._tables + [ImportLogEntity])
+
+        for entity_class in self._tables:
+            table = entity_class.__table__
+
+            if not self._use_shadow:
+                self._db_manager.drop([entity_class])
+                self._db_manager.create([entity_class])
+                self._targets[table] = table
+                continue
+
+            if self.incremental:
+                delta = self._create_copy(table, DELTA_SUFFIX)
+                self._targets[table] = delta
+                # Delta tables are short-lived: no need to rebuild their indexes
+                self._drop_indexes(delta)
+                self._row_indexes[table] = self._index_rows(entity_class, table)
+                continue
+
+            shadow = self._create_copy(table, SHADOW_SUFFIX)
+            self._targets[table] = shadow
+            self._dropped_indexes[shadow] = self._drop_indexes(shadow)
+
+        LOGGER.info(
+            'Tables ready to be loaded: %s',
+            [target.name for target in self._targets.values()],
+        )
+
+    def save(self, entities: Iterable) -> int:
+        """Load a batch of ORM entities.
+
+        Entities can belong to different tables.
+        Column attributes that are ``None`` get their scalar default,
+        if any, like an ORM session would do.
+
+        :param entities: ORM entity instances
+        :return: the amount of loaded rows
+        """
+        return self.save_rows(to_rows(entities))
+
+    def save_rows(self, rows_by_class: Dict[type, List[list]]) -> int:
+        """Load a batch of rows built by :func:`to_rows`.
+
+        In incremental mode, rows that target tables already hold
+        are skipped, and don't count as loaded.
+
+        :param rows_by_class: a ``{ORM entity class: rows}`` dict
+        :return: the amount of loaded rows
+        """
+        loaded = 0
+        for entity_class, rows in rows_by_class.items():
+            table = entity_class.__table__
+            if table in self._row_indexes:
+                rows = self._row_indexes[table].new_rows(rows)
+            if not rows:
+                continue
+
+            target = self._targets[table]
+            columns = [column.name for _, column in _attributes(entity_class)]
+
+            if self._use_load_data:
+                try:
+                    written = self._load_data(target, columns, rows)
+                except DBAPIError as error:
+                    LOGGER.warning(
+                        'Could not load a staging file into table %s, '
+                        'will fall back to INSERT statements. Reason: %s',
+                        target.name,
+                        error.orig,
+                    )
+                    self._use_load_data = False
+                    written = self._insert(target, columns, rows)
+            else:
+                written = self._insert(target, columns, rows)
+
+            LOGGER.debug('Loaded %d rows into table %s', written, target.name)
+            loaded += written
+
+        return loaded
+
+    def commit(self) -> None:
+        """Make loaded rows visible: rebuild indexes and swap shadow tables
+        with target ones, or apply changes to target tables
+        if loading incrementally.
+
+        This is done automatically when leaving the context manager.
+        """
+        if self.incremental:
+            self._apply_deltas()
+            return
+
+        self.rebuild_indexes()
+
+        if not self._use_shadow:
+            with self.engine.begin() as connection:
+                self._log_import(connection, self._targets)
+            self._targets.clear()
+            return
+
+        quote = self.engine.dialect.identifier_preparer.quote
+        renames, olds = [], []
+        for table, shadow in self._targets.items():
+            old = quote(table.name + OLD_SUFFIX)
+            renames.append(f'{quote(table.name)} TO {old}')
+            renames.append(f'{quote(shadow.name)} TO {quote(table.name)}')
+            olds.append(old)
+
+        with self.engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS {", ".join(olds)}'))
+            # All tables get swapped at once
+            connection.execute(text(f'RENAME TABLE {", ".join(renames)}'))
+            connection.execute(text(f'DROP TABLE {", ".join(olds)}'))
+            self._log_import(connection, self._targets)
+
+        LOGGER.info(
+            'Swapped in loaded tables: %s', [table.name for table in self._targets]
+        )
+        self._targets.clear()
+
+    def rollback(self) -> None:
+        """Discard shadow or delta tables, so that target ones stay untouched.
+
+        This is done automatically when leaving the context manager
+        because of an error.
+        """
+        self._row_indexes.clear()
+        self._dropped_indexes.clear()
+
+        if not self._use_shadow:
+            return
+
+        for shadow in self._targets.values():
+            LOGGER.info('Dropping table %s', shadow.name)
+            shadow.drop(bind=self.engine, checkfirst=True)
+        self._targets.clear()
+
+    def rebuild_indexes(self) -> None:
+        """Rebuild the indexes dropped so far.
+
+        This is done automatically by :meth:`commit`.
+        """
+        for table, indexes in self._dropped_indexes.items():
+            for index in indexes:
+                LOGGER.info(
+                    'Rebuilding index %s of table %s, this may take a while ...',
+                    index.name,
+                    table.name,
+                )
+                index.create(bind=self.engine)
+
+        self._dropped_indexes.clear()
+
+    def _drop_indexes(self, table):
+        # Unique indexes stay, so that they keep duplicates out while loading.
+        # Unlike the ORM, `LOAD DATA LOCAL` skips duplicates with a warning
+        # instead of failing, see `_load_data`
+        indexes = [index for index in table.indexes if not index.unique]
+        for index in indexes:
+            LOGGER.debug('Dropping index %s of table %s', index.name, table.name)
+            index.drop(bind=self.engine)
+
+        return indexes
+
+    def _create_copy(self, table, suffix):
+        copy = table.to_metadata(MetaData(), name=table.name + suffix)
+        copy.drop(bind=self.engine, checkfirst=True)
+        copy.create(bind=self.engine)
+
+        return copy
+
+    def _apply_deltas(self):
+        quote = self.engine.dialect.identifier_preparer.quote
+
+        # All tables change at once
+        with self.engine.begin() as connection:
+            for table, delta in self._targets.items():
+                deleted = self._delete(
+                    connection, table, self._row_indexes[table].stale_ids()
+                )
+                columns = ', '.join(
+                    quote(column.name)
+                    for _, column in _attributes(self._entity_classes[table])
+                )
+                inserted = connection.execute(
+                    text(
+                        f'INSERT INTO {quote(table.name)} ({columns}) '
+                        f'SELECT {columns} FROM {quote(delta.name)}'
+                    )
+                ).rowcount
+                LOGGER.info(
+                    'Table %s: deleted %d stale rows, inserted %d new ones',
+                    table.name,
+                    deleted,
+                    inserted,
+                )
+
+            self._log_import(connection, self._targets)
+
+        for delta in self._targets.values():
+            delta.drop(bind=self.engine)
+        self._targets.clear()
+        self._row_indexes.clear()
+
+    @staticmethod
+    def _log_import(connection, tables):
+        # Tables may be updated in place, so their creation time
+        # can't tell imports apart: log a timestamp of each one instead
+        timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+        names = [table.name for table in tables]
+        log = ImportLogEntity.__table__
+
+        connection.execute(log.delete().where(log.c.table_name.in_(names)))
+        connection.execute(
+            log.insert(),
+            [{'table_name': name, 'timestamp': timestamp} for name in names],
+        )
+        LOGGER.debug('Logged import %s of tables %s', timestamp, names)
+
+    def _index_rows(self, entity_class, table) -> '_RowIndex':
+        quote = self.engine.dialect.identifier_preparer.quote
+        attributes = _attributes(entity_class)
+        columns = ', '.join(quote(column.name) for _, column in attributes)
+        hashes, ids = [], []
+
+        LOGGER.info('Indexing rows of table %s ...', table.name)
+        connection = self.engine.connect().execution_options(stream_results=True)
+        with connection:
+            result = connection.execute(
+                text(f'SELECT internal_id, {columns} FROM {quote(table.name)}')
+            )
+            while True:
+                chunk = result.fetchmany(DIFF_CHUNK_SIZE)
+                if not chunk:
+                    break
+                ids.append(np.fromiter((row[0] for row in chunk), dtype=np.int64))
+                hashes.append(_row_hashes([row[1:] for row in chunk]))
+
+        row_index = _RowIndex(
+            np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64),
+            np.concatenate(ids) if ids else np.empty(0, dtype=np.int64),
+        )
+        LOGGER.info('Indexed %d rows of table %s', len(row_index), table.name)
+
+        return row_index
+
+    def _delete(self, connection, table, ids):
+        LOGGER.info('Deleting %d stale rows of table %s', len(ids), table.name)
+
+        statement = table.delete().where(
+            table.c.internal_id.in_(bindparam('ids', expanding=True))
+        )
+        for start in range(0, len(ids), DIFF_CHUNK_SIZE):
+            connection.execute(
+                statement, {'ids': ids[start : start + DIFF_CHUNK_SIZE].tolist()}
+            )
+
+        return len(ids)
+
+    def _load_data(self, table, columns, rows):
+        quote = self.engine.dialect.identifier_preparer.quote
+        fd, staging_path = tempfile.mkstemp(
+            prefix=f'{table.name}_', suffix='.tsv', text=True
+        )
+        try:
+            with open(fd, 'w', encoding='utf-8', newline='') as staging:
+                for row in rows:
+                    staging.write(_to_line(row) + '\n')
+
+            statement = text(
+                'LOAD DATA LOCAL INFILE :path '
+                f'INTO TABLE {quote(table.name)} CHARACTER SET utf8mb4 '
+                f'({", ".join(map(quote, columns))})'
+            )
+            with self.engine.begin() as connection:
+                written = connection.execute(
+                    statement, {'path': staging_path}
+                ).rowcount
+                # Warnings are per connection, and only last until
+                # the next statement
+                warnings = connection.execute(text('SELECT @@warning_count')).scalar()
+                if written != len(rows) or warnings:
+                    self._log_load_warnings(connection, table, rows, written, warnings)
+        finally:
+            os.remove(staging_path)
+
+        return written
+
+    def _log_load_warnings(self, connection, table, rows, written, warnings):
+        # With `LOCAL`, duplicate keys and bad values don't fail the load:
+        # duplicates are skipped, and bad values are converted
+        details = connection.execute(
+            text(f'SHOW WARNINGS LIMIT {MAX_LOGGED_WARNINGS}')
+        ).fetchall()
+        LOGGER.warning(
+            'Loaded %d out of %d rows into table %s, with %d warnings. '
+            'First ones: %s',
+            written,
+            len(rows),
+            table.name,
+            warnings,
+            [f'{level} {code}: {message}' for level, code, message in details],
+        )
+
+    def _insert(self, table, columns, rows):
+        with self.engine.begin() as connection:
+            connection.execute(
+                table.insert(), [dict(zip(columns, row)) for row in rows]
+            )
+
+        return len(rows)
+
+
+class _RowIndex:
+    # Content hashes of the rows a table holds, with their internal IDs.
+    # Equal rows share a hash, so each hash counts how many rows hold it,
+    # and how many of them a new load matched so far
+
+    def __init__(self, hashes: np.ndarray, ids: np.ndarray):
+        order = np.argsort(hashes, kind='stable')
+        self._ids = ids[order]
+        self._hashes, self._starts, self._counts = np.unique(
+            hashes[order], return_index=True, return_counts=True
+        )
+        self._matched = np.zeros(len(self._hashes), dtype=np.int64)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def new_rows(self, rows: List[list]) -> List[list]:
+        # Keep rows that don't match any unmatched held row
+        hashes = _row_hashes(rows)
+        positions = np.searchsorted(self._hashes, hashes)
+        n_hashes = len(self._hashes)
+
+        new = []
+        for row, row_hash, position in zip(rows, hashes, positions):
+            if (
+                position < n_hashes
+                and self._hashes[position] == row_hash
+                and self._matched[position] < self._counts[position]
+            ):
+                self._matched[position] += 1
+            else:
+                new.append(row)
+
+        return new
+
+    def stale_ids(self) -> np.ndarray:
+        # Internal IDs of held rows that no new row matched
+        ranks = np.arange(len(self._ids)) - np.repeat(self._starts, self._counts)
+        return self._ids[ranks >= np.repeat(self._matched, self._counts)]
+
+
+def to_rows(entities: Iterable) -> Dict[type, List[list]]:
+    """Turn ORM entities into plain rows.
+
+    Rows only hold column values, so they are cheap to pass
+    from worker processes to the one that loads them
+    via :meth:`BulkLoader.save_rows`.
+
+    :param entities: ORM entity instances
+    :return: the ``{ORM entity class: rows}`` dict
+    """
+    rows_by_class = defaultdict(list)
+    for entity in entities:
+        entity_class = type(entity)
+        rows_by_class[entity_class].append(
+            _to_row(entity, _attributes(entity_class))
+        )
+
+    return rows_by_class
+
+
+# (attribute name, column) pairs of loaded columns
+@lru_cache()
+def _attributes(entity_class):
+    table = entity_class.__table__
+    # Skip auto-incremented keys: the database fills them
+    return [
+        (attribute.key, column)
+        for attribute in entity_class.__mapper__.column_attrs
+        for column in attribute.columns
+        if column.table is table
+        and not (column.primary_key and isinstance(column.type, Integer))
+    ]
+
+
+def _to_row(entity, attributes):
+    row = []
+    for key, column in attributes:
+        value = getattr(entity, key)
+        if value is None and column.default is not None and column.default.is_scalar:
+            value = column.default.arg
+        row.append(value)
+
+    return row
+
+
+def _to_line(row):
+    return '\t'.join(map(_to_field, row))
+
+
+def _row_hashes(rows) -> np.ndarray:
+    # Rows are hashed as staging file lines, so that entities and
+    # rows read back from the database compare equal
+    return np.fromiter(
+        (
+            int.from_bytes(
+                blake2b(_to_line(row).encode('utf-8'), digest_size=8).digest(),
+                'little',
+            )
+            for row in rows
+        ),
+        dtype=np.uint64,
+        count=len(rows),
+    )
+
+
+def _to_field(value):
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value).translate(_ESCAPES)
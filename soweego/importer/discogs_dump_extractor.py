@@ -24,6 +24,7 @@ from tqdm import tqdm
 from soweego.commons import text_utils, url_utils
 from soweego.commons.db_manager import DBManager
 from soweego.importer.base_dump_extractor import BaseDumpExtractor
+from soweego.importer.bulk_loader import BulkLoader
 from soweego.importer.models.base_link_entity import BaseLinkEntity
 from soweego.importer.models.discogs_entity import (
     DiscogsArtistEntity, DiscogsGroupEntity, DiscogsGroupLinkEntity,
@@ -77,7 +78,9 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
             return None
         return urls
 
-    def extract_and_populate(self, dump_file_paths: List[str], resolve: bool) -> None:
+    def extract_and_populate(
+        self, dump_file_paths: List[str], resolve: bool, incremental: bool = False
+    ) -> None:
         """Extract relevant data from the *artists* (people)
         and *masters* (works) Discogs dumps, preprocess them, populate
         `SQLAlchemy <https://www.sqlalchemy.org/>`_ ORM entities, and persist
@@ -88,22 +91,31 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
 
         :param dump_file_paths: paths to downloaded catalog dumps
         :param resolve: whether to resolve URLs found in catalog dumps or not
+        :param incremental: whether to only write what changed
+          since the previous import or not
         """
-        self._process_artists_dump(dump_file_paths[0], resolve)
-        self._process_masters_dump(dump_file_paths[1])
+        tables = [
+            DiscogsMusicianEntity,
+            DiscogsMusicianNlpEntity,
+            DiscogsMusicianLinkEntity,
+            DiscogsGroupEntity,
+            DiscogsGroupNlpEntity,
+            DiscogsGroupLinkEntity,
+            DiscogsMasterEntity,
+            DiscogsMasterArtistRelationship,
+        ]
+        db_manager = DBManager()
+        LOGGER.info('Connected to database: %s', db_manager.get_engine().url)
+
+        # All tables get visible at once when loading is over,
+        # and stay untouched if anything goes wrong
+        with BulkLoader(db_manager, tables, incremental) as loader:
+            self._process_artists_dump(loader, dump_file_paths[0], resolve)
+            self._process_masters_dump(loader, dump_file_paths[1])
 
-    def _process_masters_dump(self, dump_file_path):
+    def _process_masters_dump(self, loader, dump_file_path):
         LOGGER.info("Starting import of masters from Discogs dump '%s'", dump_file_path)
         start = datetime.now()
-        tables = [DiscogsMasterEntity, DiscogsMasterArtistRelationship]
-        db_manager = DBManager()
-        LOGGER.info('Connected to database: %s', db_manager.get_engine().url)
-        db_manager.drop(tables)
-        db_manager.create(tables)
-        LOGGER.info(
-            'SQL tables dropped and re-created: %s',
-            [table.__tablename__ for table in tables],
-        )
         extracted_path = '.'.join(dump_file_path.split('.')[:-1])
         # Extract dump file if it has not yet been extracted
         if not os.path.exists(extracted_path):
@@ -115,7 +127,6 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
 
         # count number of entries
         n_rows = sum(1 for _ in self._g_process_et_items(extracted_path, 'master'))
-        session = db_manager.new_session()
         entity_array = []  # array to which we'll add the entities
         relationships_set = set()
         self.total_entities = 0
@@ -139,9 +150,7 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
 
                 insert_start_time = datetime.now()
 
-                session.bulk_save_objects(entity_array)
-                session.commit()
-                session.expunge_all()  # clear session
+                loader.save(entity_array)
 
                 entity_array.clear()  # clear entity array
 
@@ -150,17 +159,14 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
                     datetime.now() - insert_start_time,
                     self._sqlalchemy_commit_every,
                 )
-        # finally commit remaining entities in session
-        # (if any), and close session
-        session.bulk_save_objects(entity_array)
-        session.bulk_save_objects(
+        # finally load remaining entities (if any)
+        loader.save(entity_array)
+        loader.save(
             [
                 DiscogsMasterArtistRelationship(id1, id2)
                 for id1, id2 in relationships_set
             ]
         )
-        session.commit()
-        session.close()
 
         end = datetime.now()
         LOGGER.info(
@@ -246,28 +252,12 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
 
         return infos
 
-    def _process_artists_dump(self, dump_file_path, resolve):
+    def _process_artists_dump(self, loader, dump_file_path, resolve):
         LOGGER.info(
             "Starting import of musicians and bands from Discogs dump '%s'",
             dump_file_path,
         )
         start = datetime.now()
-        tables = [
-            DiscogsMusicianEntity,
-            DiscogsMusicianNlpEntity,
-            DiscogsMusicianLinkEntity,
-            DiscogsGroupEntity,
-            DiscogsGroupNlpEntity,
-            DiscogsGroupLinkEntity,
-        ]
-        db_manager = DBManager()
-        LOGGER.info('Connected to database: %s', db_manager.get_engine().url)
-        db_manager.drop(tables)
-        db_manager.create(tables)
-        LOGGER.info(
-            'SQL tables dropped and re-created: %s',
-            [table.__tablename__ for table in tables],
-        )
         extracted_path = '.'.join(dump_file_path.split('.')[:-1])
         # Extract dump file if it has not yet been extracted
         if not os.path.exists(extracted_path):
@@ -279,7 +269,6 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
 
         # count number of entries
         n_rows = sum(1 for _ in self._g_process_et_items(extracted_path, 'artist'))
-        session = db_manager.new_session()
         entity_array = []  # array to which we'll add the entities
         for _, node in tqdm(
             self._g_process_et_items(extracted_path, 'artist'), total=n_rows
@@ -311,9 +300,7 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
 
                 insert_start_time = datetime.now()
 
-                session.bulk_save_objects(entity_array)
-                session.commit()
-                session.expunge_all()  # clear session
+                loader.save(entity_array)
 
                 entity_array.clear()  # clear entity array
 
@@ -322,11 +309,8 @@ class DiscogsDumpExtractor(BaseDumpExtractor):
                     datetime.now() - insert_start_time,
                     self._sqlalchemy_commit_every,
                 )
-        # finally commit remaining entities in session
-        # (if any), and close session
-        session.bulk_save_objects(entity_array)
-        session.commit()
-        session.close()
+        # finally load remaining entities (if any)
+        loader.save(entity_array)
         end = datetime.now()
         LOGGER.info(
             'Import completed in %s. '
@@ -13,14 +13,19 @@ import copy
 import csv
 import datetime
 import gzip
+import io
 import logging
-from typing import Dict, Generator, List, Tuple
+import os
+from collections import defaultdict, deque
+from multiprocessing import Pool, cpu_count
+from typing import BinaryIO, Dict, Iterator, List, Tuple
 
 from tqdm import tqdm
 
 from soweego.commons import text_utils
 from soweego.commons.db_manager import DBManager
 from soweego.importer.base_dump_extractor import BaseDumpExtractor
+from soweego.importer.bulk_loader import BulkLoader, to_rows
 from soweego.importer.models import imdb_entity
 from soweego.wikidata import vocabulary as vocab
 
@@ -29,6 +34,19 @@ LOGGER = logging.getLogger(__name__)
 DUMP_URL_PERSON_INFO = 'https://datasets.imdbws.com/name.basics.tsv.gz'
 DUMP_URL_MOVIE_INFO = 'https://datasets.imdbws.com/title.basics.tsv.gz'
 
+# Counters of `IMDbDumpExtractor`, summed up across parsing processes
+COUNTERS = (
+    'n_actors',
+    'n_directors',
+    'n_movies',
+    'n_musicians',
+    'n_persons',
+    'n_producers',
+    'n_writers',
+    'n_misc',
+    'n_person_movie_links',
+)
+
 
 class IMDbDumpExtractor(BaseDumpExtractor):
     """Download IMDb dumps, extract data, and
@@ -47,6 +65,10 @@ class IMDbDumpExtractor(BaseDumpExtractor):
     n_person_movie_links = 0
 
     _sqlalchemy_commit_every = 100_000
+    # Dump parsing processes, `None` to use all CPUs
+    _parse_workers = None
+    # Decompressed bytes parsed by each process at a time
+    _parse_block_size = 4 * 1024 * 1024
 
     def get_dump_download_urls(self) -> List[str]:
         return [DUMP_URL_PERSON_INFO, DUMP_URL_MOVIE_INFO]
@@ -67,7 +89,9 @@ class IMDbDumpExtractor(BaseDumpExtractor):
             if value == '\\N':
                 entity[key] = None
 
-    def extract_and_populate(self, dump_file_paths: List[str], resolve: bool) -> None:
+    def extract_and_populate(
+        self, dump_file_paths: List[str], resolve: bool, incremental: bool = False
+    ) -> None:
         """Extract relevant data from the *name* (people) and *title* (works)
         IMDb dumps, preprocess them, populate
         `SQLAlchemy <https://www.sqlalchemy.org/>`_ ORM entities, and persist
@@ -78,6 +102,8 @@ class IMDbDumpExtractor(BaseDumpExtractor):
 
         :param dump_file_paths: paths to downloaded catalog dumps
         :param resolve: whether to resolve URLs found in catalog dumps or not
+        :param incremental: whether to only write what changed
+          since the previous import or not
         """
 
         # the order of these files is specified in `self.get_dump_download_urls`
@@ -102,230 +128,234 @@ class IMDbDumpExtractor(BaseDumpExtractor):
         db_manager = DBManager()
         LOGGER.info('Connected to database: %s', db_manager.get_engine().url)
 
-        db_manager.drop(tables)
-        db_manager.create(tables)
-
-        LOGGER.info(
-            'SQL tables dropped and re-created: %s',
-            [table.__tablename__ for table in tables],
-        )
-
-        LOGGER.info('Starting import of movies ...')
+        # All tables get visible at once, when loading is over
+        with BulkLoader(db_manager, tables, incremental) as loader:
+            LOGGER.info('Starting import of movies ...')
 
-        # Here we open the movie dump file, and add everything to the DB
-        for movie_info, entity_array in self._loop_through_entities(movies_file_path):
+            self._import_dump(loader, movies_file_path, '_extract_movie')
 
-            # create the movie SQLAlchemy entity and populate it
-            movie_entity = imdb_entity.IMDbTitleEntity()
-            movie_entity.catalog_id = movie_info.get('tconst')
-            movie_entity.title_type = movie_info.get('titleType')
-            if movie_info.get('primaryTitle') is not None:
-                movie_entity.name = movie_info.get('primaryTitle')
-                movie_entity.name_tokens = ' '.join(
-                    text_utils.tokenize(movie_info.get('primaryTitle'))
-                )
-            movie_entity.is_adult = True if movie_info.get('isAdult') == '1' else False
-            try:
-                movie_entity.born = datetime.date(
-                    year=int(movie_info.get('startYear')), month=1, day=1
-                )
-                movie_entity.born_precision = 9
-            except (KeyError, TypeError):
-                LOGGER.debug('No start year value for %s', movie_entity)
-            try:
-                movie_entity.died = datetime.date(
-                    year=int(movie_info.get('endYear')), month=1, day=1
-                )
-                movie_entity.died_precision = 9
-            except (KeyError, TypeError):
-                LOGGER.debug('No end year value for %s', movie_entity)
-            movie_entity.runtime_minutes = movie_info.get('runtimeMinutes')
-
-            if movie_info.get('genres'):  # if movie has a genre specified
-                movie_entity.genres = ' '.join(
-                    text_utils.tokenize(movie_info.get('genres'))
-                )
-
-            # Creates entity for alias
-            alias = movie_info.get('originalTitle')
-            if alias is not None and movie_entity.name != alias:
-                alias_entity = copy.deepcopy(movie_entity)
-                alias_entity.name = alias
-                alias_entity.name_tokens = ' '.join(text_utils.tokenize(alias))
-                entity_array.append(alias_entity)
-
-            entity_array.append(movie_entity)
-
-            self.n_movies += 1
+            # mark end for movie import process
+            end = datetime.datetime.now()
+            LOGGER.info(
+                'Movie import completed in %s. ' 'Total movies imported: %d',
+                end - start,
+                self.n_movies,
+            )
 
-        # mark end for movie import process
-        end = datetime.datetime.now()
-        LOGGER.info(
-            'Movie import completed in %s. ' 'Total movies imported: %d',
-            end - start,
-            self.n_movies,
-        )
+            LOGGER.info('Starting import of people ...')
+
+            # reset timer for persons import
+            start = datetime.datetime.now()
+
+            self._import_dump(loader, person_file_path, '_extract_person')
+
+            # mark the end time for the person import process
+            end = datetime.datetime.now()
+            LOGGER.info(
+                'Person import completed in %s. '
+                'Total people imported: %d - '
+                'Actors: %d - Directors: %d - Musicians: %d - '
+                'Producers: %d - Writers: %d - Misc: %d',
+                end - start,
+                self.n_persons,
+                self.n_actors,
+                self.n_directors,
+                self.n_musicians,
+                self.n_producers,
+                self.n_writers,
+                self.n_misc,
+            )
 
-        LOGGER.info('Starting import of people ...')
+    def _import_dump(self, loader: BulkLoader, file_path: str, extract: str) -> None:
+        """Parse an IMDb dump file (which should be in ".tsv.gz" format)
+        in parallel, and load the extracted entities into the database.
 
-        # reset timer for persons import
-        start = datetime.datetime.now()
+        The dump is decompressed into blocks of whole lines,
+        which worker processes turn into rows of SQLAlchemy entities
+        through the `extract` method. Rows are loaded in batches
+        by this process.
 
-        for person_info, entity_array in self._loop_through_entities(person_file_path):
-
-            # IMDb saves the list of professions as a comma separated
-            # string
-            professions = person_info.get('primaryProfession')
-
-            # if person has no professions then ignore it
-            if not professions:
-                LOGGER.debug('Person %s has no professions', person_info.get('nconst'))
-                continue
-
-            professions = professions.split(',')
-
-            # each person can be added to multiple tables in the DB,
-            # each table stands for one of the main professions
-            types_of_entities = []
-
-            if 'actor' in professions or 'actress' in professions:
-                self.n_actors += 1
-                types_of_entities.append(imdb_entity.IMDbActorEntity())
-
-            if 'director' in professions:
-                self.n_directors += 1
-                types_of_entities.append(imdb_entity.IMDbDirectorEntity())
-
-            if 'producer' in professions:
-                self.n_producers += 1
-                types_of_entities.append(imdb_entity.IMDbProducerEntity())
-
-            if any(
-                prof
-                in [
-                    'sound_department',
-                    'composer',
-                    'music_department',
-                    'soundtrack',
-                ]
-                for prof in professions
-            ):
-                self.n_musicians += 1
-                types_of_entities.append(imdb_entity.IMDbMusicianEntity())
-
-            if 'writer' in professions:
-                self.n_writers += 1
-                types_of_entities.append(imdb_entity.IMDbWriterEntity())
-
-            # if the only profession a person has is `miscellaneous` then we
-            # add it to all tables
-            if professions == ['miscellaneous']:
-                self.n_misc += 1
-                types_of_entities = [
-                    imdb_entity.IMDbActorEntity(),
-                    imdb_entity.IMDbDirectorEntity(),
-                    imdb_entity.IMDbMusicianEntity(),
-                    imdb_entity.IMDbProducerEntity(),
-                    imdb_entity.IMDbWriterEntity(),
-                ]
-
-            # add person to every matching table
-            for etype in types_of_entities:
-                self._populate_person(etype, person_info, entity_array)
-
-            # if person is known for any movies then add these to the
-            # database as well
-            if person_info.get('knownForTitles'):
-                self.n_person_movie_links += 1
-                self._populate_person_movie_relations(person_info, entity_array)
-
-            self.n_persons += 1
-
-        # mark the end time for the person import process
-        end = datetime.datetime.now()
-        LOGGER.info(
-            'Person import completed in %s. '
-            'Total people imported: %d - '
-            'Actors: %d - Directors: %d - Musicians: %d - '
-            'Producers: %d - Writers: %d - Misc: %d',
-            end - start,
-            self.n_persons,
-            self.n_actors,
-            self.n_directors,
-            self.n_musicians,
-            self.n_producers,
-            self.n_writers,
-            self.n_misc,
-        )
-
-    def _loop_through_entities(
-        self, file_path: str
-    ) -> Generator[Tuple[Dict, List], None, None]:
+        :param loader: a bulk loader of the target tables
+        :param file_path: path to an IMDb dump file
+        :param extract: name of the method that takes a dump entry
+          and an array, creates SQLAlchemy entities, and appends them
+          to the array
         """
-        Generator that given an IMDb dump file (which
-        should be ".tsv.gz" format) it loops through every
-        entry and yields it.
+        pending, n_pending = defaultdict(list), 0
 
-        :return: a generator which yields a Tuple[entity_info, entity_array]
-        the consumer of this generator will take `entity_info`, create an
-        SQLAlchemy entity, and append this to the `entity_array`
-        """
-        db_manager = DBManager()
+        with open(file_path, 'rb') as compressed, gzip.open(compressed) as ddump:
+            fieldnames = ddump.readline().decode('utf-8').rstrip('\n').split('\t')
+            LOGGER.debug('Dump "%s" has fields %s', file_path, fieldnames)
 
-        with gzip.open(file_path, 'rt') as ddump:
-            session = db_manager.new_session()
+            # Tag each block with the compressed bytes read so far,
+            # so that progress only needs the file size
+            tasks = (
+                (extract, fieldnames, block, compressed.tell())
+                for block in _read_blocks(ddump, self._parse_block_size)
+            )
+            progress = tqdm(
+                total=os.path.getsize(file_path), unit='B', unit_scale=True
+            )
+            workers = self._parse_workers or cpu_count()
+            pool = Pool(processes=workers)
+
+            with progress, pool:
+                # Keep a few blocks per process in flight,
+                # instead of queueing up the whole dump in memory
+                results = _imap_bounded(pool, _extract_block, tasks, 2 * workers)
+                for offset, rows_by_class, counters in results:
+                    for name, count in counters.items():
+                        setattr(self, name, getattr(self, name) + count)
+
+                    for entity_class, rows in rows_by_class.items():
+                        pending[entity_class].extend(rows)
+                        n_pending += len(rows)
+
+                    # every `_sqlalchemy_commit_every` rows we load the batch
+                    # to the DB. This is more efficient than loading
+                    # every block, and is not so hard on the memory requirements
+                    # as would be loading everything once the loop is done
+                    if n_pending >= self._sqlalchemy_commit_every:
+                        insert_start_time = datetime.datetime.now()
+
+                        loader.save_rows(pending)
+
+                        LOGGER.debug(
+                            'It took %s to add %s entities to the database',
+                            datetime.datetime.now() - insert_start_time,
+                            n_pending,
+                        )
+                        pending, n_pending = defaultdict(list), 0
+
+                    progress.update(offset - progress.n)
+
+                # load remaining entities
+                loader.save_rows(pending)
+
+    def _extract_movie(self, movie_info: Dict, entity_array: List) -> None:
+        """Create SQLAlchemy entities from a *title* dump entry.
+
+        :param movie_info: a dump entry
+        :param entity_array: an external array to which we'll add the
+          entities
+        """
+        # create the movie SQLAlchemy entity and populate it
+        movie_entity = imdb_entity.IMDbTitleEntity()
+        movie_entity.catalog_id = movie_info.get('tconst')
+        movie_entity.title_type = movie_info.get('titleType')
+        if movie_info.get('primaryTitle') is not None:
+            movie_entity.name = movie_info.get('primaryTitle')
+            movie_entity.name_tokens = ' '.join(
+                text_utils.tokenize(movie_info.get('primaryTitle'))
+            )
+        movie_entity.is_adult = True if movie_info.get('isAdult') == '1' else False
+        try:
+            movie_entity.born = datetime.date(
+                year=int(movie_info.get('startYear')), month=1, day=1
+            )
+            movie_entity.born_precision = 9
+        except (KeyError, TypeError):
+            LOGGER.debug('No start year value for %s', movie_entity)
+        try:
+            movie_entity.died = datetime.date(
+                year=int(movie_info.get('endYear')), month=1, day=1
+            )
+            movie_entity.died_precision = 9
+        except (KeyError, TypeError):
+            LOGGER.debug('No end year value for %s', movie_entity)
+        movie_entity.runtime_minutes = movie_info.get('runtimeMinutes')
+
+        if movie_info.get('genres'):  # if movie has a genre specified
+            movie_entity.genres = ' '.join(
+                text_utils.tokenize(movie_info.get('genres'))
+            )
 
-            # count number of rows for TQDM, so we can display how
-            # much is missing to complete the process. Then go back
-            # to the start of the file with `.seek(0)`
-            n_rows = sum(1 for line in ddump)
-            ddump.seek(0)
+        # Creates entity for alias
+        alias = movie_info.get('originalTitle')
+        if alias is not None and movie_entity.name != alias:
+            alias_entity = copy.deepcopy(movie_entity)
+            alias_entity.name = alias
+            alias_entity.name_tokens = ' '.join(text_utils.tokenize(alias))
+            entity_array.append(alias_entity)
 
-            entity_array = []
-            LOGGER.debug('Dump "%s" has %d entries', file_path, n_rows)
+        entity_array.append(movie_entity)
 
-            reader = csv.DictReader(ddump, delimiter='\t')
+        self.n_movies += 1
 
-            # for every entry in the file..
-            for entity_info in tqdm(reader, total=n_rows):
-                # clean the entry
-                self._normalize_null(entity_info)
+    def _extract_person(self, person_info: Dict, entity_array: List) -> None:
+        """Create SQLAlchemy entities from a *name* dump entry.
 
-                # yield the cleaned dict
-                yield entity_info, entity_array
+        :param person_info: a dump entry
+        :param entity_array: an external array to which we'll add the
+          entities
+        """
+        # IMDb saves the list of professions as a comma separated
+        # string
+        professions = person_info.get('primaryProfession')
 
-                # every `_sqlalchemy_commit_every` loops we commit the
-                # session to the DB. This is more efficient than commiting
-                # every loop, and is not so hard on the memory requirements
-                # as would be adding everything to session and commiting once
-                # the for loop is done
-                if len(entity_array) >= self._sqlalchemy_commit_every:
-                    LOGGER.info(
-                        'Adding batch of entities to the database, '
-                        'this will take a while. Progress will resume soon.'
-                    )
+        # if person has no professions then ignore it
+        if not professions:
+            LOGGER.debug('Person %s has no professions', person_info.get('nconst'))
+            return
 
-                    insert_start_time = datetime.datetime.now()
+        professions = professions.split(',')
 
-                    session.bulk_save_objects(entity_array)
-                    session.commit()
-                    session.expunge_all()  # clear session
+        # each person can be added to multiple tables in the DB,
+        # each table stands for one of the main professions
+        types_of_entities = []
 
-                    entity_array.clear()  # clear entity array
+        if 'actor' in professions or 'actress' in professions:
+            self.n_actors += 1
+            types_of_entities.append(imdb_entity.IMDbActorEntity())
 
-                    LOGGER.debug(
-                        'It took %s to add %s entities to the database',
-                        datetime.datetime.now() - insert_start_time,
-                        len(entity_array),
-                    )
+        if 'director' in professions:
+            self.n_directors += 1
+            types_of_entities.append(imdb_entity.IMDbDirectorEntity())
 
-            # commit remaining entities
-            session.bulk_save_objects(entity_array)
-            session.commit()
+        if 'producer' in professions:
+            self.n_producers += 1
+            types_of_entities.append(imdb_entity.IMDbProducerEntity())
 
-            # clear list reference since it might still be available in
-            # the scope where this generator was used.
-            entity_array.clear()
+        if any(
+            prof
+            in [
+                'sound_department',
+                'composer',
+                'music_department',
+                'soundtrack',
+            ]
+            for prof in professions
+        ):
+            self.n_musicians += 1
+            types_of_entities.append(imdb_entity.IMDbMusicianEntity())
+
+        if 'writer' in professions:
+            self.n_writers += 1
+            types_of_entities.append(imdb_entity.IMDbWriterEntity())
+
+        # if the only profession a person has is `miscellaneous` then we
+        # add it to all tables
+        if professions == ['miscellaneous']:
+            self.n_misc += 1
+            types_of_entities = [
+                imdb_entity.IMDbActorEntity(),
+                imdb_entity.IMDbDirectorEntity(),
+                imdb_entity.IMDbMusicianEntity(),
+                imdb_entity.IMDbProducerEntity(),
+                imdb_entity.IMDbWriterEntity(),
+            ]
+
+        # add person to every matching table
+        for etype in types_of_entities:
+            self._populate_person(etype, person_info, entity_array)
+
+        # if person is known for any movies then add these to the
+        # database as well
+        if person_info.get('knownForTitles'):
+            self.n_person_movie_links += 1
+            self._populate_person_movie_relations(person_info, entity_array)
+
+        self.n_persons += 1
 
     def _populate_person(
         self,
@@ -447,3 +477,54 @@ class IMDbDumpExtractor(BaseDumpExtractor):
                 qids.append(qid)
 
         return qids
+
+
+def _read_blocks(ddump: BinaryIO, block_size: int) -> Iterator[bytes]:
+    # Split a decompressed dump into blocks of whole lines
+    rest = b''
+    while True:
+        chunk = ddump.read(block_size)
+        if not chunk:
+            break
+
+        chunk = rest + chunk
+        end = chunk.rfind(b'\n') + 1
+        if end:
+            yield chunk[:end]
+        rest = chunk[end:]
+
+    if rest:
+        yield rest
+
+
+def _imap_bounded(pool, function, tasks, window):
+    # Like `Pool.imap`, but with at most `window` pending tasks
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def _extract_block(task: Tuple) -> Tuple[int, Dict, Dict]:
+    # Run in a worker process: parse a block of dump lines
+    # and return rows with counters, see `IMDbDumpExtractor._import_dump`
+    extract, fieldnames, block, offset = task
+    extractor = IMDbDumpExtractor()
+    entity_array = []
+
+    reader = csv.DictReader(
+        io.StringIO(block.decode('utf-8'), newline=''),
+        fieldnames=fieldnames,
+        delimiter='\t',
+    )
+    for entity_info in reader:
+        # clean the entry
+        extractor._normalize_null(entity_info)
+        getattr(extractor, extract)(entity_info, entity_array)
+
+    counters = {name: getattr(extractor, name) for name in COUNTERS}
+    return offset, to_rows(entity_array), counters
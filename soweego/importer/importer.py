@@ -27,6 +27,7 @@ from soweego.importer.base_dump_extractor import BaseDumpExtractor
 from soweego.importer.discogs_dump_extractor import DiscogsDumpExtractor
 from soweego.importer.imdb_dump_extractor import IMDbDumpExtractor
 from soweego.importer.musicbrainz_dump_extractor import MusicBrainzDumpExtractor
+from soweego.wikidata import sparql_cache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -54,12 +55,24 @@ ROTTEN_URLS_FNAME = '{catalog}_{entity}_rotten_urls.csv'
     default=constants.WORK_DIR,
     help=f'Input/output directory, default: {constants.WORK_DIR}.',
 )
-def import_cli(catalog: str, url_check: bool, dir_io: str) -> None:
-    """Download, extract, and import a supported catalog."""
+@click.option(
+    '--incremental',
+    is_flag=True,
+    help=(
+        'Only write what changed since the previous import. Default: no. '
+        'Requires MySQL.'
+    ),
+)
+def import_cli(catalog: str, url_check: bool, dir_io: str, incremental: bool) -> None:
+    """Download, extract, and import a supported catalog.
+
+    Imported tables get replaced only when the import is over.
+    """
+    sparql_cache.set_directory(dir_io)
 
     extractor = DUMP_EXTRACTOR[catalog]()
 
-    Importer().refresh_dump(dir_io, extractor, url_check)
+    Importer().refresh_dump(dir_io, extractor, url_check, incremental)
 
 
 @click.command()
@@ -178,7 +191,11 @@ class Importer:
     extractor."""
 
     def refresh_dump(
-        self, output_folder: str, extractor: BaseDumpExtractor, resolve: bool
+        self,
+        output_folder: str,
+        extractor: BaseDumpExtractor,
+        resolve: bool,
+        incremental: bool = False,
     ):
         """Eventually download the latest dump, and call the
          corresponding extractor.
@@ -187,6 +204,8 @@ class Importer:
         :param extractor: :class:`~soweego.importer.base_dump_extractor.BaseDumpExtractor`
           implementation to process the dump
         :param resolve: whether to resolve URLs found in catalog dumps or not
+        :param incremental: whether to only write what changed
+          since the previous import or not
         """
         filepaths = []
 
@@ -221,7 +240,7 @@ class Importer:
                 self._update_dump(download_url, file_full_path)
             filepaths.append(file_full_path)
 
-        extractor.extract_and_populate(filepaths, resolve)
+        extractor.extract_and_populate(filepaths, resolve, incremental)
 
     @staticmethod
     def _update_dump(dump_url: str, file_output_path: str):
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""`SQLAlchemy <https://www.sqlalchemy.org/>`_ ORM entity
+logging the imports of target catalog tables."""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+from sqlalchemy import Column, String
+
+from soweego.importer.models.base_entity import BASE
+
+IMPORT_LOG_TABLE = 'import_log'
+# Microseconds tell apart imports that commit within the same second
+TIMESTAMP_FORMAT = '%Y%m%d_%H%M%S_%f'
+
+
+class ImportLogEntity(BASE):
+    """The latest import of a target catalog table.
+
+    **Attributes:**
+
+    - **table_name** (string(64)) - a target catalog table name
+    - **timestamp** (string(32)) - when the latest import
+      of the table was committed, in ``TIMESTAMP_FORMAT``
+
+    """
+
+    __tablename__ = IMPORT_LOG_TABLE
+
+    table_name = Column(String(64), primary_key=True)
+    timestamp = Column(String(32), nullable=False)
+
+    def __repr__(self) -> str:
+        return (
+            f'<ImportLogEntity(table_name="{self.table_name}", '
+            f'timestamp="{self.timestamp}")>'
+        )
@@ -9,14 +9,17 @@ __version__ = '1.0'
 __license__ = 'GPL-3.0'
 __copyright__ = 'Copyleft 2018, MaxFrax96'
 
+import bz2
 import logging
 import os
 import shutil
+import subprocess
 import tarfile
 from collections import defaultdict
 from csv import DictReader
 from datetime import date, datetime
-from typing import List, Tuple
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List, Set, Tuple
 
 import requests
 from sqlalchemy.exc import IntegrityError
@@ -24,8 +27,8 @@ from tqdm import tqdm
 
 from soweego.commons import text_utils, url_utils
 from soweego.commons.db_manager import DBManager
-from soweego.commons.utils import count_num_lines_in_file
 from soweego.importer.base_dump_extractor import BaseDumpExtractor
+from soweego.importer.bulk_loader import BulkLoader
 from soweego.importer.models.base_entity import BaseEntity
 from soweego.importer.models.musicbrainz_entity import (
     MusicBrainzArtistBandRelationship, MusicBrainzArtistEntity,
@@ -37,6 +40,27 @@ from soweego.wikidata.sparql_queries import external_id_pids_and_urls
 
 LOGGER = logging.getLogger(__name__)
 
+# Dump tables read by the extractor, a small part of the whole dump
+DUMP_MEMBERS = frozenset(
+    f'mbdump/{table}'
+    for table in (
+        'area',
+        'artist',
+        'artist_alias',
+        'artist_credit_name',
+        'artist_isni',
+        'l_artist_artist',
+        'l_artist_url',
+        'l_release_group_url',
+        'link',
+        'release',
+        'release_country',
+        'release_group',
+        'release_unknown_country',
+        'url',
+    )
+)
+
 
 class MusicBrainzDumpExtractor(BaseDumpExtractor):
     """Download MusicBrainz dumps, extract data, and
@@ -49,7 +73,9 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
         latest_version = requests.get(f'{base_url}/LATEST').text.rstrip()
         return [f'{base_url}/{latest_version}/mbdump.tar.bz2']
 
-    def extract_and_populate(self, dump_file_paths: List[str], resolve: bool):
+    def extract_and_populate(
+        self, dump_file_paths: List[str], resolve: bool, incremental: bool = False
+    ):
         """Extract relevant data from the *artist* (people) and *release group*
         (works) MusicBrainz dumps, preprocess them, populate
         `SQLAlchemy <https://www.sqlalchemy.org/>`_ ORM entities, and persist
@@ -60,6 +86,8 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
 
         :param dump_file_paths: paths to downloaded catalog dumps
         :param resolve: whether to resolve URLs found in catalog dumps or not
+        :param incremental: whether to only write what changed
+          since the previous import or not
         """
         dump_file_path = dump_file_paths[0]
         dump_path = os.path.join(
@@ -68,132 +96,95 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
         )
 
         if not os.path.isdir(dump_path):
-            with tarfile.open(dump_file_path, "r:bz2") as tar:
-                LOGGER.info("Extracting dump %s in %s", dump_file_path, dump_path)
-                tar.extractall(dump_path)
-                LOGGER.info("Extracted dump %s in %s", dump_file_path, dump_path)
-
-        db_manager = DBManager()
+            _extract_members(dump_file_path, dump_path)
+
+        tables = [
+            MusicBrainzReleaseGroupEntity,
+            MusicBrainzReleaseGroupLinkEntity,
+            MusicBrainzArtistEntity,
+            MusicBrainzBandEntity,
+            MusicBrainzArtistLinkEntity,
+            MusicBrainzBandLinkEntity,
+            MusicBrainzReleaseGroupArtistRelationship,
+            MusicBrainzArtistBandRelationship,
+        ]
+
+        # All tables get visible at once, when loading is over
+        with BulkLoader(DBManager(), tables, incremental) as loader:
+            self._populate(loader, dump_path, resolve)
 
-        tables = [MusicBrainzReleaseGroupEntity]
-        db_manager.drop(tables)
-        db_manager.create(tables)
-
-        LOGGER.info(
-            "Dropped and created tables %s",
-            [table.__tablename__ for table in tables],
-        )
-        LOGGER.info("Importing release groups")
+        shutil.rmtree(dump_path, ignore_errors=True)
 
-        release_groups_count = self._add_entities_from_generator(
-            db_manager, self._release_group_generator, dump_path
+    def _populate(self, loader: BulkLoader, dump_path: str, resolve: bool):
+        # Lookup tables shared by the passes over
+        # the two largest dump files: `release_group` and `artist`
+        artist_urls, release_group_urls = self._get_urls_for_entity_ids(
+            dump_path, resolve
         )
 
-        LOGGER.debug("Added %s/%s release group records", *release_groups_count)
+        LOGGER.info("Importing release groups and their links")
 
-        def release_artist_relationships_uniqueness_filter():
-            """Remove duplicates from
-            _release_group_artist_relationship_generator"""
-            yield from [
-                MusicBrainzReleaseGroupArtistRelationship(item[0], item[1])
-                for item in set(
-                    self._release_group_artist_relationship_generator(dump_path)
-                )
-            ]
-
-        tables = [MusicBrainzReleaseGroupArtistRelationship]
-        db_manager.drop(tables)
-        db_manager.create(tables)
-        LOGGER.info(
-            "Dropped and created tables %s",
-            [table.__tablename__ for table in tables],
-        )
-        LOGGER.info("Importing relationships release-artist/band")
-
-        relationships_count = self._add_entities_from_generator(
-            db_manager, release_artist_relationships_uniqueness_filter
+        # Filled while going through release groups:
+        # artist credit ID -> release group GIDs
+        credit_release_groups = defaultdict(list)
+        release_groups_count = self._add_entities_from_generator(
+            loader,
+            self._release_group_generator,
+            dump_path,
+            release_group_urls,
+            credit_release_groups,
         )
 
-        LOGGER.debug("Added %s/%s relationships records", *relationships_count)
-
-        tables = [MusicBrainzReleaseGroupLinkEntity]
-        db_manager.drop(tables)
-        db_manager.create(tables)
-        LOGGER.info(
-            "Dropped and created tables %s",
-            [table.__tablename__ for table in tables],
+        LOGGER.debug(
+            "Added %s/%s release group and link records", *release_groups_count
         )
-        LOGGER.info("Importing release groups links")
 
-        link_count = self._add_entities_from_generator(
-            db_manager, self._release_group_link_generator, dump_path, resolve
+        # Release group lookups are no longer needed: free them before
+        # building the artist-only ones, which can then reuse that memory
+        del release_group_urls
+        artist_release_groups = self._get_artist_release_groups(
+            dump_path, credit_release_groups
         )
-
-        LOGGER.debug("Added %s/%s release group link records", *link_count)
-
-        tables = [MusicBrainzArtistEntity, MusicBrainzBandEntity]
-        db_manager.drop(tables)
-        db_manager.create(tables)
+        del credit_release_groups
+        artist_isni_links = self._get_isni_links(dump_path, resolve)
+        (
+            relationships,
+            to_invert,
+            artist_gids,
+        ) = self._get_artist_band_relationships(dump_path)
 
         LOGGER.info(
-            "Dropped and created tables %s",
-            [table.__tablename__ for table in tables],
+            "Importing artists, bands, their links, "
+            "and relationships with release groups"
         )
-        LOGGER.info("Importing artists and bands")
 
         artist_count = self._add_entities_from_generator(
-            db_manager, self._artist_generator, dump_path
-        )
-
-        LOGGER.debug("Added %s/%s artist records", *artist_count)
-
-        tables = [MusicBrainzArtistLinkEntity, MusicBrainzBandLinkEntity]
-        db_manager.drop(tables)
-        db_manager.create(tables)
-
-        LOGGER.info(
-            "Dropped and created tables %s",
-            [table.__tablename__ for table in tables],
-        )
-        LOGGER.info("Importing links")
-
-        link_count = self._add_entities_from_generator(
-            db_manager, self._artist_link_generator, dump_path, resolve
+            loader,
+            self._artist_generator,
+            dump_path,
+            artist_urls,
+            artist_isni_links,
+            artist_release_groups,
+            artist_gids,
         )
 
-        LOGGER.debug("Added %s/%s link records", *link_count)
-        LOGGER.info("Importing ISNIs")
-
-        isni_link_count = self._add_entities_from_generator(
-            db_manager, self._isni_link_generator, dump_path, resolve
-        )
-
-        LOGGER.debug("Added %s/%s ISNI link records", *isni_link_count)
-
-        tables = [MusicBrainzArtistBandRelationship]
-        db_manager.drop(tables)
-        db_manager.create(tables)
-        LOGGER.info(
-            "Dropped and created tables %s",
-            [table.__tablename__ for table in tables],
+        LOGGER.debug(
+            "Added %s/%s artist, link, and relationship records", *artist_count
         )
         LOGGER.info("Importing relationships artist-band")
 
-        def artist_band_relationships_uniqueness_filter():
-            yield from [
-                MusicBrainzArtistBandRelationship(item[0], item[1])
-                for item in set(self._artist_band_relationship_generator(dump_path))
-            ]
-
         relationships_count = self._add_entities_from_generator(
-            db_manager, artist_band_relationships_uniqueness_filter
+            loader,
+            self._artist_band_relationship_generator,
+            relationships,
+            to_invert,
+            artist_gids,
         )
 
         LOGGER.debug("Added %s/%s relationships records", *relationships_count)
-        shutil.rmtree(dump_path, ignore_errors=True)
 
     def _add_entities_from_generator(
-        self, db_manager, generator_, *args
+        self, loader, generator_, *args
     ) -> Tuple[int, int]:
         """
         Adds all entities yielded by a generator to the DB
@@ -209,12 +200,10 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
         n_total_entities = 0
         n_added_entities = 0
 
-        session = db_manager.new_session()
-
         entity_array = []  # array to which we'll add the entities
 
         # the generator will give us a new entity each loop
-        # so we just add this to the `entity_array` and commit
+        # so we just add this to the `entity_array` and load
         # it once it is large enough (self._sqlalchemy_commit_every)
         for entity in generator_(*args):
 
@@ -233,16 +222,14 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
 
                     insert_start_time = datetime.now()
 
-                    session.bulk_save_objects(entity_array)
-                    session.commit()
-                    session.expunge_all()  # clear session
+                    n_loaded = loader.save(entity_array)
 
                     entity_array.clear()  # clear entity array
 
                     LOGGER.debug(
                         "It took %s to add %s entities to the database",
                         datetime.now() - insert_start_time,
-                        len(entity_array),
+                        n_loaded,
                     )
 
                 n_added_entities += 1
@@ -250,32 +237,26 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
             except IntegrityError as i:
                 LOGGER.warning(str(i))
 
-        # finally, commit remaining entities in session
-        session.bulk_save_objects(entity_array)
-        session.commit()
-
-        # and close session
-        session.close()
+        # finally, load remaining entities
+        loader.save(entity_array)
 
         return n_total_entities, n_added_entities
 
     @staticmethod
-    def _get_urls_for_entity_id(dump_path: str, l_path: str, resolve: bool) -> dict:
-        """given a l_{something}_url relationship file, return a dict of
-        somethingid-[urls]"""
-
-        LOGGER.info(f"Loading %s relationships", l_path)
+    def _get_urls_for_entity_ids(dump_path: str, resolve: bool) -> Tuple[Dict, Dict]:
+        """Read the artist and release group URL relationships,
+        then translate them through a single pass over the *url* file.
 
-        urlid_entityid_relationship = {}
-
-        with open(l_path, "r") as tsvfile:
-            url_relationships = DictReader(
-                tsvfile, delimiter='\t', fieldnames=[i for i in range(0, 6)]
-            )
+        :return: the pair of *artist ID -> [URLs]* and
+          *release group ID -> [URLs]* dicts
+        """
+        urlid_entityid_relationships = []
+        for l_file in ('l_artist_url', 'l_release_group_url'):
+            l_path = os.path.join(dump_path, 'mbdump', l_file)
+            LOGGER.info("Loading %s relationships", l_path)
 
-            for relationship in tqdm(
-                url_relationships, total=count_num_lines_in_file(tsvfile)
-            ):
+            urlid_entityid_relationship = {}
+            for relationship in _read_tsv(l_path, list(range(0, 6))):
                 # url id matched with its user id
                 if relationship[3] in urlid_entityid_relationship:
                     LOGGER.warning(
@@ -286,176 +267,163 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
                 else:
                     urlid_entityid_relationship[relationship[3]] = relationship[2]
 
+            urlid_entityid_relationships.append(urlid_entityid_relationship)
+
         url_path = os.path.join(dump_path, 'mbdump', 'url')
-        url_entityid = {}
+        url_entityids = ({}, {})
 
-        LOGGER.info('Checking URLs related to entity')
+        LOGGER.info('Checking URLs related to artists and release groups')
 
         # Translates URL IDs to the relative URL
-        with open(url_path, "r") as tsvfile:
+        for url_record in _read_tsv(url_path, list(range(0, 5))):
+            urlid = url_record[0]
+            for urlid_entityid_relationship, url_entityid in zip(
+                urlid_entityid_relationships, url_entityids
+            ):
+                entityid = urlid_entityid_relationship.pop(urlid, None)
+                if entityid is None:
+                    continue
 
-            urls = DictReader(
-                tsvfile, delimiter='\t', fieldnames=[i for i in range(0, 5)]
-            )
+                # Keep the first valid candidate
+                for candidate_url in url_utils.clean(url_record[2]):
+                    if not url_utils.validate(candidate_url):
+                        continue
+                    if resolve and not url_utils.resolve(candidate_url):
+                        continue
+                    url_entityid[candidate_url] = entityid
+                    break
 
-            for url_record in tqdm(urls, total=count_num_lines_in_file(tsvfile)):
+        entityid_urls = []
+        # Inverts dictionaries
+        for url_entityid in url_entityids:
+            entityid_url = defaultdict(list)
+            for url, entityid in url_entityid.items():
+                entityid_url[entityid].append(url)
+            entityid_urls.append(entityid_url)
 
-                urlid = url_record[0]
-                if urlid in urlid_entityid_relationship:
-                    for candidate_url in url_utils.clean(url_record[2]):
-                        if not url_utils.validate(candidate_url):
-                            continue
-                        if resolve and not url_utils.resolve(candidate_url):
-                            continue
-                        url_entityid[candidate_url] = urlid_entityid_relationship[urlid]
-                        del urlid_entityid_relationship[urlid]
+        return entityid_urls[0], entityid_urls[1]
 
-        entityid_url = defaultdict(list)
-        # Inverts dictionary
-        for url, entityid in url_entityid.items():
-            entityid_url[entityid].append(url)
+    @staticmethod
+    def _get_isni_links(dump_path: str, resolve: bool) -> Dict[str, str]:
+        """Build ISNI links of artists through Wikidata formatter URLs.
 
-        return entityid_url
+        :return: the *artist ID -> ISNI URL* dict
+        """
+        isni_file_path = os.path.join(dump_path, 'mbdump', 'artist_isni')
 
-    def _artist_link_generator(self, dump_path: str, resolve: bool):
-        l_artist_url_path = os.path.join(dump_path, 'mbdump', 'l_artist_url')
+        url_formatters = [
+            url_formatter
+            for result in external_id_pids_and_urls()
+            for url_formatter in result.get('P213', {})
+        ]
+        if not url_formatters:
+            LOGGER.warning('No ISNI formatter URLs available, will skip ISNI links')
+            return {}
 
-        # Loads all the relationships between URL and ARTIST ID
-        artistid_url = self._get_urls_for_entity_id(
-            dump_path, l_artist_url_path, resolve
-        )
+        LOGGER.info('Getting artist ISNIs')
 
-        LOGGER.info('Adding link entities to DB')
-        # Translates ARTIST ID to the relative ARTIST
-        artist_path = os.path.join(dump_path, 'mbdump', 'artist')
-        with open(artist_path, 'r') as artistfile:
-
-            n_rows = count_num_lines_in_file(artistfile)
-            artist_link_reader = DictReader(
-                artistfile,
-                delimiter='\t',
-                fieldnames=[
-                    'id',
-                    'gid',
-                    'label',
-                    'sort_label',
-                    'b_year',
-                    'b_month',
-                    'b_day',
-                    'd_year',
-                    'd_month',
-                    'd_day',
-                    'type_id',
-                ],
-            )
+        artist_link = {}
+        for artistid_isni in _read_tsv(isni_file_path, ['id', 'isni']):
+            # If ISNI is valid, generates an url
+            artistid = artistid_isni['id']
+            isni = artistid_isni['isni']
+
+            # The last valid link wins
+            for url_formatter in url_formatters:
+                link = url_formatter.replace('$1', isni)
+                for candidate_url in url_utils.clean(link):
+                    if not url_utils.validate(candidate_url):
+                        continue
+                    if resolve and not url_utils.resolve(candidate_url):
+                        continue
+                    artist_link[artistid] = candidate_url
 
-            for artist in tqdm(artist_link_reader, total=n_rows):
-
-                if artist['id'] in artistid_url:
-                    for link in artistid_url[artist['id']]:
-                        if self._check_person(artist['type_id']):
-                            current_entity = MusicBrainzArtistLinkEntity()
-                            self._fill_link_entity(current_entity, artist['gid'], link)
-                            yield current_entity
-                        if self._check_band(artist['type_id']):
-                            current_entity = MusicBrainzBandLinkEntity()
-                            self._fill_link_entity(current_entity, artist['gid'], link)
-                            yield current_entity
-
-    def _release_group_link_generator(self, dump_path: str, resolve: bool):
-        l_release_group_url_path = os.path.join(
-            dump_path, 'mbdump', 'l_release_group_url'
-        )
+        return artist_link
 
-        release_group_id_urls = self._get_urls_for_entity_id(
-            dump_path, l_release_group_url_path, resolve
+    @staticmethod
+    def _get_artist_release_groups(
+        dump_path: str, credit_release_groups: Dict[str, List[str]]
+    ) -> Dict[str, List[str]]:
+        """Read which artists take part in which artist credits,
+        and translate them into release groups.
+
+        :param credit_release_groups: the *artist credit ID ->
+          [release group GIDs]* dict
+        :return: the *artist ID -> [release group GIDs]* dict
+        """
+        artist_credit_name_path = os.path.join(
+            dump_path, 'mbdump', 'artist_credit_name'
         )
 
-        release_group_path = os.path.join(dump_path, 'mbdump', 'release_group')
-        with open(release_group_path) as rfile:
-            n_rows = count_num_lines_in_file(rfile)
-            releases = DictReader(
-                rfile, delimiter='\t', fieldnames=['id', 'gid', 'label']
-            )
+        LOGGER.info('Getting artist credits')
+
+        artist_release_groups = {}
+        for row in _read_tsv(
+            artist_credit_name_path, ['id', 'nd', 'artist_id', 'artist_name']
+        ):
+            release_group_gids = credit_release_groups.get(row['id'])
+            if not release_group_gids:
+                continue
+
+            # Share the credit's list, and never modify it in place:
+            # other artists of the same credit may share it, too
+            artist_id = row['artist_id']
+            if artist_id in artist_release_groups:
+                artist_release_groups[artist_id] = (
+                    artist_release_groups[artist_id] + release_group_gids
+                )
+            else:
+                artist_release_groups[artist_id] = release_group_gids
 
-            for release in tqdm(releases, total=n_rows):
-                if release['id'] in release_group_id_urls:
-                    for link in release_group_id_urls[release['id']]:
-                        entity = MusicBrainzReleaseGroupLinkEntity()
-                        self._fill_link_entity(entity, release['gid'], link)
-                        yield entity
+        return artist_release_groups
 
-    def _isni_link_generator(self, dump_path: str, resolve: bool):
-        isni_file_path = os.path.join(dump_path, 'mbdump', 'artist_isni')
+    @staticmethod
+    def _get_artist_band_relationships(dump_path: str) -> Tuple[List, Set, Dict]:
+        """Read artist-band relationships, still with artist IDs.
 
-        artist_link = {}
+        :return: the list of *(artist ID, artist ID)* relationships,
+          the set of those to be inverted, and the dict of involved
+          *artist ID -> GID* to be filled
+        """
+        link_types = set(['855', '103', '305', '965', '895'])
+        link_file_path = os.path.join(dump_path, 'mbdump', 'link')
+        to_invert = set()
 
-        done = False
-        for result in external_id_pids_and_urls():
-            if done:
-                break
-            for pid, formatter in result.items():
-                if pid != 'P213':
-                    continue
-                for url_formatter, _ in formatter.items():
-                    with open(isni_file_path, 'r') as artistfile:
-                        for artistid_isni in DictReader(
-                            artistfile,
-                            delimiter='\t',
-                            fieldnames=['id', 'isni'],
-                        ):
-                            # If ISNI is valid, generates an url
-                            artistid = artistid_isni['id']
-                            isni = artistid_isni['isni']
-
-                            link = url_formatter.replace('$1', isni)
-                            for candidate_url in url_utils.clean(link):
-                                if not url_utils.validate(candidate_url):
-                                    continue
-                                if resolve and not url_utils.resolve(candidate_url):
-                                    continue
-                                artist_link[artistid] = candidate_url
-                done = True
+        LOGGER.info('Loading artist-band relationships')
 
-        artist_path = os.path.join(dump_path, 'mbdump', 'artist')
-        with open(artist_path, 'r') as artistfile:
-
-            n_rows = count_num_lines_in_file(artistfile)
-
-            artist_isni_reader = DictReader(
-                artistfile,
-                delimiter='\t',
-                fieldnames=[
-                    'id',
-                    'gid',
-                    'label',
-                    'sort_label',
-                    'b_year',
-                    'b_month',
-                    'b_day',
-                    'd_year',
-                    'd_month',
-                    'd_day',
-                    'type_id',
-                ],
-            )
+        links = set()
+        for row in _read_tsv(link_file_path, ['id', 'link_type']):
+            if row['link_type'] in link_types:
+                links.add(row['id'])
 
-            for artist in tqdm(artist_isni_reader, total=n_rows):
-                try:
-                    # Checks if artist has isni
-                    link = artist_link[artist['id']]
-                    if self._check_person(artist['type_id']):
-                        current_entity = MusicBrainzArtistLinkEntity()
-                        self._fill_link_entity(current_entity, artist['gid'], link)
-                        yield current_entity
-                    if self._check_band(artist['type_id']):
-                        current_entity = MusicBrainzBandLinkEntity()
-                        self._fill_link_entity(current_entity, artist['gid'], link)
-                        yield current_entity
-                except KeyError:
-                    continue
+        artists_relationship_file = os.path.join(dump_path, 'mbdump', 'l_artist_artist')
 
-    def _artist_generator(self, dump_path):
+        ids_translator = {}
+        relationships = []
+        for row in _read_tsv(
+            artists_relationship_file, ['id', 'link_id', 'entity0', 'entity1']
+        ):
+            link_id = row['link_id']
+            if link_id in links:
+                en0 = row['entity0']
+                en1 = row['entity1']
+                ids_translator[en0] = ''
+                ids_translator[en1] = ''
+                relationship = (en0, en1)
+                relationships.append(relationship)
+                if link_id == '855':
+                    to_invert.add(relationship)
+
+        return relationships, to_invert, ids_translator
+
+    def _artist_generator(
+        self,
+        dump_path,
+        artist_urls,
+        artist_isni_links,
+        artist_release_groups,
+        artist_gids,
+    ):
         artist_alias_path = os.path.join(dump_path, 'mbdump', 'artist_alias')
         artist_path = os.path.join(dump_path, 'mbdump', 'artist')
         area_path = os.path.join(dump_path, 'mbdump', 'area')
@@ -466,159 +434,124 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
         LOGGER.info('Getting artist aliases')
 
         # Key is the entity id which has a list of aliases
-        with open(artist_alias_path, 'r') as aliasesfile:
-            for alias in DictReader(
-                aliasesfile,
-                delimiter='\t',
-                fieldnames=['id', 'parent_id', 'label'],
-            ):
-                aliases[alias['parent_id']].append(alias['label'])
+        for alias in _read_tsv(artist_alias_path, ['id', 'parent_id', 'label']):
+            aliases[alias['parent_id']].append(alias['label'])
 
         LOGGER.info('Getting area IDs and related names')
 
         # Key is the area internal id, value is the name
-        with open(area_path, 'r') as areafile:
-            for area in DictReader(
-                areafile, delimiter='\t', fieldnames=['id', 'gid', 'name']
-            ):
-                areas[area['id']] = area['name'].lower()
+        for area in _read_tsv(area_path, ['id', 'gid', 'name']):
+            areas[area['id']] = area['name'].lower()
 
         LOGGER.info('Importing artist entities into DB')
 
-        with open(artist_path, 'r') as artistfile:
-
-            n_rows = count_num_lines_in_file(artistfile)
-
-            artist_reader = DictReader(
-                artistfile,
-                delimiter='\t',
-                fieldnames=[
-                    'id',
-                    'gid',
-                    'label',
-                    'sort_label',
-                    'b_year',
-                    'b_month',
-                    'b_day',
-                    'd_year',
-                    'd_month',
-                    'd_day',
-                    'type_id',
-                    'area',
-                    'gender',
-                    'ND1',
-                    'ND2',
-                    'ND3',
-                    'ND4',
-                    'b_place',
-                    'd_place',
-                ],
-            )
-
-            for artist in tqdm(artist_reader, total=n_rows):
+        for artist in _read_tsv(
+            artist_path,
+            [
+                'id',
+                'gid',
+                'label',
+                'sort_label',
+                'b_year',
+                'b_month',
+                'b_day',
+                'd_year',
+                'd_month',
+                'd_day',
+                'type_id',
+                'area',
+                'gender',
+                'ND1',
+                'ND2',
+                'ND3',
+                'ND4',
+                'b_place',
+                'd_place',
+            ],
+        ):
+            artist_id, gid = artist['id'], artist['gid']
+
+            # Translate IDs of artist-band relationships
+            if artist_id in artist_gids:
+                artist_gids[artist_id] = gid
+
+            # Release groups credited to the artist
+            release_group_gids = set(artist_release_groups.get(artist_id, ()))
+            for release_group_gid in release_group_gids:
+                yield MusicBrainzReleaseGroupArtistRelationship(release_group_gid, gid)
+
+            # Links, including the ISNI one
+            links = list(artist_urls.get(artist_id, ()))
+            if artist_id in artist_isni_links:
+                links.append(artist_isni_links[artist_id])
+
+            for link in links:
                 if self._check_person(artist['type_id']):
-                    current_entity = MusicBrainzArtistEntity()
-
-                    try:
-                        self._fill_entity(current_entity, artist, areas)
-                        current_entity.gender = self._artist_gender(artist['gender'])
-                    except KeyError:
-                        LOGGER.error('Wrong gender code: %s', artist)
-                        continue
-
-                    # Creates an entity foreach available alias
-                    for alias in self._alias_entities(
-                        current_entity,
-                        MusicBrainzArtistEntity,
-                        aliases[artist['id']],
-                    ):
-                        alias.gender = current_entity.gender
-                        yield alias
-
+                    current_entity = MusicBrainzArtistLinkEntity()
+                    self._fill_link_entity(current_entity, gid, link)
                     yield current_entity
-
                 if self._check_band(artist['type_id']):
-                    current_entity = MusicBrainzBandEntity()
-
-                    try:
-                        self._fill_entity(current_entity, artist, areas)
-                    except ValueError:
-                        LOGGER.error('Wrong date: %s', artist)
-                        continue
+                    current_entity = MusicBrainzBandLinkEntity()
+                    self._fill_link_entity(current_entity, gid, link)
+                    yield current_entity
 
-                    # Creates an entity foreach available alias
-                    for alias in self._alias_entities(
-                        current_entity,
-                        MusicBrainzBandEntity,
-                        aliases[artist['id']],
-                    ):
-                        yield alias
+            if self._check_person(artist['type_id']):
+                current_entity = MusicBrainzArtistEntity()
 
-                    yield current_entity
+                try:
+                    self._fill_entity(current_entity, artist, areas)
+                    current_entity.gender = self._artist_gender(artist['gender'])
+                except KeyError:
+                    LOGGER.error('Wrong gender code: %s', artist)
+                    continue
 
-    @staticmethod
-    def _artist_band_relationship_generator(dump_path):
-        link_types = set(['855', '103', '305', '965', '895'])
-        link_file_path = os.path.join(dump_path, 'mbdump', 'link')
-        to_invert = set()
+                # Creates an entity foreach available alias
+                for alias in self._alias_entities(
+                    current_entity,
+                    MusicBrainzArtistEntity,
+                    aliases.get(artist_id, ()),
+                ):
+                    alias.gender = current_entity.gender
+                    yield alias
 
-        LOGGER.info('Loading artist-band relationships')
+                yield current_entity
 
-        links = set()
-        with open(link_file_path) as link_file:
-            reader = DictReader(
-                link_file, delimiter='\t', fieldnames=['id', 'link_type']
-            )
-            for row in reader:
-                if row['link_type'] in link_types:
-                    links.add(row['id'])
+            if self._check_band(artist['type_id']):
+                current_entity = MusicBrainzBandEntity()
 
-        artists_relationship_file = os.path.join(dump_path, 'mbdump', 'l_artist_artist')
+                try:
+                    self._fill_entity(current_entity, artist, areas)
+                except ValueError:
+                    LOGGER.error('Wrong date: %s', artist)
+                    continue
 
-        ids_translator = {}
-        relationships = []
-        with open(artists_relationship_file) as relfile:
-            reader = DictReader(
-                relfile,
-                delimiter='\t',
-                fieldnames=['id', 'link_id', 'entity0', 'entity1'],
-            )
-            for row in reader:
-                link_id = row['link_id']
-                if link_id in links:
-                    en0 = row['entity0']
-                    en1 = row['entity1']
-                    ids_translator[en0] = ''
-                    ids_translator[en1] = ''
-                    relationship = (en0, en1)
-                    relationships.append(relationship)
-                    if link_id == '855':
-                        to_invert.add(relationship)
-
-        # To hope in Garbage collection intervention
-        links = None
+                # Creates an entity foreach available alias
+                for alias in self._alias_entities(
+                    current_entity,
+                    MusicBrainzBandEntity,
+                    aliases.get(artist_id, ()),
+                ):
+                    yield alias
 
-        artist_path = os.path.join(dump_path, 'mbdump', 'artist')
-        with open(artist_path, 'r') as artistfile:
-            for artist in DictReader(
-                artistfile, delimiter='\t', fieldnames=['id', 'gid']
-            ):
-                if artist['id'] in ids_translator:
-                    ids_translator[artist['id']] = artist['gid']
+                yield current_entity
 
+    @staticmethod
+    def _artist_band_relationship_generator(relationships, to_invert, artist_gids):
         LOGGER.info('Adding relationships into DB')
 
+        # Remove duplicates
+        translated = set()
         for relation in tqdm(relationships):
             translation0, translation1 = (
-                ids_translator[relation[0]],
-                ids_translator[relation[1]],
+                artist_gids[relation[0]],
+                artist_gids[relation[1]],
             )
 
             if translation0 and translation1:
                 if relation in to_invert:
-                    yield (translation1, translation0)
+                    translated.add((translation1, translation0))
                 else:
-                    yield (translation0, translation1)
+                    translated.add((translation0, translation1))
             else:
                 LOGGER.warning(
                     "Artist id missing translation: %s to (%s, %s)",
@@ -627,88 +560,33 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
                     translation1,
                 )
 
-    def _release_group_generator(self, dump_path):
+        for gid0, gid1 in translated:
+            yield MusicBrainzArtistBandRelationship(gid0, gid1)
+
+    def _release_group_generator(
+        self, dump_path, release_group_urls, credit_release_groups
+    ):
         release_group_datesprec = self._retrieve_release_group_dates(dump_path)
         release_group_path = os.path.join(dump_path, 'mbdump', 'release_group')
 
-        with open(release_group_path, 'r') as releasefile:
-            release_reader = DictReader(
-                releasefile,
-                delimiter='\t',
-                fieldnames=['id', 'gid', 'label', 'artist_credit', 'type_id'],
-            )
-
-            for row in tqdm(release_reader, total=count_num_lines_in_file(releasefile)):
-                entity = MusicBrainzReleaseGroupEntity()
-                self._fill_entity(entity, row, None)
-                if row['id'] in release_group_datesprec:
-                    dateprec = release_group_datesprec[row['id']]
-                    if dateprec[1] != 0:
-                        entity.born_precision = dateprec[1]
-                        entity.born = dateprec[0]
+        for row in _read_tsv(
+            release_group_path, ['id', 'gid', 'label', 'artist_credit', 'type_id']
+        ):
+            entity = MusicBrainzReleaseGroupEntity()
+            self._fill_entity(entity, row, None)
+            if row['id'] in release_group_datesprec:
+                dateprec = release_group_datesprec[row['id']]
+                if dateprec[1] != 0:
+                    entity.born_precision = dateprec[1]
+                    entity.born = dateprec[0]
+            yield entity
+
+            for link in release_group_urls.get(row['id'], ()):
+                entity = MusicBrainzReleaseGroupLinkEntity()
+                self._fill_link_entity(entity, row['gid'], link)
                 yield entity
 
-    @staticmethod
-    def _release_group_artist_relationship_generator(dump_path):
-        release_group_path = os.path.join(dump_path, 'mbdump', 'release_group')
-
-        artist_credit_release = defaultdict(list)
-
-        with open(release_group_path, 'r') as releasefile:
-            n_rows = count_num_lines_in_file(releasefile)
-            release_reader = DictReader(
-                releasefile,
-                delimiter='\t',
-                fieldnames=['id', 'gid', 'label', 'artist_credit', 'type_id'],
-            )
-            for row in tqdm(release_reader, total=n_rows):
-                artist_credit_release[row['artist_credit']].append(row['gid'])
-
-        artist_credit_name_path = os.path.join(
-            dump_path, 'mbdump', 'artist_credit_name'
-        )
-
-        artist_id_release = defaultdict(list)
-        with open(artist_credit_name_path) as artistcreditfile:
-            artist_credit_reader = DictReader(
-                artistcreditfile,
-                delimiter='\t',
-                fieldnames=['id', 'nd', 'artist_id', 'artist_name'],
-            )
-
-            n_rows = count_num_lines_in_file(artistcreditfile)
-            for row in tqdm(artist_credit_reader, total=n_rows):
-                artist_id_release[row['artist_id']] = artist_credit_release[row['id']]
-                # memory free up for performance
-                del artist_credit_release[row['id']]
-
-        artist_path = os.path.join(dump_path, 'mbdump', 'artist')
-        with open(artist_path, 'r') as artistfile:
-
-            n_rows = count_num_lines_in_file(artistfile)
-            artist_link_reader = DictReader(
-                artistfile,
-                delimiter='\t',
-                fieldnames=[
-                    'id',
-                    'gid',
-                    'label',
-                    'sort_label',
-                    'b_year',
-                    'b_month',
-                    'b_day',
-                    'd_year',
-                    'd_month',
-                    'd_day',
-                    'type_id',
-                ],
-            )
-
-            for artist in tqdm(artist_link_reader, total=n_rows):
-                for release_id in artist_id_release[artist['id']]:
-                    yield (release_id, artist['gid'])
-                # memory freeup for performance
-                del artist_id_release[artist['id']]
+            credit_release_groups[row['artist_credit']].append(row['gid'])
 
     def _fill_entity(self, entity, info, areas):
         entity.catalog_id = info['gid']
@@ -823,18 +701,18 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
         return genders.get(gender_code, None)
 
     def _retrieve_release_group_dates(self, dump_path):
-        release_dateprec = defaultdict(lambda: (date.today(), 0))
-
-        release_country_path = os.path.join(dump_path, 'mbdump', 'release_country')
-
-        with open(release_country_path) as rfile:
-            releases = DictReader(
-                rfile,
-                delimiter='\t',
-                fieldnames=['release_id', 'country_id', 'year', 'month', 'day'],
-            )
-
-            for release in releases:
+        # Only keep the earliest date of each release,
+        # then of each release group
+        today = date.today()
+        release_dateprec = {}
+
+        for file_name, fieldnames in (
+            ('release_country', ['release_id', 'country_id', 'year', 'month', 'day']),
+            ('release_unknown_country', ['release_id', 'year', 'month', 'day']),
+        ):
+            release_country_path = os.path.join(dump_path, 'mbdump', file_name)
+
+            for release in _read_tsv(release_country_path, fieldnames):
                 date_prec = self._get_date_and_precision(
                     release['year'], release['month'], release['day']
                 )
@@ -842,53 +720,94 @@ class MusicBrainzDumpExtractor(BaseDumpExtractor):
                 if date_prec[0] is None:
                     continue
 
-                if date_prec[0] < release_dateprec[release['release_id']][0]:
-                    release_dateprec[release['release_id']] = date_prec
+                release_id = release['release_id']
+                if date_prec[0] < release_dateprec.get(release_id, (today,))[0]:
+                    release_dateprec[release_id] = date_prec
 
-        release_country_path = os.path.join(
-            dump_path, 'mbdump', 'release_unknown_country'
-        )
+        release_group_dateprec = {}
+        release_path = os.path.join(dump_path, 'mbdump', 'release')
+        for release in _read_tsv(
+            release_path,
+            ['release_id', 'gid', 'name', 'credits', 'release_group_id'],
+        ):
+            dateprec = release_dateprec.get(release['release_id'])
+            if dateprec is None:
+                continue
+
+            release_group_id = release['release_group_id']
+            if dateprec[0] < release_group_dateprec.get(release_group_id, (today,))[0]:
+                release_group_dateprec[release_group_id] = dateprec
 
-        with open(release_country_path) as rfile:
-            releases = DictReader(
-                rfile,
-                delimiter='\t',
-                fieldnames=['release_id', 'year', 'month', 'day'],
-            )
+        return release_group_dateprec
 
-            for release in releases:
-                date_prec = self._get_date_and_precision(
-                    release['year'], release['month'], release['day']
-                )
 
-                if date_prec[0] is None:
-                    continue
+def _read_tsv(path: str, fieldnames: List) -> Iterator[Dict]:
+    # Stream the rows of a dump file as dicts.
+    # Progress goes by bytes read, so there's no need to count lines upfront
+    with open(path, 'rb') as tsv_file, tqdm(
+        total=os.path.getsize(path),
+        unit='B',
+        unit_scale=True,
+        desc=os.path.basename(path),
+    ) as progress:
 
-                if date_prec[0] < release_dateprec[release['release_id']][0]:
-                    release_dateprec[release['release_id']] = date_prec
+        def lines():
+            for line in tsv_file:
+                progress.update(len(line))
+                yield line.decode('utf-8')
 
-        release_group_dateprec = defaultdict(lambda: (date.today(), 0))
-        release_path = os.path.join(dump_path, 'mbdump', 'release')
-        with open(release_path) as rfile:
-            releases = DictReader(
-                rfile,
-                delimiter='\t',
-                fieldnames=[
-                    'release_id',
-                    'gid',
-                    'name',
-                    'credits',
-                    'release_group_id',
-                ],
-            )
+        yield from DictReader(lines(), delimiter='\t', fieldnames=fieldnames)
 
-            for release in releases:
-                if (
-                    release_dateprec[release['release_id']][0]
-                    < release_group_dateprec[release['release_group_id']][0]
-                ):
-                    release_group_dateprec[
-                        release['release_group_id']
-                    ] = release_dateprec[release['release_id']]
 
-        return release_group_dateprec
+def _extract_members(dump_file_path: str, dump_path: str) -> None:
+    # Stream the archive and only write the needed members to disk.
+    # Go through a temporary directory, so that an interrupted
+    # extraction is never mistaken for a complete one
+    tmp_path = f'{dump_path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+    LOGGER.info("Extracting %d dump tables in %s", len(DUMP_MEMBERS), dump_path)
+
+    missing = set(DUMP_MEMBERS)
+    with _open_archive(dump_file_path) as archive, tarfile.open(
+        fileobj=archive, mode='r|'
+    ) as tar:
+        for member in tar:
+            if member.name not in missing:
+                continue
+
+            LOGGER.debug("Extracting %s (%d bytes)", member.name, member.size)
+            tar.extract(member, tmp_path)
+            missing.remove(member.name)
+
+            # No need to decompress the rest of the archive
+            if not missing:
+                break
+
+    if missing:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise ValueError(f"Dump {dump_file_path} lacks tables: {sorted(missing)}")
+
+    os.replace(tmp_path, dump_path)
+    LOGGER.info("Extracted dump tables in %s", dump_path)
+
+
+@contextmanager
+def _open_archive(dump_file_path: str) -> Iterator[BinaryIO]:
+    # bz2 decompression is the bottleneck of a single reader:
+    # use parallel decompressors when available
+    program = shutil.which('lbzip2') or shutil.which('pbzip2')
+    if program is None:
+        with bz2.open(dump_file_path, 'rb') as archive:
+            yield archive
+        return
+
+    LOGGER.info("Decompressing dump through '%s'", program)
+    with subprocess.Popen(
+        [program, '-dc', dump_file_path], stdout=subprocess.PIPE, bufsize=1 << 20
+    ) as process:
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            process.kill()
@@ -31,6 +31,7 @@ from soweego.importer.models.base_entity import BaseEntity
 from soweego.importer.models.base_link_entity import BaseLinkEntity
 from soweego.ingester import wikidata_bot
 from soweego.linker.workflow import build_wikidata
+from soweego.wikidata import entity_cache, sparql_cache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -77,6 +78,9 @@ def cli(catalog, entity, rule, upload, sandbox, dir_io, dates):
 
     Run all of them by default.
     """
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     LOGGER.info("Running baseline '%s' rule over %s %s ...", rule, catalog, entity)
 
     # No need for the return value: only the output file will be consumed
@@ -185,6 +189,9 @@ def _run(catalog, entity, rule, check_dates, upload, sandbox, dir_io):
 )
 def extract_cli(catalog, entity, upload, sandbox, dir_io):
     """Extract Wikidata links from a target catalog dump."""
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     db_entity = target_database.get_link_entity(catalog, entity)
 
     if db_entity is None:
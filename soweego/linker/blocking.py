@@ -19,18 +19,33 @@ in natural language mode against the target catalog database.
 Target catalog identifiers of the output :class:`pandas.MultiIndex` are also
 passed to :func:`build_target() <soweego.linker.workflow.build_target>`
 for building the actual target dataset.
+
+Full-text search can also run in batches: one query per bucket of Wikidata
+values, over one short-lived connection per bucket.
+As an alternative to full-text search, an in-process
+:class:`InvertedIndex` over target names can answer all lookups in memory.
+It is built once per catalog import and persisted to disk.
 """
 
 import logging
 import os
-from multiprocessing import Pool
-from typing import Iterable, Tuple
+from collections import defaultdict
+from functools import lru_cache
+from math import ceil
+from multiprocessing import cpu_count, get_context
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import joblib
+import numpy as np
 import pandas as pd
+from sqlalchemy import String, literal, select, union_all
+from sqlalchemy.engine import Engine
 from tqdm import tqdm
 
-from soweego.commons import constants, keys, utils
+from soweego.commons import constants, data_gathering, keys, utils
 from soweego.commons.data_gathering import tokens_fulltext_search
+from soweego.commons.db_manager import DBManager
+from soweego.linker import cache
 
 __author__ = 'Marco Fossati'
 __email__ = 'fossati@spaziodati.eu'
@@ -40,6 +55,16 @@ __copyright__ = 'Copyleft 2018, Hjfocs'
 
 LOGGER = logging.getLogger(__name__)
 
+# DB engine of a batched full-text search worker process.
+# It doesn't pool connections: each bucket opens and closes its own,
+# so none is left behind when the pool terminates the worker
+_worker_engine: Optional[Engine] = None
+
+# Blocking runs in a linker pipeline thread: forking there would copy
+# locks held by the other threads into worker processes, and may deadlock.
+# The fork server is started clean, so workers don't inherit any lock
+_POOL_CONTEXT = get_context('forkserver')
+
 
 def find_samples(
     goal: str,
@@ -48,6 +73,7 @@ def find_samples(
     chunk_number: int,
     target_db_entity: constants.DB_ENTITY,
     dir_io: str,
+    engine: str = keys.FULLTEXT,
 ) -> pd.MultiIndex:
     """Build a blocking index by looking up target catalog identifiers given a
     Wikidata dataset column. A meaningful column should hold strings.
@@ -55,8 +81,13 @@ def find_samples(
     Under the hood, run
     `full-text search <https://mariadb.com/kb/en/library/full-text-index-overview/>`_
     in *natural language mode* against the target catalog database.
+    If ``engine='batch'``, send one query per bucket of
+    :data:`BLOCKING_BUCKET_SIZE <soweego.commons.constants.BLOCKING_BUCKET_SIZE>`
+    Wikidata values, with one connection per worker for the whole chunk.
+    If ``engine='index'``, run the same kind of lookup against an in-memory
+    :class:`InvertedIndex` instead.
 
-    This function uses multithreaded parallel processing.
+    Full-text engines use multithreaded parallel processing.
 
     :param goal: ``{'training', 'classification'}``.
       Whether the samples are for training or classification
@@ -71,37 +102,56 @@ def find_samples(
       database that full-text search should aim at
     :param dir_io: input/output directory where index chunks
       will be read/written
+    :param engine: ``{'fulltext', 'batch', 'index'}``. Whether to query
+      the target database full-text index one value at a time, in batches,
+      or an in-memory inverted index
     :return: the blocking index holding candidate pairs
     """
     utils.check_goal_value(goal)
+    _check_engine_value(engine)
 
-    samples_path = os.path.join(
-        dir_io,
-        constants.SAMPLES.format(
-            catalog, target_db_entity.__name__, goal, chunk_number
-        ),
+    # Cached samples are keyed by all inputs, so they can't be stale.
+    # Can't tell which target import they come from: don't cache them
+    import_timestamp = data_gathering.get_import_timestamp(target_db_entity)
+    cache_key = (
+        None
+        if import_timestamp is None
+        else cache.make_key(
+            catalog,
+            target_db_entity.__name__,
+            import_timestamp,
+            engine,
+            constants.BLOCKING_LIMIT,
+            cache.data_digest(wikidata_column),
+        )
     )
 
-    # Early return cached samples, for development purposes
-    if os.path.isfile(samples_path):
+    # Early return cached samples
+    samples_index = cache.load(cache.SAMPLES, cache_key, dir_io)
+    if samples_index is not None:
         LOGGER.info(
-            "Will reuse existing %s %s samples index, chunk %d: '%s'",
+            'Will reuse existing %s %s samples index, chunk %d',
             catalog,
             goal,
             chunk_number,
-            samples_path,
         )
-        return pd.read_pickle(samples_path)
+        return samples_index
 
     LOGGER.info(
-        "Blocking on Wikidata column '%s' "
-        "via full-text search to find all samples ...",
+        "Blocking on Wikidata column '%s' via %s engine to find all samples ...",
         wikidata_column.name,
+        engine,
     )
 
     wikidata_column.dropna(inplace=True)
 
-    samples = _fire_queries(wikidata_column, target_db_entity)
+    if engine == keys.INVERTED_INDEX:
+        index = load_index(catalog, target_db_entity, dir_io)
+        samples = _search_index(wikidata_column, index)
+    elif engine == keys.BATCHED_FULLTEXT:
+        samples = _fire_batched_queries(wikidata_column, target_db_entity)
+    else:
+        samples = _fire_queries(wikidata_column, target_db_entity)
     samples_index = pd.MultiIndex.from_tuples(samples, names=[keys.QID, keys.TID])
 
     LOGGER.debug(
@@ -112,22 +162,231 @@ def find_samples(
         samples_index.to_series().sample(5),
     )
 
-    os.makedirs(os.path.dirname(samples_path), exist_ok=True)
-    pd.to_pickle(samples_index, samples_path)
-
-    LOGGER.info(
-        "%s %s samples index chunk %d dumped to '%s'",
-        catalog,
-        goal,
-        chunk_number,
-        samples_path,
-    )
+    samples_path = cache.dump(samples_index, cache.SAMPLES, cache_key, dir_io)
+    if samples_path is not None:
+        LOGGER.info(
+            "%s %s samples index chunk %d dumped to '%s'",
+            catalog,
+            goal,
+            chunk_number,
+            samples_path,
+        )
 
     LOGGER.info('Built blocking index of all samples, chunk %d', chunk_number)
 
     return samples_index
 
 
+class InvertedIndex:
+    """An in-memory inverted index over target catalog name tokens.
+
+    Each row of the target table is a document, as in the database
+    full-text index. Ranking mimics MariaDB InnoDB *natural language mode*,
+    see `how relevancy is computed <https://mariadb.com/kb/en/library/full-text-index-overview/#relevance>`_:
+    the score of a document is the sum over query terms of
+    ``TF * IDF * IDF``, where ``IDF = log10(total documents / matching documents)``.
+    """
+
+    def __init__(
+        self,
+        tids: np.ndarray,
+        postings: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    ):
+        """
+        :param tids: target catalog IDs, one per document
+        :param postings: a dictionary ``{token: (document IDs, term frequencies)}``
+        """
+        self.tids = tids
+        self.postings = postings
+
+    def __len__(self):
+        return len(self.tids)
+
+    @classmethod
+    def build(cls, target_db_entity: constants.DB_ENTITY) -> 'InvertedIndex':
+        """Build an index by streaming the ``name_tokens`` column
+        of a target catalog table.
+
+        :param target_db_entity: an ORM entity (AKA table) of the target
+          catalog database
+        :return: the inverted index
+        """
+        LOGGER.info(
+            'Building inverted index over %s name tokens ...',
+            target_db_entity.__name__,
+        )
+
+        tids: List[str] = []
+        documents, frequencies = defaultdict(list), defaultdict(list)
+
+        session = DBManager.connect_to_db()
+        try:
+            query = session.query(
+                target_db_entity.catalog_id, target_db_entity.name_tokens
+            ).yield_per(10000)
+
+            for doc_id, (tid, name_tokens) in enumerate(tqdm(query)):
+                tids.append(tid)
+                if not name_tokens:
+                    continue
+
+                term_frequencies = defaultdict(int)
+                for token in _filter_tokens(name_tokens.split()):
+                    term_frequencies[token] += 1
+
+                for token, frequency in term_frequencies.items():
+                    documents[token].append(doc_id)
+                    frequencies[token].append(frequency)
+
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        postings = {
+            token: (
+                np.array(doc_ids, dtype=np.int32),
+                np.array(frequencies.pop(token), dtype=np.float32),
+            )
+            for token, doc_ids in documents.items()
+        }
+
+        LOGGER.info(
+            'Built inverted index: %d documents, %d tokens',
+            len(tids),
+            len(postings),
+        )
+
+        return cls(np.array(tids, dtype=object), postings)
+
+    def search(
+        self, tokens: Iterable[str], limit: int = constants.BLOCKING_LIMIT
+    ) -> List[str]:
+        """Find the top-scoring target catalog IDs given query tokens.
+
+        :param tokens: query terms
+        :param limit: (optional) maximum number of matching documents
+        :return: the list of target catalog IDs
+        """
+        total = len(self.tids)
+        doc_ids, weights = [], []
+
+        for token in set(_filter_tokens(tokens)):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+
+            documents, frequencies = posting
+            idf = np.log10(total / len(documents))
+            doc_ids.append(documents)
+            weights.append(frequencies * idf * idf)
+
+        if not doc_ids:
+            return []
+
+        candidates, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights))
+
+        # Like natural language mode, only keep documents with a positive rank
+        positive = scores > 0
+        candidates, scores = candidates[positive], scores[positive]
+
+        if len(candidates) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            candidates = candidates[top]
+
+        return self.tids[candidates].tolist()
+
+    def dump(self, path: str) -> None:
+        """Persist the index to disk.
+
+        :param path: an output file path
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(self, path)
+        LOGGER.info("Inverted index dumped to '%s'", path)
+
+
+def load_index(
+    catalog: str, target_db_entity: constants.DB_ENTITY, dir_io: str
+) -> InvertedIndex:
+    """Load the inverted index of a target catalog table,
+    or build it if the table was imported after the last build.
+
+    :param catalog: ``{'discogs', 'imdb', 'musicbrainz'}``.
+      A supported catalog
+    :param target_db_entity: an ORM entity (AKA table) of the target
+      catalog database
+    :param dir_io: input/output directory where the index
+      will be read/written
+    :return: the inverted index
+    """
+    import_timestamp = data_gathering.get_import_timestamp(target_db_entity)
+    return _load_index(catalog, target_db_entity, dir_io, import_timestamp)
+
+
+# Load the index only once per process,
+# since `find_samples` runs on each Wikidata chunk
+@lru_cache()
+def _load_index(
+    catalog: str,
+    target_db_entity: constants.DB_ENTITY,
+    dir_io: str,
+    import_timestamp: Optional[str],
+) -> InvertedIndex:
+    # Can't tell which import the index comes from, so don't persist it
+    if import_timestamp is None:
+        return InvertedIndex.build(target_db_entity)
+
+    index_path = os.path.join(
+        dir_io,
+        constants.BLOCKING_INDEX.format(
+            catalog, target_db_entity.__name__, import_timestamp
+        ),
+    )
+
+    if os.path.isfile(index_path):
+        LOGGER.info("Will reuse existing inverted index: '%s'", index_path)
+        return joblib.load(index_path)
+
+    index = InvertedIndex.build(target_db_entity)
+    index.dump(index_path)
+
+    return index
+
+
+def _filter_tokens(tokens: Iterable[str]) -> Iterable[str]:
+    return (
+        token
+        for token in tokens
+        if token and len(token) >= constants.FULLTEXT_MIN_TOKEN_SIZE
+    )
+
+
+def _search_index(
+    wikidata_column: pd.Series, index: InvertedIndex
+) -> Iterable[Tuple[str, str]]:
+    for qid, values in tqdm(wikidata_column.items(), total=len(wikidata_column)):
+        tids = set(index.search(values))
+        LOGGER.debug('Target ID candidates: %s - Query terms: %s', tids, values)
+
+        for tid in tids:
+            yield qid, tid
+
+
+def _check_engine_value(engine):
+    if engine not in constants.BLOCKING_ENGINES:
+        err_msg = (
+            f"Invalid blocking engine: {engine}. "
+            f"It should be one of {constants.BLOCKING_ENGINES}"
+        )
+
+        LOGGER.critical(err_msg)
+        raise ValueError(err_msg)
+
+
 def _query_generator(
     wikidata_column: pd.Series, target_db_entity: constants.DB_ENTITY
 ) -> Iterable[Tuple[str, list, constants.DB_ENTITY]]:
@@ -138,7 +397,7 @@ def _query_generator(
 def _full_text_search(
     query: Tuple[str, list, constants.DB_ENTITY],
     boolean_mode: bool = False,
-    limit: int = 5,
+    limit: int = constants.BLOCKING_LIMIT,
 ) -> Iterable[Tuple[str, str]]:
     qid, query_terms, target_db_entity = query
     tids = set(
@@ -155,7 +414,7 @@ def _full_text_search(
 
 
 def _fire_queries(wikidata_column: pd.Series, target_db_entity: constants.DB_ENTITY):
-    with Pool() as pool:
+    with _POOL_CONTEXT.Pool() as pool:
         for result in tqdm(
             pool.imap_unordered(
                 _full_text_search,
@@ -164,3 +423,76 @@ def _fire_queries(wikidata_column: pd.Series, target_db_entity: constants.DB_ENT
             total=len(wikidata_column),
         ):
             yield from result
+
+
+def _bucket_generator(
+    wikidata_column: pd.Series, target_db_entity: constants.DB_ENTITY
+) -> Iterable[Tuple[List[Tuple[str, list]], constants.DB_ENTITY]]:
+    items = list(wikidata_column.items())
+    for i in range(0, len(items), constants.BLOCKING_BUCKET_SIZE):
+        yield items[i : i + constants.BLOCKING_BUCKET_SIZE], target_db_entity
+
+
+def _init_worker():
+    global _worker_engine
+    _worker_engine = DBManager().get_engine()
+
+
+def _batched_full_text_search(
+    bucket: Tuple[List[Tuple[str, list]], constants.DB_ENTITY],
+    limit: int = constants.BLOCKING_LIMIT,
+) -> Iterable[Tuple[str, str]]:
+    queries, target_db_entity = bucket
+    column = target_db_entity.name_tokens
+
+    selects = []
+    for i, (qid, query_terms) in enumerate(queries):
+        terms = ' '.join(filter(None, query_terms))
+        if not terms:
+            continue
+
+        # Each query is a derived table, so that its `LIMIT`
+        # doesn't apply to the whole `UNION ALL`
+        subquery = (
+            select(
+                [
+                    literal(qid, type_=String).label(keys.QID),
+                    target_db_entity.catalog_id,
+                ]
+            )
+            .where(column.match(terms))
+            .limit(limit)
+            .alias(f'q{i}')
+        )
+        selects.append(select([subquery.c[keys.QID], subquery.c[keys.CATALOG_ID]]))
+
+    if not selects:
+        return set()
+
+    statement = selects[0] if len(selects) == 1 else union_all(*selects)
+    with _worker_engine.connect() as connection:
+        samples = {(qid, tid) for qid, tid in connection.execute(statement)}
+
+    LOGGER.debug(
+        'Got %d target ID candidates from a bucket of %d Wikidata values',
+        len(samples),
+        len(queries),
+    )
+
+    return samples
+
+
+def _fire_batched_queries(
+    wikidata_column: pd.Series, target_db_entity: constants.DB_ENTITY
+):
+    workers = min(cpu_count(), constants.BLOCKING_MAX_CONNECTIONS)
+
+    with _POOL_CONTEXT.Pool(processes=workers, initializer=_init_worker) as pool:
+        for result in tqdm(
+            pool.imap_unordered(
+                _batched_full_text_search,
+                _bucket_generator(wikidata_column, target_db_entity),
+            ),
+            total=ceil(len(wikidata_column) / constants.BLOCKING_BUCKET_SIZE),
+        ):
+            yield from result
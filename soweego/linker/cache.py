@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Content-addressed cache for samples and features of Wikidata chunks.
+
+Each cache entry is named after a hash of the inputs that produced it,
+i.e., the Wikidata chunk data, the target catalog import timestamp,
+and the blocking or feature set definition.
+As a result, stale entries are never reused: a change in any input
+yields a new key, while unchanged chunks still hit the cache.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import hashlib
+import logging
+import os
+from collections import Counter
+from typing import Any, Optional, Union
+
+import pandas as pd
+import recordlinkage as rl
+
+from soweego.commons import constants, data_gathering, target_database
+from soweego.linker import features
+
+LOGGER = logging.getLogger(__name__)
+
+# Cache kinds, as paths relative to the input/output directory
+SAMPLES = constants.SAMPLES
+FEATURES = constants.FEATURES
+
+# Hit/miss counters, see `log_stats`
+_hits, _misses = Counter(), Counter()
+
+
+def make_key(*parts: Any) -> str:
+    """Build a cache key out of input fingerprints.
+
+    :param parts: strings or objects with a stable ``repr``
+    :return: the hexadecimal SHA-256 digest of the parts
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+        # Separator, so that ('ab', 'c') and ('a', 'bc') don't collide
+        digest.update(b'\x00')
+
+    return digest.hexdigest()
+
+
+def data_digest(data: Union[pd.DataFrame, pd.Series, pd.MultiIndex]) -> str:
+    """Fingerprint a pandas object, including its index.
+
+    Cells are hashed through their string representation,
+    since list and set values are not hashable.
+
+    :param data: a Wikidata chunk, a column of it, or an index of
+      *(QID, target ID)* pairs
+    :return: the hexadecimal SHA-256 digest of the data
+    """
+    if isinstance(data, pd.DataFrame):
+        data = data.apply(lambda column: column.map(_stable_repr))
+    elif isinstance(data, pd.Series):
+        data = data.map(_stable_repr)
+
+    hashes = pd.util.hash_pandas_object(data).values
+
+    return hashlib.sha256(hashes.tobytes()).hexdigest()
+
+
+def feature_set_digest(feature_extractor: rl.Compare) -> str:
+    """Fingerprint a feature set definition.
+
+    Both feature parameters and the source code of
+    :mod:`soweego.linker.features` are taken into account.
+
+    :param feature_extractor: a feature extractor
+      with all features added
+    :return: the hexadecimal SHA-256 digest of the definition
+    """
+    with open(features.__file__, 'rb') as fin:
+        source = hashlib.sha256(fin.read()).hexdigest()
+
+    definition = [
+        (
+            type(feature).__name__,
+            # Skip private attributes, like process-local caches
+            sorted(
+                (name, _stable_repr(value))
+                for name, value in vars(feature).items()
+                if not name.startswith('_')
+            ),
+        )
+        for feature in feature_extractor.features
+    ]
+
+    return make_key(source, definition)
+
+
+def target_import_timestamp(catalog: str, entity: str) -> Optional[str]:
+    """Get the import timestamp of all target catalog tables
+    relevant to a given catalog and entity.
+
+    :param catalog: ``{'discogs', 'imdb', 'musicbrainz'}``.
+      A supported catalog
+    :param entity: ``{'actor', 'band', 'director', 'musician', 'producer',
+      'writer', 'audiovisual_work', 'musical_work'}``.
+      A supported entity
+    :return: the timestamps joined together, or ``None`` if any of them
+      is not available. In this case, caching should be skipped
+    """
+    timestamps = []
+    for table in (
+        target_database.get_main_entity(catalog, entity),
+        target_database.get_link_entity(catalog, entity),
+        target_database.get_nlp_entity(catalog, entity),
+    ):
+        if table is None:
+            continue
+
+        timestamp = data_gathering.get_import_timestamp(table)
+        if timestamp is None:
+            return None
+
+        timestamps.append(timestamp)
+
+    return '_'.join(timestamps)
+
+
+def load(kind: str, key: Optional[str], dir_io: str) -> Optional[Any]:
+    """Load a cache entry.
+
+    :param kind: ``{SAMPLES, FEATURES}``. A cache kind
+    :param key: a cache key as returned by :func:`make_key`.
+      ``None`` means the entry can't be cached, thus a miss
+    :param dir_io: input/output directory where the cache lives
+    :return: the cached object, or ``None`` on a miss
+    """
+    path = _path(kind, key, dir_io)
+
+    if path is None or not os.path.isfile(path):
+        _misses[kind] += 1
+        LOGGER.debug("Cache miss: '%s'", path)
+        return None
+
+    _hits[kind] += 1
+    LOGGER.info("Cache hit, will reuse: '%s'", path)
+
+    return pd.read_pickle(path)
+
+
+def dump(obj: Any, kind: str, key: Optional[str], dir_io: str) -> Optional[str]:
+    """Store a cache entry.
+
+    :param obj: a pandas object
+    :param kind: ``{SAMPLES, FEATURES}``. A cache kind
+    :param key: a cache key as returned by :func:`make_key`.
+      ``None`` means the entry can't be cached, so nothing happens
+    :param dir_io: input/output directory where the cache lives
+    :return: the cache entry path, or ``None`` if not cached
+    """
+    path = _path(kind, key, dir_io)
+    if path is None:
+        return None
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first, so that
+    # a failure won't leave a broken entry behind
+    tmp_path = f'{path}.tmp'
+    pd.to_pickle(obj, tmp_path, compression='gzip')
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def log_stats() -> None:
+    """Log cache hit/miss metrics of the current process."""
+    for kind in sorted(_hits.keys() | _misses.keys()):
+        hits, misses = _hits[kind], _misses[kind]
+        LOGGER.info(
+            "Cache '%s': %d hits, %d misses, %.0f%% hit rate",
+            kind.split(os.sep)[0],
+            hits,
+            misses,
+            hits / (hits + misses) * 100,
+        )
+
+
+def _path(kind, key, dir_io):
+    if key is None:
+        return None
+
+    return os.path.join(dir_io, kind.format(key[:2], key))
+
+
+def _stable_repr(value):
+    # Set order depends on string hash randomization across processes
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(value, key=repr))
+
+    return repr(value)
@@ -1,9 +1,10 @@
 import click
 
-from soweego.linker import baseline, evaluate, link, train
+from soweego.linker import baseline, columnar, evaluate, link, train
 
 CLI_COMMANDS = {
     'baseline': baseline.cli,
+    'convert': columnar.cli,
     'evaluate': evaluate.cli,
     'extract': baseline.extract_cli,
     'link': link.cli,
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""`Apache Parquet <https://parquet.apache.org/>`_ storage backend
+for the Wikidata training and classification sets.
+
+List columns like names, URLs, dates, and occupations are stored natively.
+Reads are chunked by row group and can project columns,
+so re-runs don't need to parse JSON at all.
+
+This backend requires the `pyarrow <https://arrow.apache.org/docs/python/>`_
+library, shipped with the project environment.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import gzip
+import json
+import logging
+import os
+from typing import Dict, Iterator, List
+
+import click
+import pandas as pd
+from numpy import nan
+
+from soweego.commons import constants, keys, target_database
+from soweego.wikidata import vocabulary
+
+LOGGER = logging.getLogger(__name__)
+
+# Wikidata set columns holding `[date, precision]` pairs
+DATE_COLUMNS = (keys.DATE_OF_BIRTH, keys.DATE_OF_DEATH)
+
+DATE_VALUE, DATE_PRECISION = 'value', 'precision'
+
+
+@click.command()
+@click.argument('catalog', type=click.Choice(target_database.supported_targets()))
+@click.argument('entity', type=click.Choice(target_database.supported_entities()))
+@click.option(
+    '-d',
+    '--dir-io',
+    type=click.Path(file_okay=False),
+    default=constants.WORK_DIR,
+    help=f'Input/output directory, default: {constants.WORK_DIR}.',
+)
+def cli(catalog, entity, dir_io):
+    """Convert existing Wikidata sets from JSON Lines to Parquet."""
+    for wd_set in (constants.WD_TRAINING_SET, constants.WD_CLASSIFICATION_SET):
+        jsonl_path = os.path.join(dir_io, wd_set.format(catalog, entity))
+
+        if not os.path.isfile(jsonl_path):
+            LOGGER.info("Skipping '%s': no such file", jsonl_path)
+            continue
+
+        convert(jsonl_path)
+
+
+def parquet_path(jsonl_path: str) -> str:
+    """Get the Parquet counterpart of a Wikidata set file path.
+
+    :param jsonl_path: path to a gzipped JSON Lines Wikidata set
+    :return: the Parquet file path
+    """
+    return jsonl_path.replace(
+        constants.WD_SET_JSONL_EXTENSION, constants.WD_SET_PARQUET_EXTENSION
+    )
+
+
+def is_stale(jsonl_path: str) -> bool:
+    """Check whether the Parquet counterpart of a Wikidata set
+    should be (re)built.
+
+    :param jsonl_path: path to a gzipped JSON Lines Wikidata set
+    :return: ``True`` if the Parquet file doesn't exist,
+      or is older than the JSON Lines one
+    """
+    out_path = parquet_path(jsonl_path)
+
+    if not os.path.isfile(out_path):
+        return True
+
+    # A rebuilt JSON Lines set must not be shadowed by an old conversion
+    return os.path.isfile(jsonl_path) and os.path.getmtime(
+        jsonl_path
+    ) > os.path.getmtime(out_path)
+
+
+def convert(jsonl_path: str, chunk_size: int = 1000) -> str:
+    """Convert a Wikidata set from gzipped JSON Lines to Parquet.
+
+    The input file is streamed, one row group at a time.
+
+    :param jsonl_path: path to a gzipped JSON Lines Wikidata set,
+      as dumped by
+      :func:`build_wikidata() <soweego.linker.workflow.build_wikidata>`
+    :param chunk_size: (optional) how many items per row group
+    :return: the output Parquet file path
+    """
+    pa, pq = _import_pyarrow()
+
+    out_path = parquet_path(jsonl_path)
+    # Write to a temporary file first, so that
+    # a failure won't leave a broken Wikidata set behind
+    tmp_path = f'{out_path}.tmp'
+    schema = _schema(pa)
+
+    LOGGER.info("Converting '%s' to Parquet ...", jsonl_path)
+
+    items = 0
+    with gzip.open(jsonl_path, 'rt') as fin, pq.ParquetWriter(
+        tmp_path, schema
+    ) as writer:
+        chunk = []
+        for line in fin:
+            chunk.append(json.loads(line))
+
+            if len(chunk) == chunk_size:
+                writer.write_table(_to_table(pa, schema, chunk))
+                items += len(chunk)
+                chunk = []
+
+        if chunk:
+            writer.write_table(_to_table(pa, schema, chunk))
+            items += len(chunk)
+
+    os.replace(tmp_path, out_path)
+
+    LOGGER.info("Converted %d items to '%s'", items, out_path)
+
+    return out_path
+
+
+def read(
+    path: str, chunk_size: int = 1000, columns: List[str] = None
+) -> Iterator[pd.DataFrame]:
+    """Read a Parquet Wikidata set into a generator of
+    :class:`pandas.DataFrame` chunks.
+
+    Chunks look exactly like those read from JSON Lines:
+    list values are Python lists, dates are ``[date, precision]`` lists,
+    and missing values are ``NaN``.
+
+    If the JSON Lines set beside it is newer, the Parquet file is rebuilt first.
+
+    :param path: path to a Parquet Wikidata set
+    :param chunk_size: (optional) how many items per chunk
+    :param columns: (optional) a subset of columns to read
+    :return: the generator yielding :class:`pandas.DataFrame` chunks
+    """
+    _, pq = _import_pyarrow()
+
+    jsonl_path = _jsonl_path(path)
+    if os.path.isfile(jsonl_path) and is_stale(jsonl_path):
+        convert(jsonl_path)
+
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+        chunk = {}
+        for name, column in zip(batch.schema.names, batch.columns):
+            values = column.to_pylist()
+
+            if name in DATE_COLUMNS:
+                chunk[name] = [
+                    nan
+                    if dates is None
+                    else [[date[DATE_VALUE], date[DATE_PRECISION]] for date in dates]
+                    for dates in values
+                ]
+            else:
+                chunk[name] = [nan if value is None else value for value in values]
+
+        yield pd.DataFrame(chunk, columns=batch.schema.names)
+
+
+def read_qids_and_tids(path: str) -> Dict[str, Dict[str, List[str]]]:
+    """Read the ``{QID: {'tid': [target_IDs]} }`` dictionary
+    of a Parquet Wikidata training set.
+
+    Only QID and target ID columns are loaded.
+
+    :param path: path to a Parquet Wikidata training set
+    :return: the dictionary of QIDs and target IDs
+    """
+    _, pq = _import_pyarrow()
+
+    table = pq.read_table(path, columns=[keys.QID, keys.TID])
+
+    return {
+        qid: {keys.TID: tids}
+        for qid, tids in zip(
+            table.column(keys.QID).to_pylist(), table.column(keys.TID).to_pylist()
+        )
+    }
+
+
+def _jsonl_path(path):
+    return path.replace(
+        constants.WD_SET_PARQUET_EXTENSION, constants.WD_SET_JSONL_EXTENSION
+    )
+
+
+def _schema(pa):
+    # All fields dumped by `api_requests.get_data_for_linker`:
+    # string lists, except for QIDs and dates
+    list_columns = [keys.TID, keys.NAME, keys.DESCRIPTION, keys.URL]
+    list_columns.extend(
+        column
+        for column in dict.fromkeys(vocabulary.LINKER_PIDS.values())
+        if column not in DATE_COLUMNS
+    )
+    date = pa.struct([(DATE_VALUE, pa.string()), (DATE_PRECISION, pa.int64())])
+
+    fields = [pa.field(keys.QID, pa.string(), nullable=False)]
+    fields.extend(pa.field(column, pa.list_(pa.string())) for column in list_columns)
+    fields.extend(pa.field(column, pa.list_(date)) for column in DATE_COLUMNS)
+
+    return pa.schema(fields)
+
+
+def _to_table(pa, schema, items):
+    columns = {name: [] for name in schema.names}
+
+    for item in items:
+        unexpected = item.keys() - columns.keys()
+        if unexpected:
+            LOGGER.warning(
+                'Skipping unexpected fields of %s: %s', item.get(keys.QID), unexpected
+            )
+
+        for name, values in columns.items():
+            value = item.get(name)
+
+            if value is not None and name in DATE_COLUMNS:
+                value = [
+                    {DATE_VALUE: date, DATE_PRECISION: precision}
+                    for date, precision in value
+                ]
+
+            values.append(value)
+
+    return pa.Table.from_pydict(columns, schema=schema)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        LOGGER.critical(
+            "The Parquet backend requires 'pyarrow'. "
+            "Install it with: pip install pyarrow"
+        )
+        raise
+
+    return pyarrow, pyarrow.parquet
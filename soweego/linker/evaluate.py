@@ -24,6 +24,7 @@ from sklearn.model_selection import GridSearchCV, StratifiedKFold
 
 from soweego.commons import constants, target_database, utils
 from soweego.linker import train
+from soweego.wikidata import entity_cache, sparql_cache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -72,6 +73,9 @@ def cli(ctx, classifier, catalog, entity, k_folds, single, nested, metric, dir_i
     By default, run 5-fold cross-validation and
     return averaged performance scores.
     """
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     kwargs = utils.handle_extra_cli_args(ctx.args)
     if kwargs is None:
         sys.exit(1)
@@ -43,20 +43,19 @@ __version__ = '1.0'
 __license__ = 'GPL-3.0'
 __copyright__ = 'Copyleft 2018, Hjfocs'
 
-import itertools
 import logging
 from multiprocessing import Manager
-from typing import List, Set, Tuple
+from typing import Callable, Iterable, Set, Tuple
 
 import jellyfish
 import numpy as np
 import pandas as pd
 from recordlinkage.base import BaseCompareFeature
 from recordlinkage.utils import fillna
-from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer
 
 from soweego.commons import constants, text_utils
-from soweego.wikidata import sparql_queries
+from soweego.wikidata import class_hierarchy, sparql_queries
 
 LOGGER = logging.getLogger(__name__)
 
@@ -70,6 +69,10 @@ LOGGER = logging.getLogger(__name__)
 _threading_manager = Manager()
 _global_occupations_qid_cache = _threading_manager.dict()
 
+# Text vectorizers for cosine similarity, keyed by (analyzer, n-gram range).
+# See `SimilarStrings._get_vectorizer`
+_vectorizers = {}
+
 
 # Adapted from https://github.com/J535D165/recordlinkage/blob/master/recordlinkage/compare.py
 # See RECORDLINKAGE_LICENSE
@@ -131,6 +134,13 @@ class ExactMatch(BaseCompareFeature):
 class SimilarStrings(BaseCompareFeature):
     """Compare pairs of lists holding **strings**
     through similarity measures on each pair of elements.
+
+    A pair where any list is null or empty gets *missing_value*.
+    With the Levenshtein distance, a null element scores *missing_value*
+    against any other element, and a pair gets its best score.
+    If *missing_value* is ``NaN``, then any null element makes
+    the whole pair ``NaN``: before the batched implementation,
+    the outcome depended on the order of elements.
     """
 
     name = 'similar_strings'
@@ -167,7 +177,7 @@ class SimilarStrings(BaseCompareFeature):
         :param analyzer: (optional, only applies when *algorithm='cosine'*)
           ``{'soweego', 'word', 'char', 'char_wb'}``.
           A text analyzer to preprocess input. It is passed to the *analyzer*
-          parameter of :class:`sklearn.feature_extraction.text.CountVectorizer`.
+          parameter of :class:`sklearn.feature_extraction.text.HashingVectorizer`.
 
           - ``'soweego'`` is :func:`soweego.commons.text_utils.tokenize`
           - ``{'word', 'char', 'char_wb'}`` are *scikit* built-ins. See
@@ -179,7 +189,7 @@ class SimilarStrings(BaseCompareFeature):
         :param ngram_range: (optional, only applies when *algorithm='cosine'*
           and *analyzer* is not *'soweego')*. Lower and upper boundary for
           n-gram extraction, passed to
-          :class:`CountVectorizer <sklearn.feature_extraction.text.CountVectorizer>`
+          :class:`HashingVectorizer <sklearn.feature_extraction.text.HashingVectorizer>`
         :param label: (optional) a label for the output feature
           :class:`Series <pandas.Series>`
         """
@@ -219,36 +229,42 @@ class SimilarStrings(BaseCompareFeature):
     # TODO low scores if name is swapped with surname,
     #  see https://github.com/Wikidata/soweego/issues/175
     def levenshtein_similarity(self, source_column, target_column):
-        paired = pd.Series(list(zip(source_column, target_column)))
-
-        def levenshtein_apply(pair):
-            if _pair_has_any_null(pair):
-                LOGGER.debug(
-                    "Can't compute Levenshtein distance, "
-                    "the pair contains null values: %s",
-                    pair,
-                )
-                return np.nan
+        (
+            source_values,
+            target_values,
+            source_index,
+            target_index,
+            pair_counts,
+        ) = _element_pairs(source_column, target_column)
+
+        # Compute the distance only once per distinct pair of strings.
+        # Shift codes by 1, so that null values get 0
+        codes, strings = pd.factorize(
+            np.array(source_values + target_values, dtype=object)
+        )
+        codes += 1
+        base = len(strings) + 1
+        source_codes = codes[: len(source_values)][source_index]
+        target_codes = codes[len(source_values) :][target_index]
+        distinct_pairs, inverse = np.unique(
+            source_codes * base + target_codes, return_inverse=True
+        )
 
-            scores = []
-            source_list, target_list = pair
-
-            for source in source_list:
-                for target in target_list:
-                    try:
-                        score = 1 - jellyfish.levenshtein_distance(
-                            source, target
-                        ) / np.max([len(source), len(target)])
-                        scores.append(score)
-                    except TypeError:
-                        if pd.isnull(source) or pd.isnull(target):
-                            scores.append(self.missing_value)
-                        else:
-                            raise
+        distinct_scores = np.empty(len(distinct_pairs))
+        for i, pair_code in enumerate(distinct_pairs):
+            source_code, target_code = divmod(int(pair_code), base)
+            if source_code == 0 or target_code == 0:
+                distinct_scores[i] = self.missing_value
+                continue
 
-            return max(scores)
+            source, target = strings[source_code - 1], strings[target_code - 1]
+            distinct_scores[i] = 1 - jellyfish.levenshtein_distance(
+                source, target
+            ) / np.max([len(source), len(target)])
 
-        return paired.apply(levenshtein_apply)
+        return pd.Series(
+            _max_per_row(distinct_scores[inverse.ravel()], pair_counts)
+        )
 
     def cosine_similarity(self, source_column, target_column):
         if len(source_column) != len(target_column):
@@ -264,12 +280,53 @@ class SimilarStrings(BaseCompareFeature):
             target_column.str.join(' '),
         )
 
+        vectorizer = self._get_vectorizer()
+
+        # Transform each distinct string only once
+        codes, uniques = pd.factorize(
+            pd.concat(
+                [source_column.fillna(''), target_column.fillna('')],
+                ignore_index=True,
+            )
+        )
+        try:
+            vectors = vectorizer.transform(uniques)
+        except ValueError as ve:
+            LOGGER.warning(
+                'Failed transforming text into vectors, reason: %s. Text: %s',
+                ve,
+                uniques,
+            )
+            return pd.Series(np.nan)
+
+        def _metric_sparse_cosine(u, v):
+            a = np.sqrt(u.multiply(u).sum(axis=1))
+            b = np.sqrt(v.multiply(v).sum(axis=1))
+            ab = v.multiply(u).sum(axis=1)
+            cosine = np.divide(ab, np.multiply(a, b)).A1
+            return cosine
+
+        return _metric_sparse_cosine(
+            vectors[codes[: len(source_column)]], vectors[codes[len(source_column) :]]
+        )
+
+    def _get_vectorizer(self) -> HashingVectorizer:
+        # Vectorizers are stateless, so the same one is shared
+        # across chunks, features, training and classification:
+        # there is no vocabulary to fit, and the feature space is always the same
+        key = (self.analyzer, self.ngram_range)
+        if key in _vectorizers:
+            return _vectorizers[key]
+
+        # Raw term counts, as `CountVectorizer` would do
+        params = {'norm': None, 'alternate_sign': False}
+
         # No analyzer means input underwent `commons.text_utils.tokenize`
         if self.analyzer is None:
-            vectorizer = CountVectorizer(analyzer=str.split)
+            vectorizer = HashingVectorizer(analyzer=str.split, **params)
 
         elif self.analyzer == 'soweego':
-            vectorizer = CountVectorizer(analyzer=text_utils.tokenize)
+            vectorizer = HashingVectorizer(analyzer=text_utils.tokenize, **params)
 
         # scikit-learn built-ins
         # `char` and `char_wb` make CHARACTER n-grams, instead of WORD ones:
@@ -278,10 +335,11 @@ class SimilarStrings(BaseCompareFeature):
         # thus eventually padding with whitespaces. See
         # https://scikit-learn.org/stable/modules/feature_extraction.html#limitations-of-the-bag-of-words-representation
         elif self.analyzer in ('word', 'char', 'char_wb'):
-            vectorizer = CountVectorizer(
+            vectorizer = HashingVectorizer(
                 analyzer=self.analyzer,
                 strip_accents='unicode',
                 ngram_range=self.ngram_range,
+                **params,
             )
 
         else:
@@ -292,32 +350,16 @@ class SimilarStrings(BaseCompareFeature):
             LOGGER.critical(err_msg)
             raise ValueError(err_msg)
 
-        data = source_column.append(target_column).fillna('')
-        try:
-            vectors = vectorizer.fit_transform(data)
-        except ValueError as ve:
-            LOGGER.warning(
-                'Failed transforming text into vectors, reason: %s. Text: %s',
-                ve,
-                data,
-            )
-            return pd.Series(np.nan)
-
-        def _metric_sparse_cosine(u, v):
-            a = np.sqrt(u.multiply(u).sum(axis=1))
-            b = np.sqrt(v.multiply(v).sum(axis=1))
-            ab = v.multiply(u).sum(axis=1)
-            cosine = np.divide(ab, np.multiply(a, b)).A1
-            return cosine
+        _vectorizers[key] = vectorizer
 
-        return _metric_sparse_cosine(
-            vectors[: len(source_column)], vectors[len(source_column) :]
-        )
+        return vectorizer
 
 
 class SimilarDates(BaseCompareFeature):
     """Compare pairs of lists holding **dates**
     through match by maximum shared precision.
+
+    A pair where any list is null or empty gets *missing_value*.
     """
 
     name = 'similar_dates'
@@ -347,60 +389,44 @@ class SimilarDates(BaseCompareFeature):
         self.missing_value = missing_value
 
     def _compute_vectorized(self, source_column, target_column):
-        concatenated = pd.Series(list(zip(source_column, target_column)))
-
-        def check_date_equality(pair: Tuple[List[pd.Period], List[pd.Period]]):
-            if _pair_has_any_null(pair):
-                LOGGER.debug(
-                    "Can't compare dates, the pair contains null values: %s",
-                    pair,
-                )
-                return np.nan
-
-            source_list, target_list = pair
-            # Keep track of the best score
-            best = 0
-
-            for source, target in itertools.product(source_list, target_list):
-                # Get precision number for both dates
-                s_precision = constants.PD_PERIOD_PRECISIONS.index(source.freq.name)
-                t_precision = constants.PD_PERIOD_PRECISIONS.index(target.freq.name)
-
-                # Minimum pair precision = maximum shared precision
-                lowest_prec = min(s_precision, t_precision)
-                # Result for the current `source`
-                current_result = 0
-
-                # Loop through `pandas.Period` attributes that we can compare
-                # and the precision that stands for said attribute
-                for min_required_prec, d_attr in enumerate(
-                    ['year', 'month', 'day', 'hour', 'minute', 'second']
-                ):
-                    # If both `source` and `target` have a precision which allows the
-                    # current attribute to be compared then we do so. If the attribute
-                    # matches then we add 1 to `current_result`, if not then we break the loop.
-                    # We consider from lowest to highest precision. If a lowest
-                    # precision attribute (e.g., year) doesn't match then we say that
-                    # the dates don't match at all (we don't check if higher precision
-                    # attributes match)
-                    if lowest_prec >= min_required_prec and getattr(
-                        source, d_attr
-                    ) == getattr(target, d_attr):
-                        current_result += 1
-                    else:
-                        break
-
-                # We want a value between 0 and 1 for our score. 0 means no match at all and
-                # 1 stands for perfect match. We just divide `current_result` by `lowest_prec`
-                # so that we get the percentage of items that matches from the total number
-                # of items we compared (since we have variable date precision)
-                # we sum 1 to `lowest_prec` to account for the fact that the possible minimum
-                # common precision is 0 (the year)
-                best = max(best, (current_result / (lowest_prec + 1)))
+        (
+            source_values,
+            target_values,
+            source_index,
+            target_index,
+            pair_counts,
+        ) = _element_pairs(source_column, target_column)
+
+        # Extract the precision number and the comparable attributes
+        # only once per date
+        source_precisions, source_attributes = _date_components(source_values)
+        target_precisions, target_attributes = _date_components(target_values)
+
+        # Minimum pair precision = maximum shared precision
+        lowest_prec = np.minimum(
+            source_precisions[source_index], target_precisions[target_index]
+        )
 
-            return best
+        # Compare attributes from lowest to highest precision.
+        # An attribute counts only if both dates have a precision
+        # that allows the comparison, and if all lower precision
+        # attributes match. For instance, if the years don't match,
+        # then we say that the dates don't match at all
+        comparable = lowest_prec[:, None] >= np.arange(len(_DATE_ATTRIBUTES))
+        equal = source_attributes[source_index] == target_attributes[target_index]
+        matches = np.cumprod(comparable & equal, axis=1).sum(axis=1)
+
+        # We want a value between 0 and 1 for our score. 0 means no match at all and
+        # 1 stands for perfect match. We just divide the matches by `lowest_prec`
+        # so that we get the percentage of items that matches from the total number
+        # of items we compared (since we have variable date precision)
+        # we sum 1 to `lowest_prec` to account for the fact that the possible minimum
+        # common precision is 0 (the year)
+        scores = matches / (lowest_prec + 1)
 
-        return fillna(concatenated.apply(check_date_equality), self.missing_value)
+        return fillna(
+            pd.Series(_max_per_row(scores, pair_counts)), self.missing_value
+        )
 
 
 class SharedTokens(BaseCompareFeature):
@@ -433,41 +459,31 @@ class SharedTokens(BaseCompareFeature):
         self.missing_value = missing_value
 
     def _compute_vectorized(self, source_column, target_column):
-        concatenated = pd.Series(list(zip(source_column, target_column)))
-
-        def intersection_percentage_size(pair):
-            if _pair_has_any_null(pair):
-                LOGGER.debug(
-                    "Can't compare tokens, the pair contains null values: %s",
-                    pair,
-                )
-                return np.nan
+        # Target values may hold space-separated tokens
+        def split(values):
+            return {token for value in values if value for token in value.split()}
 
-            source_list, target_list = pair
-            source_set, target_set = set(source_list), set()
-
-            for value in target_list:
-                if value:
-                    target_set.update(filter(None, value.split()))
-
-            intersection = source_set.intersection(target_set)
-            count_intersect = len(intersection)
-            count_total = len(source_set.union(target_set))
+        valid, source_size, target_size, shared, shared_tokens = _shared_items(
+            source_column, target_column, set, split
+        )
+        union_size = source_size + target_size - shared
 
-            # Penalize band stopwords
-            count_low_score_words = len(
-                text_utils.BAND_NAME_LOW_SCORE_WORDS.intersection(intersection)
-            )
+        # Penalize band stopwords
+        low_score_words = np.isin(
+            shared_tokens[1],
+            np.array(list(text_utils.BAND_NAME_LOW_SCORE_WORDS), dtype=object),
+        )
+        low_score_count = np.bincount(
+            shared_tokens[0][low_score_words], minlength=len(valid)
+        )
 
-            return (
-                (count_intersect - (count_low_score_words * 0.9)) / count_total
-                if count_total > 0
-                else np.nan
-            )
+        scores = np.full(len(valid), np.nan)
+        has_tokens = valid & (union_size > 0)
+        scores[has_tokens] = (
+            shared[has_tokens] - low_score_count[has_tokens] * 0.9
+        ) / union_size[has_tokens]
 
-        return fillna(
-            concatenated.apply(intersection_percentage_size), self.missing_value
-        )
+        return fillna(pd.Series(scores), self.missing_value)
 
 
 class SharedOccupations(BaseCompareFeature):
@@ -487,6 +503,7 @@ class SharedOccupations(BaseCompareFeature):
         right_on: str,
         missing_value: float = 0.0,
         label: str = None,
+        hierarchy_path: str = None,
     ):
         """
         :param left_on: a Wikidata :class:`DataFrame <pandas.DataFrame>`
@@ -496,12 +513,17 @@ class SharedOccupations(BaseCompareFeature):
         :param missing_value: (optional) a score to fill null values
         :param label: (optional) a label for the output feature
           :class:`Series <pandas.Series>`
+        :param hierarchy_path: (optional) a class hierarchy store path,
+          see :mod:`soweego.wikidata.class_hierarchy`.
+          If given, occupations are expanded offline.
+          Otherwise, SPARQL queries are fired
         """
         super(SharedOccupations, self).__init__(left_on, right_on, label=label)
 
         global _global_occupations_qid_cache
 
         self.missing_value = missing_value
+        self.hierarchy_path = hierarchy_path
         self._expand_occupations_cache = _global_occupations_qid_cache
 
     # This should be applied to a `pandas.Series`, where each element
@@ -510,8 +532,28 @@ class SharedOccupations(BaseCompareFeature):
     # subclasses of each QID in the original set.
     def _expand_occupations(self, occupation_qids: Set[str]) -> Set[str]:
         expanded_set = set()
+        hierarchy = (
+            None
+            if self.hierarchy_path is None
+            else class_hierarchy.load(self.hierarchy_path)
+        )
 
         for qid in occupation_qids:
+            # Offline expansion through the class hierarchy store,
+            # memory-mapped and shared across parallel processes
+            if hierarchy is not None:
+                if qid in hierarchy:
+                    expanded_set |= hierarchy.closure(qid)
+                    continue
+
+                # Only classes in the occupation subtree
+                # have a complete closure in the store
+                LOGGER.debug(
+                    '%s is not in the occupations class hierarchy, '
+                    'will expand it through SPARQL',
+                    qid,
+                )
+
             expanded_set.add(qid)
 
             # Check if we have the subclasses and superclasses
@@ -538,31 +580,19 @@ class SharedOccupations(BaseCompareFeature):
         return expanded_set
 
     def _compute_vectorized(self, source_column: pd.Series, target_column: pd.Series):
-
-        # add the superclasses and subclasses of each occupation to
-        # the target column
-        target_column = target_column.apply(self._expand_occupations)
-
-        concatenated = pd.Series(list(zip(source_column, target_column)))
-
-        # Given 2 sets, return the percentage of items that the
+        # Add the superclasses and subclasses of each occupation
+        # to the target side.
+        # Then, given 2 sets, compute the percentage of items that the
         # smaller set shares with the larger set
-        def check_occupation_equality(pair: Tuple[Set[str], Set[str]]):
-            if _pair_has_any_null(pair):
-                LOGGER.debug(
-                    "Can't compare occupations, " "the pair contains null values: %s",
-                    pair,
-                )
-                return np.nan
-
-            s_item, t_item = pair
-
-            min_length = min(len(s_item), len(t_item))
-            n_shared_items = len(s_item & t_item)
+        valid, source_size, target_size, shared, _ = _shared_items(
+            source_column, target_column, set, self._expand_occupations
+        )
+        min_length = np.minimum(source_size, target_size)
 
-            return n_shared_items / min_length
+        scores = np.full(len(valid), np.nan)
+        scores[valid] = shared[valid] / min_length[valid]
 
-        return fillna(concatenated.apply(check_occupation_equality), self.missing_value)
+        return fillna(pd.Series(scores), self.missing_value)
 
 
 class SharedTokensPlus(BaseCompareFeature):
@@ -608,74 +638,221 @@ class SharedTokensPlus(BaseCompareFeature):
         self.missing_value = missing_value
         self.stop_words = stop_words
 
-    @staticmethod
-    def _flatten(list_to_flatten: List) -> List:
-        to_process = [list_to_flatten]
-        result = []
+    def _compute_vectorized(
+        self, source_column: pd.Series, target_column: pd.Series
+    ) -> pd.Series:
+        # Make all lowercase, split on possible spaces,
+        # flatten, and filter stop words
+        def clean(values):
+            tokens = {token for value in values for token in value.lower().split()}
+            if self.stop_words:
+                tokens -= self.stop_words
+            return tokens
 
-        while len(to_process) != 0:
-            current = to_process.pop()
+        valid, source_size, target_size, shared, _ = _shared_items(
+            source_column, target_column, clean, clean
+        )
+        min_length = np.minimum(source_size, target_size)
 
-            for child in current:
-                if isinstance(child, List):
-                    to_process.append(child)
-                else:
-                    result.append(child)
+        # Prevent division by 0
+        scores = np.full(len(valid), np.nan)
+        has_tokens = valid & (min_length > 0)
+        scores[has_tokens] = shared[has_tokens] / min_length[has_tokens]
 
-        return result
+        return fillna(pd.Series(scores), self.missing_value)
 
-    def _compute_vectorized(
-        self, source_column: pd.Series, target_column: pd.Series
-    ) -> pd.Series:
 
-        # concatenate columns for easier processing. Here each element in
-        # the columns is a set of tokens
-        concatenated = pd.Series(list(zip(source_column, target_column)))
+def _pair_has_any_null(pair):
+    return _is_null(pair[0]) or _is_null(pair[1])
 
-        # Compute shared tokens after filtering stop words
-        def compare_apply(pair: Tuple[List[str], List[str]]) -> float:
-            if _pair_has_any_null(pair):
-                LOGGER.debug("Can't compare, the pair contains null values: %s", pair)
-                return np.nan
 
-            # first we clean a bit the pair
-            # make all lowercase and split on possible spaces
-            # also reshape result into a list (flatten)
-            pair = [self._flatten([el.lower().split() for el in p]) for p in pair]
+def _is_null(value):
+    if not value:
+        return True
 
-            s_item, t_item = pair
+    is_null = pd.isna(value)
+    if isinstance(is_null, np.ndarray):
+        is_null = is_null.all()
 
-            # finally convert to sets
-            s_item = set(s_item)
-            t_item = set(t_item)
+    return bool(is_null)
 
-            if self.stop_words:
-                s_item -= self.stop_words
-                t_item -= self.stop_words
 
-            min_length = min(len(s_item), len(t_item))
-            n_shared_items = len(s_item & t_item)
+# Batched feature kernels.
+# Input columns hold one value per (QID, target ID) pair, but
+# the same Wikidata or target record appears in many pairs.
+# Hence, values are prepared and flattened only once per record:
+# Wikidata records are the first level of the pairs index,
+# target records the second one.
+# Pairs then just combine flat arrays in bulk,
+# instead of applying a Python function to each pair of lists
 
-            # Prevent division by 0
-            if min_length != 0:
-                return n_shared_items / min_length
-            else:
-                return np.nan
+_DATE_ATTRIBUTES = ('year', 'month', 'day', 'hour', 'minute', 'second')
 
-        return fillna(concatenated.apply(compare_apply), self.missing_value)
 
+def _record_codes(column: pd.Series, level: int) -> np.ndarray:
+    if isinstance(column.index, pd.MultiIndex):
+        codes, _ = pd.factorize(column.index.get_level_values(level))
+        return codes
 
-def _pair_has_any_null(pair):
-    if not all(pair):
-        return True
+    # No pairs index: each row is a distinct record
+    return np.arange(len(column))
 
-    source_is_null, target_is_null = pd.isna(pair[0]), pd.isna(pair[1])
-    if isinstance(source_is_null, np.ndarray):
-        source_is_null = source_is_null.all()
-    if isinstance(target_is_null, np.ndarray):
-        target_is_null = target_is_null.all()
 
-    if source_is_null or target_is_null:
-        return True
+def _flatten_records(
+    column: pd.Series, level: int, prepare: Callable = None
+) -> Tuple[list, np.ndarray, np.ndarray, np.ndarray]:
+    # Concatenate prepared values of each distinct record into one list.
+    # Return it, plus offsets, lengths, and non-null flags for each pair
+    codes = _record_codes(column, level)
+    _, first_rows = np.unique(codes, return_index=True)
+
+    values = []
+    lengths = np.zeros(len(first_rows), dtype=np.int64)
+    not_null = np.zeros(len(first_rows), dtype=bool)
+
+    for record, row in enumerate(first_rows):
+        cell = column.iat[row]
+        if _is_null(cell):
+            continue
+
+        if prepare is not None:
+            cell = prepare(cell)
+
+        values.extend(cell)
+        lengths[record] = len(cell)
+        not_null[record] = True
+
+    return values, _offsets(lengths)[codes], lengths[codes], not_null[codes]
+
+
+def _offsets(lengths: np.ndarray) -> np.ndarray:
+    return np.cumsum(lengths) - lengths
+
+
+def _gather(offsets: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Flat value indices of each pair, plus the pair they belong to
+    pairs = np.repeat(np.arange(len(lengths)), lengths)
+    indices = np.repeat(offsets - _offsets(lengths), lengths) + np.arange(
+        lengths.sum()
+    )
+
+    return indices, pairs
+
+
+def _element_pairs(
+    source_column: pd.Series, target_column: pd.Series
+) -> Tuple[list, list, np.ndarray, np.ndarray, np.ndarray]:
+    # Flat values of both sides, plus indices of all (source, target)
+    # element pairs, in the same order as `itertools.product`.
+    # Also return the amount of element pairs, 0 when any side is null
+    (
+        source_values,
+        source_offsets,
+        source_lengths,
+        source_not_null,
+    ) = _flatten_records(source_column, 0)
+    (
+        target_values,
+        target_offsets,
+        target_lengths,
+        target_not_null,
+    ) = _flatten_records(target_column, 1)
+
+    valid = source_not_null & target_not_null
+    source_lengths, target_lengths = source_lengths * valid, target_lengths * valid
+
+    pair_counts = source_lengths * target_lengths
+    within_pair = np.arange(pair_counts.sum()) - np.repeat(
+        _offsets(pair_counts), pair_counts
+    )
+    pair_target_lengths = np.repeat(target_lengths, pair_counts)
+
+    source_index = (
+        np.repeat(source_offsets, pair_counts) + within_pair // pair_target_lengths
+    )
+    target_index = (
+        np.repeat(target_offsets, pair_counts) + within_pair % pair_target_lengths
+    )
+
+    return source_values, target_values, source_index, target_index, pair_counts
+
+
+def _max_per_row(scores: np.ndarray, pair_counts: np.ndarray) -> np.ndarray:
+    # Rows without element pairs get NaN.
+    # Unlike the built-in `max`, `np.maximum` propagates NaN:
+    # a row with any NaN score gets NaN
+    result = np.full(len(pair_counts), np.nan)
+    has_pairs = pair_counts > 0
+
+    if has_pairs.any():
+        result[has_pairs] = np.maximum.reduceat(
+            scores, _offsets(pair_counts)[has_pairs]
+        )
+
+    return result
+
+
+def _shared_items(
+    source_column: pd.Series,
+    target_column: pd.Series,
+    prepare_source: Callable[[Iterable], Set],
+    prepare_target: Callable[[Iterable], Set],
+) -> Tuple[
+    np.ndarray, np.ndarray, np.ndarray, np.ndarray, Tuple[np.ndarray, np.ndarray]
+]:
+    # Turn values of each record into a set, then compute set sizes
+    # and intersection size for each pair.
+    # Also return the shared (pair, item) couples.
+    # Items are encoded as integers, then each (pair, item) couple
+    # as a unique key, so that pair sets become arrays of keys
+    (
+        source_items,
+        source_offsets,
+        source_lengths,
+        source_not_null,
+    ) = _flatten_records(source_column, 0, lambda values: set(prepare_source(values)))
+    (
+        target_items,
+        target_offsets,
+        target_lengths,
+        target_not_null,
+    ) = _flatten_records(target_column, 1, lambda values: set(prepare_target(values)))
+
+    valid = source_not_null & target_not_null
+    source_lengths, target_lengths = source_lengths * valid, target_lengths * valid
+
+    codes, uniques = pd.factorize(np.array(source_items + target_items, dtype=object))
+    base = len(uniques) + 1
+    # Shift codes by 1, so that null items get 0
+    codes += 1
+
+    source_indices, source_pairs = _gather(source_offsets, source_lengths)
+    target_indices, target_pairs = _gather(target_offsets, target_lengths)
+    source_keys = source_pairs * base + codes[: len(source_items)][source_indices]
+    target_keys = target_pairs * base + codes[len(source_items) :][target_indices]
+    shared_keys = np.intersect1d(source_keys, target_keys, assume_unique=True)
+
+    shared_pairs, shared_codes = np.divmod(shared_keys, base)
+    shared_items = np.array([None, *uniques], dtype=object)[shared_codes]
+
+    return (
+        valid,
+        source_lengths,
+        target_lengths,
+        np.bincount(shared_pairs, minlength=len(valid)),
+        (shared_pairs, shared_items),
+    )
+
+
+def _date_components(dates: list) -> Tuple[np.ndarray, np.ndarray]:
+    # Precision number and comparable attributes of `pandas.Period` dates
+    precisions = np.array(
+        [constants.PD_PERIOD_PRECISIONS.index(date.freq.name) for date in dates],
+        dtype=np.int64,
+    )
+    attributes = np.array(
+        [[getattr(date, attribute) for attribute in _DATE_ATTRIBUTES] for date in dates],
+        dtype=np.int64,
+    ).reshape(len(dates), len(_DATE_ATTRIBUTES))
 
-    return False
+    return precisions, attributes
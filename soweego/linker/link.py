@@ -13,7 +13,7 @@ import logging
 import os
 import sys
 from re import search
-from typing import Iterator, Tuple
+from typing import Dict, Iterator, Tuple
 
 import click
 import joblib
@@ -24,7 +24,8 @@ from numpy import full, nan
 
 from soweego.commons import constants, keys, target_database
 from soweego.ingester import wikidata_bot
-from soweego.linker import blocking, classifiers, workflow
+from soweego.linker import classifiers, workflow
+from soweego.wikidata import entity_cache, sparql_cache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -52,6 +53,45 @@ LOGGER = logging.getLogger(__name__)
     is_flag=True,
     help='Perform all edits on the Wikidata sandbox item Q4115189.',
 )
+@click.option(
+    '-b',
+    '--blocking-engine',
+    type=click.Choice(constants.BLOCKING_ENGINES),
+    default=keys.FULLTEXT,
+    help=f'Blocking engine to find samples, default: {keys.FULLTEXT}.',
+)
+@click.option(
+    '-w',
+    '--wd-format',
+    type=click.Choice(constants.WD_SET_FORMATS),
+    default=keys.JSONL,
+    help=f'Storage format of the Wikidata set, default: {keys.JSONL}.',
+)
+@click.option(
+    '-j',
+    '--wd-dump',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='Wikidata JSON dump to read items from, instead of the Web API.',
+)
+@click.option(
+    '--blocking-workers',
+    type=click.IntRange(min=1),
+    default=constants.PIPELINE_WORKERS['blocking'],
+    help=f"Worker threads for blocking, default: {constants.PIPELINE_WORKERS['blocking']}.",
+)
+@click.option(
+    '--target-workers',
+    type=click.IntRange(min=1),
+    default=constants.PIPELINE_WORKERS['target'],
+    help=f"Worker threads for building target datasets, default: {constants.PIPELINE_WORKERS['target']}.",
+)
+@click.option(
+    '--features-workers',
+    type=click.IntRange(min=1),
+    default=constants.PIPELINE_WORKERS['features'],
+    help=f"Worker threads for feature extraction, default: {constants.PIPELINE_WORKERS['features']}.",
+)
 @click.option(
     '-d',
     '--dir-io',
@@ -59,7 +99,22 @@ LOGGER = logging.getLogger(__name__)
     default=constants.WORK_DIR,
     help=f'Input/output directory, default: {constants.WORK_DIR}.',
 )
-def cli(classifier, catalog, entity, threshold, name_rule, upload, sandbox, dir_io):
+def cli(
+    classifier,
+    catalog,
+    entity,
+    threshold,
+    name_rule,
+    upload,
+    sandbox,
+    blocking_engine,
+    wd_format,
+    wd_dump,
+    blocking_workers,
+    target_workers,
+    features_workers,
+    dir_io,
+):
     """Run a supervised linker.
 
     Build the classification set relevant to the given catalog and entity,
@@ -74,6 +129,9 @@ def cli(classifier, catalog, entity, threshold, name_rule, upload, sandbox, dir_
 
     $ python -m soweego linker train
     """
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     actual_classifier = constants.CLASSIFIERS[classifier]
 
     model_path, result_path = _handle_io(actual_classifier, catalog, entity, dir_io)
@@ -84,7 +142,22 @@ def cli(classifier, catalog, entity, threshold, name_rule, upload, sandbox, dir_
     rl.set_option(*constants.CLASSIFICATION_RETURN_SERIES)
 
     for i, chunk in enumerate(
-        execute(model_path, catalog, entity, threshold, name_rule, dir_io)
+        execute(
+            model_path,
+            catalog,
+            entity,
+            threshold,
+            name_rule,
+            dir_io,
+            blocking_engine=blocking_engine,
+            wd_format=wd_format,
+            wd_dump=wd_dump,
+            workers={
+                'blocking': blocking_workers,
+                'target': target_workers,
+                'features': features_workers,
+            },
+        )
     ):
         chunk.to_csv(result_path, mode='a', header=False)
 
@@ -112,6 +185,10 @@ def execute(
     threshold: float,
     name_rule: bool,
     dir_io: str,
+    blocking_engine: str = keys.FULLTEXT,
+    wd_format: str = keys.JSONL,
+    wd_dump: str = None,
+    workers: Dict[str, int] = None,
 ) -> Iterator[pd.Series]:
     """Run a supervised linker.
 
@@ -132,6 +209,17 @@ def execute(
       are discarded after classification
     :param dir_io: input/output directory where working files
       will be read/written
+    :param blocking_engine: ``{'fulltext', 'batch', 'index'}``.
+      A blocking engine, see
+      :func:`find_samples() <soweego.linker.blocking.find_samples>`
+    :param wd_format: ``{'jsonl', 'parquet'}``.
+      A storage format for the Wikidata set, see
+      :func:`build_wikidata() <soweego.linker.workflow.build_wikidata>`
+    :param wd_dump: (optional) path to a Wikidata JSON dump.
+      If given, Wikidata items are read from it instead of the Web API
+    :param workers: (optional) a ``{stage: worker threads}`` dict
+      for the chunk processing pipeline, see
+      :func:`process_chunks() <soweego.linker.workflow.process_chunks>`
     :return: the generator yielding chunks of links
     """
     classifier = joblib.load(model_path)
@@ -140,7 +228,9 @@ def execute(
         wd_chunk,
         target_chunk,
         feature_vectors,
-    ) in _classification_set_generator(catalog, entity, dir_io):
+    ) in _classification_set_generator(
+        catalog, entity, dir_io, blocking_engine, wd_format, wd_dump, workers
+    ):
         # The classification set must have the same feature space
         # as the training one
         _add_missing_feature_columns(classifier, feature_vectors)
@@ -160,41 +250,33 @@ def execute(
 
 
 def _classification_set_generator(
-    catalog, entity, dir_io
+    catalog,
+    entity,
+    dir_io,
+    blocking_engine=keys.FULLTEXT,
+    wd_format=keys.JSONL,
+    wd_dump=None,
+    workers=None,
 ) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]]:
     goal = 'classification'
 
     # Wikidata side
-    wd_reader = workflow.build_wikidata(goal, catalog, entity, dir_io)
+    wd_reader = workflow.build_wikidata(
+        goal, catalog, entity, dir_io, wd_format, wd_dump
+    )
     wd_generator = workflow.preprocess_wikidata(goal, wd_reader)
 
-    for i, wd_chunk in enumerate(wd_generator, 1):
-        # Collect samples via queries to the target DB
-        samples = blocking.find_samples(
-            goal,
-            catalog,
-            wd_chunk[keys.NAME_TOKENS],
-            i,
-            target_database.get_main_entity(catalog, entity),
-            dir_io,
-        )
-
-        # Build target chunk from samples
-        target_reader = workflow.build_target(
-            goal, catalog, entity, set(samples.get_level_values(keys.TID))
-        )
-
-        # Preprocess target chunk
-        target_chunk = workflow.preprocess_target(goal, target_reader)
-
-        # Extract features
-        features_path = os.path.join(
-            dir_io, constants.FEATURES.format(catalog, entity, goal, i)
-        )
-        feature_vectors = workflow.extract_features(
-            samples, wd_chunk, target_chunk, features_path
-        )
-
+    # Blocking, target side, and feature extraction run as a pipeline,
+    # so they overlap with classification of the previous chunk
+    for i, wd_chunk, _, target_chunk, feature_vectors in workflow.process_chunks(
+        goal,
+        catalog,
+        entity,
+        wd_generator,
+        dir_io,
+        blocking_engine=blocking_engine,
+        workers=workers,
+    ):
         yield wd_chunk, target_chunk, feature_vectors
 
         LOGGER.info('Chunk %d classified', i)
@@ -22,7 +22,8 @@ from recordlinkage.base import BaseClassifier
 from sklearn.model_selection import GridSearchCV
 
 from soweego.commons import constants, keys, target_database, utils
-from soweego.linker import blocking, workflow
+from soweego.linker import workflow
+from soweego.wikidata import entity_cache, sparql_cache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -48,6 +49,45 @@ LOGGER = logging.getLogger(__name__)
     help="Number of folds for hyperparameters tuning. Use with '--tune'. "
     "Default: 5.",
 )
+@click.option(
+    '-b',
+    '--blocking-engine',
+    type=click.Choice(constants.BLOCKING_ENGINES),
+    default=keys.FULLTEXT,
+    help=f'Blocking engine to find samples, default: {keys.FULLTEXT}.',
+)
+@click.option(
+    '-w',
+    '--wd-format',
+    type=click.Choice(constants.WD_SET_FORMATS),
+    default=keys.JSONL,
+    help=f'Storage format of the Wikidata set, default: {keys.JSONL}.',
+)
+@click.option(
+    '-j',
+    '--wd-dump',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='Wikidata JSON dump to read items from, instead of the Web API.',
+)
+@click.option(
+    '--blocking-workers',
+    type=click.IntRange(min=1),
+    default=constants.PIPELINE_WORKERS['blocking'],
+    help=f"Worker threads for blocking, default: {constants.PIPELINE_WORKERS['blocking']}.",
+)
+@click.option(
+    '--target-workers',
+    type=click.IntRange(min=1),
+    default=constants.PIPELINE_WORKERS['target'],
+    help=f"Worker threads for building target datasets, default: {constants.PIPELINE_WORKERS['target']}.",
+)
+@click.option(
+    '--features-workers',
+    type=click.IntRange(min=1),
+    default=constants.PIPELINE_WORKERS['features'],
+    help=f"Worker threads for feature extraction, default: {constants.PIPELINE_WORKERS['features']}.",
+)
 @click.option(
     '-d',
     '--dir-io',
@@ -56,19 +96,52 @@ LOGGER = logging.getLogger(__name__)
     help=f'Input/output directory, default: {constants.WORK_DIR}.',
 )
 @click.pass_context
-def cli(ctx, classifier, catalog, entity, tune, k_folds, dir_io):
+def cli(
+    ctx,
+    classifier,
+    catalog,
+    entity,
+    tune,
+    k_folds,
+    blocking_engine,
+    wd_format,
+    wd_dump,
+    blocking_workers,
+    target_workers,
+    features_workers,
+    dir_io,
+):
     """Train a supervised linker.
 
     Build the training set relevant to the given catalog and entity,
     then train a model with the given classification algorithm.
     """
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     kwargs = utils.handle_extra_cli_args(ctx.args)
     if kwargs is None:
         sys.exit(1)
 
     actual_classifier = constants.CLASSIFIERS[classifier]
 
-    model = execute(actual_classifier, catalog, entity, tune, k_folds, dir_io, **kwargs)
+    model = execute(
+        actual_classifier,
+        catalog,
+        entity,
+        tune,
+        k_folds,
+        dir_io,
+        blocking_engine=blocking_engine,
+        wd_format=wd_format,
+        wd_dump=wd_dump,
+        workers={
+            'blocking': blocking_workers,
+            'target': target_workers,
+            'features': features_workers,
+        },
+        **kwargs,
+    )
 
     outfile = os.path.join(
         dir_io,
@@ -101,6 +174,10 @@ def execute(
     tune: bool,
     k: int,
     dir_io: str,
+    blocking_engine: str = keys.FULLTEXT,
+    wd_format: str = keys.JSONL,
+    wd_dump: str = None,
+    workers: Dict[str, int] = None,
     **kwargs,
 ) -> BaseClassifier:
     """Train a supervised linker.
@@ -122,13 +199,30 @@ def execute(
       It is used only when `tune=True`
     :param dir_io: input/output directory where working files
       will be read/written
+    :param blocking_engine: ``{'fulltext', 'batch', 'index'}``.
+      A blocking engine, see
+      :func:`find_samples() <soweego.linker.blocking.find_samples>`
+    :param wd_format: ``{'jsonl', 'parquet'}``.
+      A storage format for the Wikidata set, see
+      :func:`build_wikidata() <soweego.linker.workflow.build_wikidata>`
+    :param wd_dump: (optional) path to a Wikidata JSON dump.
+      If given, Wikidata items are read from it instead of the Web API
+    :param workers: (optional) a ``{stage: worker threads}`` dict
+      for the chunk processing pipeline, see
+      :func:`process_chunks() <soweego.linker.workflow.process_chunks>`
     :param kwargs: extra keyword arguments that will be passed to the model
         initialization
     :return: the trained model
     """
 
     feature_vectors, positive_samples_index = build_training_set(
-        catalog, entity, dir_io
+        catalog,
+        entity,
+        dir_io,
+        blocking_engine=blocking_engine,
+        wd_format=wd_format,
+        wd_dump=wd_dump,
+        workers=workers,
     )
 
     if tune:
@@ -148,7 +242,13 @@ def execute(
 
 
 def build_training_set(
-    catalog: str, entity: str, dir_io: str
+    catalog: str,
+    entity: str,
+    dir_io: str,
+    blocking_engine: str = keys.FULLTEXT,
+    wd_format: str = keys.JSONL,
+    wd_dump: str = None,
+    workers: Dict[str, int] = None,
 ) -> Tuple[pd.DataFrame, pd.MultiIndex]:
     """Build a training set.
 
@@ -159,6 +259,17 @@ def build_training_set(
       A supported entity
     :param dir_io: input/output directory where working files
       will be read/written
+    :param blocking_engine: ``{'fulltext', 'batch', 'index'}``.
+      A blocking engine, see
+      :func:`find_samples() <soweego.linker.blocking.find_samples>`
+    :param wd_format: ``{'jsonl', 'parquet'}``.
+      A storage format for the Wikidata set, see
+      :func:`build_wikidata() <soweego.linker.workflow.build_wikidata>`
+    :param wd_dump: (optional) path to a Wikidata JSON dump.
+      If given, Wikidata items are read from it instead of the Web API
+    :param workers: (optional) a ``{stage: worker threads}`` dict
+      for the chunk processing pipeline, see
+      :func:`process_chunks() <soweego.linker.workflow.process_chunks>`
     :return: the feature vectors and positive samples pair.
       Features are computed by comparing *(QID, catalog ID)* pairs.
       Positive samples are catalog IDs available in Wikidata
@@ -166,12 +277,25 @@ def build_training_set(
     goal = 'training'
 
     # Wikidata side
-    wd_reader = workflow.build_wikidata(goal, catalog, entity, dir_io)
+    wd_reader = workflow.build_wikidata(
+        goal, catalog, entity, dir_io, wd_format, wd_dump
+    )
     wd_generator = workflow.preprocess_wikidata(goal, wd_reader)
 
     positive_samples, feature_vectors = None, None
 
-    for i, wd_chunk in enumerate(wd_generator, 1):
+    # Blocking, target side, and feature extraction run as a pipeline.
+    # All samples come from queries to the target DB
+    # and include negative ones
+    for _, wd_chunk, _, _, chunk_fv in workflow.process_chunks(
+        goal,
+        catalog,
+        entity,
+        wd_generator,
+        dir_io,
+        blocking_engine=blocking_engine,
+        workers=workers,
+    ):
         # Positive samples come from Wikidata
         if positive_samples is None:
             positive_samples = wd_chunk[keys.TID]
@@ -184,33 +308,6 @@ def build_training_set(
             # is less memory-efficient
             positive_samples = pd.concat([positive_samples, wd_chunk[keys.TID]])
 
-        # All samples come from queries to the target DB
-        # and include negative ones
-        all_samples = blocking.find_samples(
-            goal,
-            catalog,
-            wd_chunk[keys.NAME_TOKENS],
-            i,
-            target_database.get_main_entity(catalog, entity),
-            dir_io,
-        )
-
-        # Build target chunk from all samples
-        target_reader = workflow.build_target(
-            goal, catalog, entity, set(all_samples.get_level_values(keys.TID))
-        )
-        # Preprocess target chunk
-        target_chunk = workflow.preprocess_target(goal, target_reader)
-
-        features_path = os.path.join(
-            dir_io, constants.FEATURES.format(catalog, entity, goal, i)
-        )
-
-        # Extract features from all samples
-        chunk_fv = workflow.extract_features(
-            all_samples, wd_chunk, target_chunk, features_path
-        )
-
         if feature_vectors is None:
             feature_vectors = chunk_fv
         else:
@@ -10,6 +10,8 @@ It is a pipeline composed of the following main steps:
 3. extract features by comparing pairs of Wikidata and target values
    (:func:`extract_features`)
 
+:func:`process_chunks` runs blocking and steps 1 to 3 on Wikidata chunks
+as a staged pipeline.
 """
 import datetime
 import gzip
@@ -17,22 +19,22 @@ import json
 import logging
 import os
 from multiprocessing import cpu_count
-from typing import Iterator, Set
+from typing import Dict, Iterator, Set, Tuple
 
 import pandas as pd
 import recordlinkage as rl
 from numpy import nan
 from pandas import read_sql
-from pandas.io.json._json import JsonReader
 from sqlalchemy.orm import Query
 
 from soweego.commons import (
-    constants, data_gathering, keys, target_database, text_utils, url_utils, utils
+    constants, data_gathering, keys, pipelining, target_database, text_utils,
+    url_utils, utils
 )
 from soweego.commons.db_manager import DBManager
 from soweego.commons.logging import log_dataframe_info
-from soweego.linker import features
-from soweego.wikidata import api_requests, vocabulary
+from soweego.linker import blocking, cache, columnar, features
+from soweego.wikidata import api_requests, class_hierarchy, json_dump, vocabulary
 
 __author__ = 'Marco Fossati'
 __email__ = 'fossati@spaziodati.eu'
@@ -43,13 +45,21 @@ __copyright__ = 'Copyleft 2018, Hjfocs'
 LOGGER = logging.getLogger(__name__)
 
 
-def build_wikidata(goal: str, catalog: str, entity: str, dir_io: str) -> JsonReader:
+def build_wikidata(
+    goal: str,
+    catalog: str,
+    entity: str,
+    dir_io: str,
+    wd_format: str = keys.JSONL,
+    wd_dump: str = None,
+) -> Iterator[pd.DataFrame]:
     """Build a Wikidata dataset for training or classification purposes:
     workflow step 1.
 
     Data is gathered from the
     `SPARQL endpoint <https://query.wikidata.org/>`_ and the
-    `Web API <https://www.wikidata.org/w/api.php>`_.
+    `Web API <https://www.wikidata.org/w/api.php>`_,
+    or a local Wikidata JSON dump, see :mod:`soweego.wikidata.json_dump`.
 
     **How it works:**
 
@@ -57,7 +67,10 @@ def build_wikidata(goal: str, catalog: str, entity: str, dir_io: str) -> JsonRea
        or *lack* (for *classification*) identifiers of the given catalog
     2. gather relevant item data
     3. dump the dataset to a gzipped `JSON Lines <http://jsonlines.org/>`_ file
-    4. read the dataset into a generator of :class:`pandas.DataFrame` chunks
+    4. *(Parquet format)* convert the dataset to a
+       `Parquet <https://parquet.apache.org/>`_ file,
+       see :mod:`soweego.linker.columnar`
+    5. read the dataset into a generator of :class:`pandas.DataFrame` chunks
        for memory-efficient processing
 
     :param goal: ``{'training', 'classification'}``.
@@ -69,12 +82,27 @@ def build_wikidata(goal: str, catalog: str, entity: str, dir_io: str) -> JsonRea
       A supported entity
     :param dir_io: input/output directory where working files
       will be read/written
+    :param wd_format: (optional) ``{'jsonl', 'parquet'}``.
+      A storage format for the dataset
+    :param wd_dump: (optional) path to a Wikidata JSON dump.
+      If given, item data is read from it instead of the Web API
     :return: the generator yielding :class:`pandas.DataFrame` chunks
     """
+    _check_wd_format_value(wd_format)
     qids_and_tids, wd_io_path = _handle_goal(goal, catalog, entity, dir_io)
     catalog_pid = target_database.get_catalog_pid(catalog, entity)
+    wd_parquet_path = columnar.parquet_path(wd_io_path)
+    use_parquet = wd_format == keys.PARQUET
+
+    # Cached Parquet dataset: no need to parse JSON
+    if use_parquet and not columnar.is_stale(wd_io_path):
+        LOGGER.info(
+            "Will reuse existing Wikidata %s set: '%s'", goal, wd_parquet_path
+        )
+        if goal == 'training':
+            qids_and_tids.update(columnar.read_qids_and_tids(wd_parquet_path))
 
-    if not os.path.isfile(wd_io_path):
+    elif not os.path.isfile(wd_io_path):
         LOGGER.info(
             "Building Wikidata %s set for %s %s, output file '%s' ...",
             goal,
@@ -102,22 +130,47 @@ def build_wikidata(goal: str, catalog: str, entity: str, dir_io: str) -> JsonRea
         url_pids, ext_id_pids_to_urls = data_gathering.gather_relevant_pids()
 
         with gzip.open(wd_io_path, 'wt') as wd_io:
-            api_requests.get_data_for_linker(
-                catalog,
-                entity,
-                qids,
-                url_pids,
-                ext_id_pids_to_urls,
-                qids_and_tids,
-                wd_io,
-            )
+            if wd_dump is None:
+                api_requests.get_data_for_linker(
+                    catalog,
+                    entity,
+                    qids,
+                    url_pids,
+                    ext_id_pids_to_urls,
+                    qids_and_tids,
+                    wd_io,
+                )
+            else:
+                json_dump.get_data_for_linker(
+                    wd_dump,
+                    catalog,
+                    entity,
+                    qids,
+                    url_pids,
+                    ext_id_pids_to_urls,
+                    qids_and_tids,
+                    wd_io,
+                    os.path.join(
+                        dir_io, constants.WD_DUMP_SUBSET.format(catalog, entity, goal)
+                    ),
+                )
 
     # Cached dataset, for development purposes
     else:
         LOGGER.info("Will reuse existing Wikidata %s set: '%s'", goal, wd_io_path)
-        if goal == 'training':
+        if goal == 'training' and not use_parquet:
             _reconstruct_qids_and_tids(wd_io_path, qids_and_tids)
 
+    if use_parquet:
+        if columnar.is_stale(wd_io_path):
+            columnar.convert(wd_io_path)
+            if goal == 'training':
+                qids_and_tids.update(columnar.read_qids_and_tids(wd_parquet_path))
+
+        LOGGER.info('Wikidata %s set built', goal)
+
+        return columnar.read(wd_parquet_path)
+
     LOGGER.info('Wikidata %s set built', goal)
 
     return pd.read_json(wd_io_path, lines=True, chunksize=1000)
@@ -168,7 +221,13 @@ def build_target(
     for table in tables:
         query = query.outerjoin(table, base.catalog_id == table.catalog_id)
     # Condition
-    query = query.filter(base.catalog_id.in_(identifiers)).enable_eagerloads(False)
+    # Order by catalog ID, so that denormalized rows of the same target
+    # come together: `preprocess_target` aggregates them in a streaming fashion
+    query = (
+        query.filter(base.catalog_id.in_(identifiers))
+        .order_by(base.catalog_id)
+        .enable_eagerloads(False)
+    )
 
     sql = query.statement
     LOGGER.debug('SQL query to be fired: %s', sql)
@@ -180,7 +239,7 @@ def build_target(
 
 
 def preprocess_wikidata(
-    goal: str, wikidata_reader: JsonReader
+    goal: str, wikidata_reader: Iterator[pd.DataFrame]
 ) -> Iterator[pd.DataFrame]:
     """Preprocess a Wikidata dataset: workflow step 2.
 
@@ -266,7 +325,7 @@ def preprocess_target(goal: str, target_reader: Iterator[pd.DataFrame]) -> pd.Da
     3. drop columns with null values only
     4. pair dates with their precision and drop precision columns
        when applicable
-    5. aggregate denormalized data on target ID
+    5. aggregate denormalized data on target ID, one chunk at a time
     6. *(shared with* :func:`preprocess_wikidata` *)*
        normalize columns with names, occupations, dates, when applicable
 
@@ -281,33 +340,61 @@ def preprocess_target(goal: str, target_reader: Iterator[pd.DataFrame]) -> pd.Da
 
     LOGGER.info('Preprocessing target ...')
 
-    # Target data is denormalized, so we must consume the input generator
-    # to perform consistent aggregations later
-    target = pd.concat([chunk for chunk in target_reader], sort=False)
+    # Target data is denormalized, i.e., one target ID may span
+    # several rows. `build_target` sorts them by target ID,
+    # so we can aggregate each chunk as soon as it comes,
+    # and only carry over the rows of the last target ID to the next one
+    aggregated, carry_over, non_null = [], None, None
+    for chunk in target_reader:
+        # 1. Drop target DB internal ID columns
+        chunk.drop(columns=keys.INTERNAL_ID, inplace=True)
 
-    # 1. Drop target DB internal ID columns
-    LOGGER.info("Dropping '%s' columns ...", keys.INTERNAL_ID)
-    target.drop(columns=keys.INTERNAL_ID, inplace=True)
-    log_dataframe_info(LOGGER, target, f"Dropped '{keys.INTERNAL_ID}'' columns")
+        # 2. Rename non-null catalog ID column & drop others
+        _rename_or_drop_tid_columns(chunk)
 
-    # 2. Rename non-null catalog ID column & drop others
-    _rename_or_drop_tid_columns(target)
+        # Keep track of columns with non-null values,
+        # before dates get paired into tuples
+        chunk_non_null = chunk.notna().any()
+        non_null = chunk_non_null if non_null is None else non_null | chunk_non_null
 
-    # 3. Drop columns with null values only
-    LOGGER.info('Dropping columns with null values only ...')
-    _drop_null_columns(target)
+        # 4. Pair dates with their precision & drop precision columns
+        _pair_dates(chunk)
+
+        if carry_over is not None:
+            chunk = pd.concat([carry_over, chunk], sort=False)
+
+        last_tid = chunk[keys.TID].values == chunk[keys.TID].iat[-1]
+        carry_over = chunk[last_tid]
+
+        # 5. Aggregate denormalized data on target ID
+        complete = chunk[~last_tid]
+        if not complete.empty:
+            aggregated.append(_aggregate_on_tid(complete))
 
-    # 4. Pair dates with their precision & drop precision columns
-    _pair_dates(target)
+    if carry_over is not None:
+        aggregated.append(_aggregate_on_tid(carry_over))
+
+    target = pd.concat(aggregated, sort=False)
+    target.index.name = keys.TID
+
+    # Input not sorted by target ID: merge rows spanning different chunks
+    if target.index.has_duplicates:
+        LOGGER.warning(
+            "Target data is not sorted by '%s': merging duplicate rows ...",
+            keys.TID,
+        )
+        target = target.groupby(level=0).agg(_merge_lists)
 
-    # 5. Aggregate denormalized data on target ID
-    # TODO Token lists may contain duplicate tokens
-    LOGGER.info("Aggregating denormalized data on '%s' column ...", keys.TID)
-    target = target.groupby(keys.TID).agg(lambda x: list(set(x)))
     log_dataframe_info(
         LOGGER, target, f"Data indexed and aggregated on '{keys.TID}' column"
     )
 
+    # 3. Drop columns with null values only
+    LOGGER.info('Dropping columns with null values only ...')
+    null_columns = non_null.index[~non_null].intersection(target.columns)
+    target.drop(columns=null_columns, inplace=True)
+    log_dataframe_info(LOGGER, target, 'Dropped columns with null values only')
+
     # 6. Shared preprocessing
     target = _shared_preprocessing(
         target,
@@ -324,7 +411,8 @@ def extract_features(
     candidate_pairs: pd.MultiIndex,
     wikidata: pd.DataFrame,
     target: pd.DataFrame,
-    path_io: str,
+    dir_io: str = None,
+    import_timestamp: str = None,
 ) -> pd.DataFrame:
     """Extract feature vectors by comparing pairs of
     *(Wikidata, target catalog)* records.
@@ -351,16 +439,18 @@ def extract_features(
       that should undergo comparison
     :param wikidata: a preprocessed Wikidata dataset (typically a chunk)
     :param target: a preprocessed target catalog dataset (typically a chunk)
-    :param path_io: input/output path to an extracted feature file
+    :param dir_io: (optional) input/output directory where the
+      occupations class hierarchy and cached features are stored.
+      If not given, occupations are expanded through SPARQL queries,
+      and features are not cached
+    :param import_timestamp: (optional) the target catalog import timestamp,
+      as returned by
+      :func:`target_import_timestamp() <soweego.linker.cache.target_import_timestamp>`.
+      If not given, features are not cached
     :return: the feature vectors dataset
     """
     LOGGER.info('Extracting features ...')
 
-    # Early return cached features, for development purposes
-    if os.path.isfile(path_io):
-        LOGGER.info("Will reuse existing features: '%s'", path_io)
-        return pd.read_pickle(path_io)
-
     def in_both_datasets(col: str) -> bool:
         return (col in wikidata.columns) and (col in target.columns)
 
@@ -405,6 +495,7 @@ def extract_features(
                 occupations_column,
                 occupations_column,
                 label=f'{occupations_column}_shared',
+                hierarchy_path=_get_occupations_hierarchy(dir_io),
             )
         )
 
@@ -419,20 +510,148 @@ def extract_features(
             )
         )
 
+    # Cached features are keyed by the feature set and by all input data.
+    # Occupation expansions come from Wikidata, not from the inputs:
+    # they may lag behind it up to the class hierarchy cache TTL
+    cache_key = (
+        None
+        if dir_io is None or import_timestamp is None
+        else cache.make_key(
+            import_timestamp,
+            cache.feature_set_digest(feature_extractor),
+            cache.data_digest(candidate_pairs),
+            cache.data_digest(wikidata),
+            cache.data_digest(target),
+        )
+    )
+
+    # Early return cached features
+    feature_vectors = cache.load(cache.FEATURES, cache_key, dir_io)
+    if feature_vectors is not None:
+        return feature_vectors
+
     feature_vectors = feature_extractor.compute(candidate_pairs, wikidata, target)
     feature_vectors = feature_vectors[
         ~feature_vectors.index.duplicated()  # Drop duplicates
     ]
 
-    os.makedirs(os.path.dirname(path_io), exist_ok=True)
-    pd.to_pickle(feature_vectors, path_io)
-    LOGGER.info("Features dumped to '%s'", path_io)
+    features_path = cache.dump(feature_vectors, cache.FEATURES, cache_key, dir_io)
+    if features_path is not None:
+        LOGGER.info("Features dumped to '%s'", features_path)
 
     LOGGER.info('Feature extraction done')
 
     return feature_vectors
 
 
+def process_chunks(
+    goal: str,
+    catalog: str,
+    entity: str,
+    wikidata_generator: Iterator[pd.DataFrame],
+    dir_io: str,
+    blocking_engine: str = keys.FULLTEXT,
+    workers: Dict[str, int] = None,
+) -> Iterator[Tuple[int, pd.DataFrame, pd.MultiIndex, pd.DataFrame, pd.DataFrame]]:
+    """Find samples, build the target dataset, and extract features
+    for each preprocessed Wikidata chunk.
+
+    Stages run as a pipeline: while features of a chunk are extracted,
+    the target dataset of the next chunk is built, and blocking happens
+    on the chunk after. Stages are connected through bounded queues,
+    see :mod:`soweego.commons.pipelining`.
+
+    :param goal: ``{'training', 'classification'}``.
+      Whether to process a training or classification set
+    :param catalog: ``{'discogs', 'imdb', 'musicbrainz'}``.
+      A supported catalog
+    :param entity: ``{'actor', 'band', 'director', 'musician', 'producer',
+      'writer', 'audiovisual_work', 'musical_work'}``.
+      A supported entity
+    :param wikidata_generator: a generator of preprocessed Wikidata chunks,
+      as returned by :func:`preprocess_wikidata`
+    :param dir_io: input/output directory where working files
+      will be read/written
+    :param blocking_engine: (optional) ``{'fulltext', 'batch', 'index'}``.
+      A blocking engine, see
+      :func:`find_samples() <soweego.linker.blocking.find_samples>`
+    :param workers: (optional) a ``{stage: worker threads}`` dict,
+      where stage is one of ``{'blocking', 'target', 'features'}``.
+      Missing stages default to
+      :data:`PIPELINE_WORKERS <soweego.commons.constants.PIPELINE_WORKERS>`
+    :return: the generator yielding
+      *(chunk number, Wikidata chunk, samples, target chunk, features)*
+      tuples, in the same order as Wikidata chunks
+    """
+    utils.check_goal_value(goal)
+
+    workers = {**constants.PIPELINE_WORKERS, **(workers or {})}
+    target_db_entity = target_database.get_main_entity(catalog, entity)
+    # Cached features depend on the target catalog import
+    import_timestamp = cache.target_import_timestamp(catalog, entity)
+
+    def find_samples(chunk):
+        i, wd_chunk = chunk
+        samples = blocking.find_samples(
+            goal,
+            catalog,
+            wd_chunk[keys.NAME_TOKENS],
+            i,
+            target_db_entity,
+            dir_io,
+            engine=blocking_engine,
+        )
+        return i, wd_chunk, samples
+
+    def build_target_chunk(chunk):
+        i, wd_chunk, samples = chunk
+        target_reader = build_target(
+            goal, catalog, entity, set(samples.get_level_values(keys.TID))
+        )
+        return i, wd_chunk, samples, preprocess_target(goal, target_reader)
+
+    def extract_chunk_features(chunk):
+        i, wd_chunk, samples, target_chunk = chunk
+        feature_vectors = extract_features(
+            samples,
+            wd_chunk,
+            target_chunk,
+            dir_io=dir_io,
+            import_timestamp=import_timestamp,
+        )
+        return i, wd_chunk, samples, target_chunk, feature_vectors
+
+    yield from pipelining.run(
+        enumerate(wikidata_generator, 1),
+        (
+            (find_samples, workers['blocking']),
+            (build_target_chunk, workers['target']),
+            (extract_chunk_features, workers['features']),
+        ),
+    )
+
+    cache.log_stats()
+
+
+def _get_occupations_hierarchy(dir_io):
+    if dir_io is None:
+        return None
+
+    hierarchy_path = os.path.join(dir_io, constants.OCCUPATIONS_HIERARCHY)
+
+    # Later runs read the store from disk,
+    # until it expires like cached class hierarchy queries
+    if class_hierarchy.is_stale(
+        hierarchy_path, constants.SPARQL_CACHE_TTL['class_hierarchy']
+    ):
+        LOGGER.info('Building the occupations class hierarchy ...')
+        class_hierarchy.build(hierarchy_path)
+        # Don't serve a previously loaded store
+        class_hierarchy.load.cache_clear()
+
+    return hierarchy_path
+
+
 def _add_date_features(feature_extractor, in_both_datasets):
     birth_column, death_column = keys.DATE_OF_BIRTH, keys.DATE_OF_DEATH
 
@@ -504,8 +723,9 @@ def _add_name_tokens_features(feature_extractor):
 
 
 def _pair_dates(target):
-    if _will_handle_birth_dates(target):
-        LOGGER.info('Pairing birth date columns with precision ones ...')
+    # Called on each target chunk: check columns silently
+    if target.get(keys.DATE_OF_BIRTH) is not None:
+        LOGGER.debug('Pairing birth date columns with precision ones ...')
 
         target[keys.DATE_OF_BIRTH] = list(
             zip(target[keys.DATE_OF_BIRTH], target[keys.BIRTH_PRECISION])
@@ -516,8 +736,8 @@ def _pair_dates(target):
             LOGGER, target, 'Paired birth date columns with precision ones'
         )
 
-    if _will_handle_death_dates(target):
-        LOGGER.info('Pairing death date columns with precision ones ...')
+    if target.get(keys.DATE_OF_DEATH) is not None:
+        LOGGER.debug('Pairing death date columns with precision ones ...')
 
         target[keys.DATE_OF_DEATH] = list(
             zip(target[keys.DATE_OF_DEATH], target[keys.DEATH_PRECISION])
@@ -530,7 +750,7 @@ def _pair_dates(target):
 
 
 def _rename_or_drop_tid_columns(target):
-    LOGGER.info(
+    LOGGER.debug(
         "Renaming '%s' column with no null values to '%s' "
         "& dropping '%s' columns with null values ...",
         keys.CATALOG_ID,
@@ -604,6 +824,17 @@ def _handle_goal(goal, catalog, entity, dir_io):
     return qids_and_tids, wd_io_path
 
 
+def _check_wd_format_value(wd_format):
+    if wd_format not in constants.WD_SET_FORMATS:
+        err_msg = (
+            f"Invalid Wikidata set format: {wd_format}. "
+            f"It should be one of {constants.WD_SET_FORMATS}"
+        )
+
+        LOGGER.critical(err_msg)
+        raise ValueError(err_msg)
+
+
 def _reconstruct_qids_and_tids(wd_io_path, qids_and_tids):
     with gzip.open(wd_io_path, 'rt') as wd_io:
         for line in wd_io:
@@ -627,6 +858,28 @@ def _normalize_values(values):
     return list(normalized_values) if normalized_values else nan
 
 
+def _aggregate_on_tid(target):
+    # One vectorized de-duplication per column,
+    # instead of one `set` per cell
+    tids = target[keys.TID]
+    aggregated = pd.DataFrame(index=pd.Index(tids.unique(), name=keys.TID))
+    for column in target.columns.drop(keys.TID):
+        values = target[[keys.TID, column]].drop_duplicates()
+        aggregated[column] = values.groupby(keys.TID, sort=False)[column].agg(list)
+
+    return aggregated
+
+
+def _merge_lists(lists):
+    merged = []
+    for values in lists:
+        for value in values:
+            if value not in merged:
+                merged.append(value)
+
+    return merged
+
+
 def _drop_null_columns(target):
     target.dropna(axis=1, how='all', inplace=True)
     log_dataframe_info(LOGGER, target, 'Dropped columns with null values only')
@@ -14,6 +14,7 @@ import json
 import logging
 import os
 import pickle
+import re
 from collections import defaultdict
 from re import match
 from typing import DefaultDict, Dict, Iterator, Optional, Tuple
@@ -24,7 +25,7 @@ from sqlalchemy.exc import SQLAlchemyError
 from soweego.commons import constants, data_gathering, keys, target_database, text_utils
 from soweego.commons.db_manager import DBManager
 from soweego.ingester import wikidata_bot
-from soweego.wikidata import api_requests, vocabulary
+from soweego.wikidata import api_requests, entity_cache, sparql_cache, vocabulary
 from soweego.wikidata.api_requests import get_url_blacklist
 
 LOGGER = logging.getLogger(__name__)
@@ -44,6 +45,9 @@ URLS_FNAME = '{catalog}_{entity}_urls_to_be_{task}.csv'
 # For `bio_cli`
 BIO_STATEMENTS_TO_BE_ADDED_FNAME = '{catalog}_{entity}_bio_statements_to_be_added.csv'
 
+# Catalog identifiers looked up by each query of `dead_ids`
+DEAD_IDS_CHUNK_SIZE = 1000
+
 # URL prefixes for catalog providers
 QID_PREFIX = 'https://www.wikidata.org/wiki/'
 PID_PREFIX = QID_PREFIX + 'Property:'
@@ -83,6 +87,9 @@ def dead_ids_cli(catalog, entity, deprecate, sandbox, dump_wikidata, dir_io):
     Dead identifiers should get a deprecated rank in Wikidata:
     you can pass the '-d' flag to do so.
     """
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     dead_ids_path = os.path.join(
         dir_io, DEAD_IDS_FNAME.format(catalog=catalog, entity=entity)
     )
@@ -186,6 +193,9 @@ def links_cli(catalog, entity, blacklist, upload, sandbox, dump_wikidata, dir_io
 
     The '-b' flag applies a URL blacklist of low-quality Web domains to file #3.
     """
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     criterion = 'links'
     # Output paths
     deprecate_path = os.path.join(
@@ -326,6 +336,9 @@ def bio_cli(catalog, entity, upload, sandbox, dump_wikidata, dir_io):
 
     You can pass the '-u' flag to upload the output to Wikidata.
     """
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     criterion = 'bio'
     # Output paths
     deprecate_path = os.path.join(
@@ -454,14 +467,11 @@ def dead_ids(catalog: str, entity: str, wd_cache=None) -> Tuple[DefaultDict, Dic
     session = DBManager.connect_to_db()
 
     try:
+        all_tids = {tid for qid in wd_ids for tid in wd_ids[qid][keys.TID]}
+        alive = _existing_ids(session, db_entity, all_tids)
         for qid in wd_ids:
             for tid in wd_ids[qid][keys.TID]:
-                existing = (
-                    session.query(db_entity.catalog_id)
-                    .filter_by(catalog_id=tid)
-                    .count()
-                )
-                if existing == 0:
+                if tid not in alive:
                     LOGGER.debug('%s %s identifier %s is dead', qid, catalog, tid)
                     dead[tid].add(qid)
         session.commit()
@@ -486,6 +496,34 @@ def dead_ids(catalog: str, entity: str, wd_cache=None) -> Tuple[DefaultDict, Dic
     return dead, wd_ids
 
 
+def _existing_ids(session, db_entity, tids):
+    # Look up identifiers in chunks, one query per chunk
+    # instead of one per identifier
+    tids = sorted(tids)
+    existing = set()
+    for i in range(0, len(tids), DEAD_IDS_CHUNK_SIZE):
+        chunk = tids[i : i + DEAD_IDS_CHUNK_SIZE]
+        found = {
+            row.catalog_id
+            for row in session.query(db_entity.catalog_id)
+            .filter(db_entity.catalog_id.in_(chunk))
+            .distinct()
+        }
+        # The database may compare identifiers case-insensitively,
+        # so map what it found back to the given identifiers
+        found_lower = {catalog_id.lower() for catalog_id in found}
+        existing.update(
+            tid for tid in chunk if tid in found or tid.lower() in found_lower
+        )
+        LOGGER.debug(
+            'Looked up %d identifiers, %d so far exist in the catalog',
+            i + len(chunk),
+            len(existing),
+        )
+
+    return existing
+
+
 def links(
     catalog: str, entity: str, url_blacklist=False, wd_cache=None
 ) -> Optional[Tuple[defaultdict, list, list, list, list, list, dict]]:
@@ -689,12 +727,19 @@ def _apply_url_blacklist(url_statements):
     initial_input_size = len(url_statements)
     blacklist = get_url_blacklist()
 
-    # O(nm) complexity: n = len(blacklist); m = len(url_statements)
-    # Expected order of magnitude: n = 10^2; m = 10^5
-    for domain in blacklist:  # 10^2
-        url_statements = list(  # Slurp the filter or it won't work
-            filter(lambda stmt: domain not in stmt[2], url_statements)  # 10^5
+    if not blacklist or not initial_input_size:
+        LOGGER.warning(
+            'Skipping URL blacklist: got %s blacklist and %d URLs',
+            'no' if not blacklist else 'a',
+            initial_input_size,
         )
+        return url_statements
+
+    # One pass over statements: the pattern matches any blacklisted
+    # domain as a URL substring, i.e., `domain in url`.
+    # n = len(blacklist) = 10^2; m = len(url_statements) = 10^5
+    pattern = _blacklist_pattern(blacklist)
+    url_statements = [stmt for stmt in url_statements if not pattern.search(stmt[2])]
 
     LOGGER.info(
         'Filtered %.2f%%  URLs',
@@ -703,6 +748,40 @@ def _apply_url_blacklist(url_statements):
     return url_statements
 
 
+def _blacklist_pattern(domains):
+    # Build a trie of domains, then turn it into a regex
+    # of nested alternations, e.g.,
+    # {ab.com, ab.org, ac.net} -> a(?:b\.(?:com|org)|c\.net)
+    # Each search position only follows the trie path
+    # of its characters, instead of trying all domains
+    trie = {}
+    for domain in filter(None, domains):
+        node = trie
+        for char in domain:
+            node = node.setdefault(char, {})
+        # Domain end marker
+        node[''] = {}
+
+    def to_regex(node):
+        alternatives = [
+            re.escape(char) + to_regex(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not alternatives:
+            return ''
+
+        regex = (
+            alternatives[0]
+            if len(alternatives) == 1
+            else '(?:' + '|'.join(alternatives) + ')'
+        )
+        # A shorter domain ends here: the rest is optional
+        return f'(?:{regex})?' if '' in node else regex
+
+    return re.compile(to_regex(trie))
+
+
 def _bio_statements_generator(stmts_dict, for_catalogs=False):
     for (qid, tid), values in stmts_dict.items():
         for pid, value in values:
@@ -717,6 +796,8 @@ def _bio_statements_generator(stmts_dict, for_catalogs=False):
 def _validate(criterion, wd, target_data, deprecate, add, reference, wd_only):
     LOGGER.info('Starting check against target %s ...', criterion)
     target = _prepare_target(target_data)
+    # (QID, TID) -> (PID, target value) pairs to be resolved into QIDs
+    to_resolve = defaultdict(set)
 
     # Large loop size: total Wikidata class instances with identifiers,
     # e.g., 80k musicians
@@ -749,9 +830,12 @@ def _validate(criterion, wd, target_data, deprecate, add, reference, wd_only):
                     )
                     continue
 
-                shared_set, extra_set, wd_only_set = _compute_comparison_sets(
-                    criterion, wd_data, target_data
-                )
+                (
+                    shared_set,
+                    extra_set,
+                    wd_only_set,
+                    unresolved_set,
+                ) = _compute_comparison_sets(criterion, wd_data, target_data)
 
                 if not shared_set:
                     LOGGER.debug(
@@ -796,6 +880,15 @@ def _validate(criterion, wd, target_data, deprecate, add, reference, wd_only):
                 else:
                     LOGGER.debug('%s has no extra %s', qid, criterion)
 
+                if unresolved_set:
+                    to_resolve[(qid, tid)].update(unresolved_set)
+
+    # Target values that don't match Wikidata ones may still be
+    # extra statements, if they resolve to QIDs:
+    # look them all up at once
+    if to_resolve:
+        _resolve_extra_values(to_resolve, add)
+
     LOGGER.info(
         'Check against target %s completed: %d IDs to be deprecated, '
         '%d Wikidata items with statements to be added, '
@@ -814,6 +907,7 @@ def _compute_comparison_sets(criterion, wd_data, target_data):
         shared = wd_data.intersection(target_data)
         extra = target_data.difference(wd_data)
         wd_only = wd_data.difference(target_data)
+        unresolved = set()
     # Biographical validation requires more complex comparisons
     elif criterion == keys.BIODATA:
         # `wd_data` has either couples or triples: couples are dates
@@ -830,13 +924,13 @@ def _compute_comparison_sets(criterion, wd_data, target_data):
         target_other = target_data.difference(target_dates)
         shared_dates, extra_dates = _compare('dates', wd_dates, target_dates)
         wd_only_dates = wd_dates.difference(shared_dates)
-        shared_other, extra_other = _compare('other', wd_other, target_other)
+        shared_other, unresolved = _compare('other', wd_other, target_other)
         # `wd_other` has triples: build a set with couples
         # to directly compute the difference with `shared_other`
         wd_other_set = {(pid, qid) for pid, qid, _ in wd_other}
         wd_only_other = wd_other_set.difference(shared_other)
         shared = shared_dates | shared_other
-        extra = extra_dates | extra_other
+        extra = extra_dates
         wd_only = wd_only_dates | wd_only_other
     else:
         raise ValueError(
@@ -844,31 +938,63 @@ def _compute_comparison_sets(criterion, wd_data, target_data):
             f"Please use either '{keys.LINKS}' or '{keys.BIODATA}'"
         )
 
-    return shared, extra, wd_only
+    return shared, extra, wd_only, unresolved
+
+
+def _resolve_extra_values(to_resolve, add):
+    LOGGER.info(
+        'Resolving target values of %d Wikidata items into QIDs ...',
+        len(to_resolve),
+    )
+    terms = {term for values in to_resolve.values() for _, term in values}
+    resolved = api_requests.resolve_qids(terms)
+
+    for (qid, tid), values in to_resolve.items():
+        for pid, term in values:
+            t_qid = resolved.get(term)
+            if t_qid is not None:
+                add[(qid, tid)].add((pid, t_qid))
+
+    LOGGER.info(
+        'Resolved %d out of %d distinct target values',
+        sum(1 for t_qid in resolved.values() if t_qid is not None),
+        len(terms),
+    )
 
 
 def _compare(what, wd, target):
+    # When `what` is 'other', the second returned set holds
+    # `(PID, normalized target value)` pairs that don't match Wikidata:
+    # it's up to the caller to resolve them into QIDs
+    if what not in ('dates', 'other'):
+        raise ValueError(
+            f"Invalid argument: '{what}'. "
+            "Please use either 'dates' or 'other'"
+        )
+
     shared, extra = set(), set()
     # Keep track of matches to avoid useless computation
     # and incorrect comparisons:
     # this happens when WD has multiple claims with
     # the same property
-    wd_matches, target_matches = [], []
+    wd_matches, target_matches = set(), set()
 
     # Filter missing target values (doesn't apply to dates)
     if what == 'other':
-        target = filter(lambda x: x[1] is not None, target)
+        target = [t_elem for t_elem in target if t_elem[1] is not None]
+
+    # Only compare elements with the same PID:
+    # join them by PID, keeping the target order
+    target_by_pid = defaultdict(list)
+    for j, t_elem in enumerate(target):
+        target_by_pid[t_elem[0]].append((j, t_elem))
 
     for i, wd_elem in enumerate(wd):
-        for j, t_elem in enumerate(target):
+        for j, t_elem in target_by_pid.get(wd_elem[0], []):
             # Don't compare when already matched
             if i in wd_matches or j in target_matches:
                 continue
 
-            # Don't compare different PIDs
-            if wd_elem[0] != t_elem[0]:
-                continue
-
             inputs = (
                 shared,
                 extra,
@@ -888,19 +1014,14 @@ def _compare(what, wd, target):
                     )
                     continue
                 _compare_dates(inputs)
-            elif what == 'other':
-                _compare_other(inputs)
             else:
-                raise ValueError(
-                    f"Invalid argument: '{what}'. "
-                    "Please use either 'dates' or 'other'"
-                )
+                _compare_other(inputs)
 
     return shared, extra
 
 
 def _compare_other(inputs):
-    shared, extra, wd_matches, target_matches, i, wd_elem, j, t_elem = inputs
+    shared, unresolved, wd_matches, target_matches, i, wd_elem, j, t_elem = inputs
     pid, qid, wd_values = wd_elem
     _, t_value = t_elem
 
@@ -909,12 +1030,11 @@ def _compare_other(inputs):
     _, t_normalized = text_utils.normalize(t_value)
     if t_normalized in wd_values:
         shared.add((pid, qid))
-        wd_matches.append(i)
-        target_matches.append(j)
+        wd_matches.add(i)
+        target_matches.add(j)
     else:
-        t_qid = api_requests.resolve_qid(t_normalized)
-        if t_qid is not None:
-            extra.add((pid, t_qid))
+        # Resolved later, see `_resolve_extra_values`
+        unresolved.add((pid, t_normalized))
 
 
 def _compare_dates(inputs):
@@ -931,8 +1051,8 @@ def _compare_dates(inputs):
     )
     if shared_date is not None:
         shared.add(shared_date)
-        wd_matches.append(i)
-        target_matches.append(j)
+        wd_matches.add(i)
+        target_matches.add(j)
     elif extra_date is not None:
         extra.add(extra_date)
 
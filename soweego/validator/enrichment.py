@@ -24,7 +24,7 @@ from tqdm import tqdm
 from soweego.commons import constants, data_gathering, keys, target_database, utils
 from soweego.commons.db_manager import DBManager
 from soweego.ingester import wikidata_bot
-from soweego.wikidata import vocabulary
+from soweego.wikidata import entity_cache, sparql_cache, vocabulary
 
 LOGGER = logging.getLogger(__name__)
 
@@ -54,6 +54,9 @@ def works_people_cli(catalog, entity, upload, sandbox, dir_io):
 
     You can pass the '-u' flag to upload the statements to Wikidata.
     """
+    sparql_cache.set_directory(dir_io)
+    entity_cache.set_directory(dir_io)
+
     if upload:
         to_upload = set()
 
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Asynchronous client for the `Wikidata Web API <https://www.wikidata.org/w/api.php>`_.
+
+Requests are sent concurrently over one pool of keep-alive connections.
+The amount of concurrent requests adapts to the server:
+
+- it grows while response latency stays close to the best one seen so far;
+- it shrinks when latency degrades, or the server signals overload through
+  `maxlag <https://www.mediawiki.org/wiki/Manual:Maxlag_parameter>`_ errors,
+  ``429`` or ``5xx`` status codes.
+
+Overload signals also pause all requests for the time the server asks via
+the ``Retry-After`` header, or for an exponential backoff with jitter.
+
+The HTTP layer is a pluggable *transport*: any coroutine function
+that takes request parameters and returns a :class:`Response`.
+Transports may also expose an ``aclose`` coroutine to release
+their resources once a stream is over.
+The default one is based on `aiohttp <https://docs.aiohttp.org/>`_.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import asyncio
+import json
+import logging
+import random
+from collections import deque, namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+)
+
+import aiohttp
+from requests.cookies import RequestsCookieJar
+from requests.utils import dict_from_cookiejar
+
+from soweego.commons import constants
+
+LOGGER = logging.getLogger(__name__)
+
+# HTTP status codes worth a retry
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Seconds before giving up on a single HTTP request
+REQUEST_TIMEOUT = 60
+# Exponential backoff bounds, in seconds
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+# Latency higher than the best one times this factor
+# shrinks the concurrency limit
+LATENCY_TOLERANCE = 2.0
+# How fast the best latency is forgotten, so that the limit
+# can recover when the server gets slower for everyone
+LATENCY_DRIFT = 1.01
+# Multiplicative decrease of the concurrency limit
+# on degraded latency and overload signals, respectively
+SLOWDOWN_FACTOR = 0.9
+OVERLOAD_FACTOR = 0.5
+
+Response = namedtuple('Response', ['status', 'headers', 'body'])
+Response.__doc__ = """An HTTP response: status code, headers dict, and text body."""
+
+Transport = Callable[[Dict], Awaitable[Response]]
+
+
+class AiohttpTransport:
+    """Send Web API requests through a shared :class:`aiohttp.ClientSession`.
+
+    Each event loop gets its own session, created on the first request.
+    Its connection pool is bounded, and connections are kept alive
+    until :meth:`aclose`.
+
+    :param url: the Web API endpoint
+    :param cookies: (optional) session cookies, e.g., for authentication
+    :param max_connections: (optional) size of the connection pool
+    """
+
+    def __init__(
+        self,
+        url: str,
+        cookies: RequestsCookieJar = None,
+        max_connections: int = constants.WIKIDATA_API_MAX_CONCURRENCY,
+    ):
+        self.url = url
+        self.max_connections = max_connections
+        self._cookies = {} if cookies is None else dict_from_cookiejar(cookies)
+        # Sessions can't be shared across event loops
+        self._sessions = {}
+
+    async def __call__(self, params: Dict) -> Response:
+        session = self._get_session()
+        async with session.get(self.url, params=params) as response:
+            body = await response.text()
+
+        LOGGER.debug('Request sent: %s %s', response.method, response.url)
+
+        return Response(response.status, dict(response.headers), body)
+
+    async def aclose(self) -> None:
+        """Release connections of the running event loop."""
+        session = self._sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _get_session(self):
+        loop = asyncio.get_event_loop()
+        session = self._sessions.get(loop)
+
+        if session is None:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                cookies=self._cookies,
+                headers={'User-Agent': constants.HTTP_USER_AGENT},
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            )
+            self._sessions[loop] = session
+
+        return session
+
+
+class Client:
+    """Send Web API requests concurrently, adapting to the server load.
+
+    :param transport: a coroutine function that sends a request
+      with the given parameters and returns a :class:`Response`
+    :param max_concurrency: (optional) upper bound of concurrent requests
+    :param maxlag: (optional) the ``maxlag`` request parameter, in seconds.
+      ``None`` to disable it
+    :param max_retries: (optional) retries per request before giving up
+    """
+
+    def __init__(
+        self,
+        transport: Transport,
+        max_concurrency: int = constants.WIKIDATA_API_MAX_CONCURRENCY,
+        maxlag: Optional[int] = constants.WIKIDATA_API_MAXLAG,
+        max_retries: int = constants.WIKIDATA_API_MAX_RETRIES,
+    ):
+        self.transport = transport
+        self.max_concurrency = max_concurrency
+        self.maxlag = maxlag
+        self.max_retries = max_retries
+        # Set up by `stream` within the running event loop
+        self._limiter = None
+        self._resume_at = 0.0
+
+    async def get(self, params: Dict) -> Optional[Dict]:
+        """Send a request and decode its JSON response.
+
+        :param params: request parameters
+        :return: the response body, or ``None`` if the request failed
+        """
+        if self._limiter is None:
+            self._limiter = _AdaptiveLimiter(self.max_concurrency)
+
+        if self.maxlag is not None:
+            params = {**params, 'maxlag': self.maxlag}
+
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.max_retries + 1):
+            # Overload signals hold back all requests
+            while loop.time() < self._resume_at:
+                await asyncio.sleep(self._resume_at - loop.time())
+
+            await self._limiter.acquire()
+            start = loop.time()
+            try:
+                response = await self.transport(params)
+            except asyncio.CancelledError:
+                await self._limiter.release()
+                raise
+            except Exception as error:
+                await self._limiter.release(overloaded=True)
+                LOGGER.warning(
+                    'Connection broken, will retry the request '
+                    'to the Wikidata API. Reason: %s',
+                    error,
+                )
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+
+            latency = loop.time() - start
+
+            if response.status in RETRY_STATUSES:
+                await self._limiter.release(overloaded=True)
+                LOGGER.warning(
+                    'Wikidata API responded with status code %d, will retry',
+                    response.status,
+                )
+                self._pause(_retry_after(response.headers), attempt)
+                continue
+
+            if not 200 <= response.status < 300:
+                await self._limiter.release(latency)
+                LOGGER.warning(
+                    'Skipping failed request to the Wikidata API. '
+                    'Status code: %d - Parameters: %s',
+                    response.status,
+                    params,
+                )
+                return None
+
+            try:
+                body = json.loads(response.body)
+            except ValueError as error:
+                await self._limiter.release(overloaded=True)
+                LOGGER.warning(
+                    'Malformed JSON response from the Wikidata API, '
+                    'will retry. Reason: %s',
+                    error,
+                )
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+
+            error = body.get('error') if isinstance(body, dict) else None
+            if error is not None and error.get('code') == 'maxlag':
+                await self._limiter.release(overloaded=True)
+                LOGGER.info(
+                    'Wikidata API replication lag is %s seconds, will wait ...',
+                    error.get('lag'),
+                )
+                self._pause(_retry_after(response.headers), attempt)
+                continue
+
+            await self._limiter.release(latency)
+            LOGGER.debug(
+                'Successful request to the Wikidata API. '
+                'Latency: %.2f seconds, concurrency limit: %d',
+                latency,
+                self._limiter.limit,
+            )
+            return body
+
+        LOGGER.warning(
+            'Giving up request to the Wikidata API after %d retries. Parameters: %s',
+            self.max_retries,
+            params,
+        )
+        return None
+
+    async def stream(
+        self, all_params: Iterable[Dict], ordered: bool = False
+    ) -> AsyncIterator[Tuple[int, Optional[Dict]]]:
+        """Send a sequence of requests concurrently.
+
+        Only a bounded window of requests is scheduled at a time,
+        so that the sequence can be lazy and arbitrarily long.
+
+        :param all_params: parameters of each request
+        :param ordered: (optional) whether to yield responses
+          in request order or as soon as they complete
+        :return: the asynchronous generator yielding
+          ``(request index, response body)`` pairs.
+          Bodies are ``None`` for failed requests
+        """
+        self._limiter = _AdaptiveLimiter(self.max_concurrency)
+        self._resume_at = 0.0
+
+        window = 2 * self.max_concurrency
+        todo = enumerate(all_params)
+        scheduled = deque()
+
+        def schedule():
+            for i, params in todo:
+                scheduled.append(asyncio.ensure_future(self._indexed(i, params)))
+                if len(scheduled) >= window:
+                    break
+
+        try:
+            schedule()
+            while scheduled:
+                if ordered:
+                    yield await scheduled.popleft()
+                else:
+                    done, _ = await asyncio.wait(
+                        scheduled, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        scheduled.remove(task)
+                        yield task.result()
+
+                schedule()
+        finally:
+            # Also triggered when the consumer stops early
+            for task in scheduled:
+                task.cancel()
+            await asyncio.gather(*scheduled, return_exceptions=True)
+
+    async def _indexed(self, i, params):
+        return i, await self.get(params)
+
+    def _pause(self, retry_after, attempt):
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        loop = asyncio.get_event_loop()
+        self._resume_at = max(self._resume_at, loop.time() + delay)
+
+
+class _AdaptiveLimiter:
+    # Additive increase, multiplicative decrease of the concurrency limit,
+    # driven by response latency and server overload signals
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = 1.0
+        self._in_flight = 0
+        self._best_latency = None
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._in_flight < max(1, int(self.limit))
+            )
+            self._in_flight += 1
+
+    async def release(self, latency=None, overloaded=False):
+        async with self._condition:
+            self._in_flight -= 1
+            self._adapt(latency, overloaded)
+            self._condition.notify_all()
+
+    def _adapt(self, latency, overloaded):
+
+        if overloaded:
+            self.limit = max(1.0, self.limit * OVERLOAD_FACTOR)
+        elif latency is not None:
+            if self._best_latency is None:
+                self._best_latency = latency
+            else:
+                self._best_latency = min(latency, self._best_latency * LATENCY_DRIFT)
+
+            if latency > self._best_latency * LATENCY_TOLERANCE:
+                self.limit = max(1.0, self.limit * SLOWDOWN_FACTOR)
+            else:
+                # About +1 per full window of successful requests
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Compute an exponential backoff delay with full jitter.
+
+    :param attempt: how many attempts failed so far, starting from 0
+    :return: a random delay in seconds
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def run_stream(
+    transport: Transport, all_params: Iterable[Dict], ordered: bool = False, **kwargs
+) -> Iterator[Tuple[int, Optional[Dict]]]:
+    """Synchronous wrapper of :meth:`Client.stream`.
+
+    Each call runs its own event loop, so that it fits plain generators.
+
+    :param transport: a transport, see :class:`Client`
+    :param all_params: parameters of each request
+    :param ordered: (optional) whether to yield responses
+      in request order or as soon as they complete
+    :param kwargs: extra keyword arguments for :class:`Client`
+    :return: the generator yielding ``(request index, response body)`` pairs
+    """
+    loop = asyncio.new_event_loop()
+    stream = Client(transport, **kwargs).stream(all_params, ordered=ordered)
+
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(stream.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(stream.aclose())
+        # Connections are bound to this loop
+        aclose = getattr(transport, 'aclose', None)
+        if aclose is not None:
+            loop.run_until_complete(aclose())
+        loop.close()
+
+
+def get(transport: Transport, params: Dict, **kwargs) -> Optional[Dict]:
+    """Send a single request, see :meth:`Client.get`.
+
+    :param transport: a transport, see :class:`Client`
+    :param params: request parameters
+    :param kwargs: extra keyword arguments for :class:`Client`
+    :return: the response body, or ``None`` if the request failed
+    """
+    for _, body in run_stream(transport, [params], **kwargs):
+        return body
+
+
+def _retry_after(headers):
+    # Either seconds or an HTTP date, see
+    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Retry-After
+    value = next(
+        (value for name, value in headers.items() if name.lower() == 'retry-after'),
+        None,
+    )
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        LOGGER.debug('Ignoring malformed Retry-After header: %s', value)
+        return None
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
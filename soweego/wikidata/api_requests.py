@@ -7,21 +7,30 @@ import json
 import logging
 import os
 import pickle
+import time
 from collections import defaultdict
-from functools import lru_cache, partial
-from multiprocessing.pool import Pool
-from typing import Dict, Iterator, List, Optional, Set, TextIO, Tuple, Union
+from functools import lru_cache
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
 from urllib.parse import urlunsplit
 
 import lxml.html
 import requests
-from requests.exceptions import RequestException
 from tqdm import tqdm
 
 from soweego.commons import constants, keys
 from soweego.commons.db_manager import DBManager
-from soweego.commons.logging import log_request_data
-from soweego.wikidata import vocabulary
+from soweego.wikidata import api_client, entity_cache, vocabulary
 
 __author__ = 'Marco Fossati'
 __email__ = 'fossati@spaziodati.eu'
@@ -37,6 +46,13 @@ WIKIDATA_API_URL = 'https://www.wikidata.org/w/api.php'
 # https://www.wikidata.org/wiki/Wikidata:Primary_sources_tool/URL_blacklist
 URL_BLACKLIST_PAGE = 'Wikidata:Primary_sources_tool/URL_blacklist'
 BUCKET_SIZE = 500
+# Properties of stored entities: a superset of what any request needs,
+# so that the same entity serves them all
+ENTITY_PROPS = 'info|labels|aliases|descriptions|sitelinks|claims'
+# (search term, language) -> QID of the first result, see `resolve_qids`
+_RESOLVED_QIDS = {}
+# Referenced item QID -> its labels, see `_lookup_labels`
+_ITEM_LABELS = {}
 
 
 def resolve_qid(term: str, language='en') -> Optional[str]:
@@ -47,18 +63,58 @@ def resolve_qid(term: str, language='en') -> Optional[str]:
       Default: ``en``.
     :return: the QID of the first result, or ``None`` in case of no result
     """
-    params = {
-        'action': 'wbsearchentities',
-        'format': 'json',
-        'search': term,
-        'language': language,
-    }
-    response_body = _make_request(params)
+    return resolve_qids([term], language=language)[term]
 
-    # Failed API request
-    if response_body is None:
-        return None
 
+def resolve_qids(
+    terms: Iterable[str], language='en', transport: api_client.Transport = None
+) -> Dict[str, Optional[str]]:
+    """Try to resolve QIDs given a set of search terms,
+    in a *feeling lucky* way.
+
+    Distinct terms are searched concurrently, and results are cached
+    for the lifetime of the process.
+    Use this function instead of :func:`resolve_qid` when you have
+    many terms.
+
+    :param terms: search terms
+    :param language: (optional) search in the given language code.
+      Default: ``en``.
+    :param transport: (optional) a Web API transport,
+      see :mod:`soweego.wikidata.api_client`.
+      Default: one shared by all requests
+    :return: the ``{term: QID of the first result}`` dict.
+      QIDs are ``None`` in case of no result
+    """
+    if transport is None:
+        transport = _get_transport()
+
+    terms = set(terms)
+    to_search = [term for term in terms if (term, language) not in _RESOLVED_QIDS]
+    all_params = (
+        {
+            'action': 'wbsearchentities',
+            'format': 'json',
+            'search': term,
+            'language': language,
+        }
+        for term in to_search
+    )
+    for i, response_body in api_client.run_stream(transport, all_params):
+        term = to_search[i]
+
+        # Failed API request: don't cache, a later call may succeed
+        if response_body is None:
+            continue
+
+        _RESOLVED_QIDS[(term, language)] = _first_search_result(
+            response_body, term, language
+        )
+
+    return {term: _RESOLVED_QIDS.get((term, language)) for term in terms}
+
+
+def _first_search_result(response_body, term, language):
     try:
         return response_body['search'][0]['id']
     # Malformed JSON response
@@ -105,21 +161,19 @@ def get_url_blacklist() -> Optional[set]:
     return blacklist
 
 
-def get_biodata(qids: Set[str]) -> Iterator[Tuple[str, str, str]]:
+def get_biodata(
+    qids: Set[str], transport: api_client.Transport = None
+) -> Iterator[Tuple[str, str, str]]:
     """Collect biographical data for a given set of Wikidata items.
 
     :param qids: a set of QIDs
+    :param transport: (optional) an HTTP transport, see
+      :class:`soweego.wikidata.api_client.Client`.
+      Default: a shared one for the Wikidata Web API
     :return: the generator yielding ``(QID, PID, value)`` triples
     """
     no_claims_count = 0
-    qid_buckets, request_params = _prepare_request(qids, 'claims')
-
-    for bucket in qid_buckets:
-        entities = _sanity_check(bucket, request_params)
-
-        if entities is None:
-            continue
-
+    for entities in _get_entities(qids, transport):
         for qid in entities:
             claims = entities[qid].get('claims')
             if not claims:
@@ -143,7 +197,10 @@ def get_biodata(qids: Set[str]) -> Iterator[Tuple[str, str, str]]:
 
 
 def get_links(
-    qids: Set[str], url_pids: Set[str], ext_id_pids_to_urls: Dict
+    qids: Set[str],
+    url_pids: Set[str],
+    ext_id_pids_to_urls: Dict,
+    transport: api_client.Transport = None,
 ) -> Iterator[Tuple]:
     """Collect sitelinks and third-party links
     for a given set of Wikidata items.
@@ -155,17 +212,13 @@ def get_links(
       ``{PID: {formatter_URL: (id_regex, url_regex,)} }`` dict.
       Returned by
       :py:func:`soweego.wikidata.sparql_queries.external_id_pids_and_urls`
+    :param transport: (optional) an HTTP transport, see
+      :class:`soweego.wikidata.api_client.Client`.
+      Default: a shared one for the Wikidata Web API
     :return: the generator yielding ``(QID, URL)`` pairs
     """
     no_sitelinks_count, no_links_count, no_ext_ids_count = 0, 0, 0
-    qid_buckets, request_params = _prepare_request(qids, 'sitelinks|claims')
-
-    for bucket in qid_buckets:
-        entities = _sanity_check(bucket, request_params)
-
-        if entities is None:
-            continue
-
+    for entities in _get_entities(qids, transport):
         for qid in entities:
             entity = entities[qid]
 
@@ -202,11 +255,12 @@ def get_data_for_linker(
     ext_id_pids_to_urls: Dict,
     qids_and_tids: Dict,
     fileout: TextIO,
+    transport: api_client.Transport = None,
 ) -> None:
     """Collect relevant data for linking Wikidata to a given catalog.
     Dump the result to a given output stream.
 
-    This function uses multithreaded parallel processing.
+    Requests are sent concurrently, see :mod:`soweego.wikidata.api_client`.
 
     :param catalog: ``{'discogs', 'imdb', 'musicbrainz'}``.
       A supported catalog
@@ -224,18 +278,11 @@ def get_data_for_linker(
     :param qids_and_tids: a ``{QID: {'tid': {catalog_ID_set} }`` dict.
       Populated by
       :py:func:`soweego.commons.data_gathering.gather_target_ids`
+    :param transport: (optional) an HTTP transport, see
+      :class:`soweego.wikidata.api_client.Client`.
+      Default: a shared one for the Wikidata Web API
     """
-    qid_buckets, request_params = _prepare_request(
-        qids, 'labels|aliases|descriptions|sitelinks|claims'
-    )
-
-    # Catalog-specific data needs
-    if catalog in constants.REQUIRE_OCCUPATION.keys():
-        needs_occupation = entity in constants.REQUIRE_OCCUPATION[catalog]
-    else:
-        needs_occupation = False
-    needs_genre = entity in constants.REQUIRE_GENRE
-    needs_publication_date = entity in constants.REQUIRE_PUBLICATION_DATE
+    needs = get_linker_needs(catalog, entity)
 
     # Initialize 7 counters to 0
     # Indices legend:
@@ -248,38 +295,27 @@ def get_data_for_linker(
     # 6 = third-party IDs
     counters = [0] * 7
 
-    # Create a partial function where all parameters
-    # but the data bucket are passed to `_process_bucket`,
-    # so that we only pass the data bucket
-    # when we call `pool_function`.
-    # In this way, it becomes trivial to use
-    # `multiprocessing.Pool` map functions, like `imap_unordered`
-    pool_function = partial(
-        _process_bucket,
-        request_params=request_params,
-        url_pids=url_pids,
-        ext_id_pids_to_urls=ext_id_pids_to_urls,
-        qids_and_tids=qids_and_tids,
-        needs=(needs_occupation, needs_genre, needs_publication_date),
-        counters=counters,
-    )
+    # Buckets are processed as soon as their response arrives
+    for entities in tqdm(_get_entities(qids, transport), desc='Buckets'):
+        processed_bucket = _process_bucket(
+            entities,
+            url_pids,
+            ext_id_pids_to_urls,
+            qids_and_tids,
+            needs,
+            counters,
+            transport,
+        )
 
-    # Create a pool of threads and map the list of buckets via `pool_function`
-    with Pool() as pool:
-        # `processed_bucket` will be a list of dicts, where each dict
-        # is a processed entity from the bucket
-        for processed_bucket in pool.imap_unordered(
-            pool_function, tqdm(qid_buckets, total=len(qid_buckets))
-        ):
-            # Join results into a string so that we can write them to
-            # the dump file
-            to_write = ''.join(
-                json.dumps(result, ensure_ascii=False) + '\n'
-                for result in processed_bucket
-            )
+        # Join results into a string so that we can write them to
+        # the dump file
+        to_write = ''.join(
+            json.dumps(result, ensure_ascii=False) + '\n'
+            for result in processed_bucket
+        )
 
-            fileout.write(to_write)
-            fileout.flush()
+        fileout.write(to_write)
+        fileout.flush()
 
     LOGGER.info(
         'QIDs: got %d with no expected claims, %d with no labels, '
@@ -289,6 +325,26 @@ def get_data_for_linker(
     )
 
 
+def get_linker_needs(catalog: str, entity: str) -> Tuple[bool, bool, bool]:
+    """Tell which catalog-specific data the linker needs.
+
+    :param catalog: ``{'discogs', 'imdb', 'musicbrainz'}``.
+      A supported catalog
+    :param entity: ``{'actor', 'band', 'director', 'musician', 'producer',
+      'writer', 'audiovisual_work', 'musical_work'}``.
+      A supported entity
+    :return: whether occupations, genres, and publication dates are needed
+    """
+    if catalog in constants.REQUIRE_OCCUPATION.keys():
+        needs_occupation = entity in constants.REQUIRE_OCCUPATION[catalog]
+    else:
+        needs_occupation = False
+    needs_genre = entity in constants.REQUIRE_GENRE
+    needs_publication_date = entity in constants.REQUIRE_PUBLICATION_DATE
+
+    return needs_occupation, needs_genre, needs_publication_date
+
+
 @lru_cache()
 def build_session() -> requests.Session:
     """Build the HTTP session for interaction with the Wikidata API.
@@ -350,7 +406,9 @@ def build_session() -> requests.Session:
         return session
 
 
-def parse_value(value: Union[str, Dict]) -> Union[str, Tuple[str, str], Set[str], None]:
+def parse_value(
+    value: Union[str, Dict], lookup_label: Callable[[str], Optional[Set[str]]] = None
+) -> Union[str, Tuple[str, str], Set[str], None]:
     """Parse a value returned by the Wikidata API into standard Python objects.
 
     The parser supports the following Wikidata
@@ -363,6 +421,8 @@ def parse_value(value: Union[str, Dict]) -> Union[str, Tuple[str, str], Set[str]
     - item > *set* ``{item_labels}``
 
     :param value: a data value from a call to the Wikidata API
+    :param lookup_label: (optional) a function that returns the set of labels
+      of a given QID. Default: call the Wikidata API
     :return: the parsed Python object, or ``None`` if parsing failed
     """
     # Plain string
@@ -388,15 +448,13 @@ def parse_value(value: Union[str, Dict]) -> Union[str, Tuple[str, str], Set[str]
     # QID: return set of labels
     qid_value = value.get('id')
     if qid_value:
-        return _lookup_label(qid_value)
+        return (lookup_label or _lookup_label)(qid_value)
 
     LOGGER.warning('Failed parsing value: %s', value)
     return None
 
 
-def _sanity_check(bucket, request_params):
-    request_params['ids'] = '|'.join(bucket)
-    response_body = _make_request(request_params)
+def _check_entities(response_body):
     # Failed API request
     if not response_body:
         return None
@@ -414,128 +472,314 @@ def _sanity_check(bucket, request_params):
 
 
 def _lookup_label(item_value):
-    request_params = {
-        'action': 'wbgetentities',
-        'format': 'json',
-        'props': 'labels',
-    }
+    return _lookup_labels([item_value]).get(item_value)
 
-    entities = _sanity_check([item_value], request_params)
-    if entities is None:
-        return None
 
-    entity = entities.get(item_value)
-    if entity is None:
-        LOGGER.warning(
-            "Skipping unexpected JSON response with no %s " "in the 'entities' key",
-            item_value,
+# Referenced items, like countries or genres, recur a lot:
+# spare decoding their stored labels over and over.
+# Only labels are requested and stored for them,
+# and missing ones are fetched in one stream of requests
+def _lookup_labels(item_values, transport=None) -> Dict[str, Optional[Set[str]]]:
+    to_fetch = {value for value in item_values if value not in _ITEM_LABELS}
+
+    if to_fetch:
+        for qid, labels in _get_labels(to_fetch, transport).items():
+            if labels:
+                _ITEM_LABELS[qid] = _return_monolingual_strings(qid, labels)
+            else:
+                LOGGER.info('No label for %s', qid)
+                _ITEM_LABELS[qid] = None
+
+        for value in to_fetch.difference(_ITEM_LABELS):
+            LOGGER.warning(
+                "Skipping unexpected JSON response with no %s in the 'entities' key",
+                value,
+            )
+
+    return {value: _ITEM_LABELS.get(value) for value in item_values}
+
+
+# Get labels of the given QIDs, reading through the entity store:
+# only those missing or older than the store TTL are downloaded
+def _get_labels(qids, transport=None) -> Dict[str, Dict]:
+    # Set the bucket size, which depends on authentication
+    build_session()
+    if transport is None:
+        transport = _get_transport()
+
+    now = time.time()
+    with entity_cache.connect() as store:
+        labels = {
+            qid: item_labels
+            for qid, (checked, item_labels) in entity_cache.get_labels(
+                store, qids
+            ).items()
+            if now - checked < constants.WD_ENTITY_CACHE_TTL
+        }
+        stale = [qid for qid in qids if qid not in labels]
+        LOGGER.debug(
+            'Labels cache: %d QIDs up to date, %d to download',
+            len(labels),
+            len(stale),
         )
-        return None
 
-    labels = entity.get('labels')
-    if labels is None:
-        LOGGER.info('No label for %s', item_value)
-        return None
+        all_params = (
+            {
+                'action': 'wbgetentities',
+                'format': 'json',
+                'props': 'labels',
+                'ids': '|'.join(bucket),
+            }
+            for bucket in _make_buckets(stale)
+        )
+        for _, response_body in api_client.run_stream(transport, all_params):
+            entities = _check_entities(response_body)
+            if entities is None:
+                continue
+
+            # Missing entities have no labels key at all
+            fetched = {
+                qid: entity.get('labels', {})
+                for qid, entity in entities.items()
+                if 'missing' not in entity
+            }
+            entity_cache.save_labels(store, fetched, now)
+            labels.update(fetched)
+
+    return labels
+
+
+# Yield entities of the given QIDs in buckets, reading through
+# the entity store: only those missing or changed upstream are downloaded
+def _get_entities(qids, transport=None) -> Iterator[Dict]:
+    # Set the bucket size, which depends on authentication
+    build_session()
+    if transport is None:
+        transport = _get_transport()
 
-    return _return_monolingual_strings(item_value, labels)
+    qids = list(qids)
+    with entity_cache.connect() as store:
+        fresh = _check_revisions(store, qids, transport)
+        stale = [qid for qid in qids if qid not in fresh]
+        LOGGER.debug(
+            'Entity cache: %d QIDs up to date, %d to download', len(fresh), len(stale)
+        )
+
+        # Up-to-date entities need no request
+        for bucket in _make_buckets([qid for qid in qids if qid in fresh]):
+            yield entity_cache.get_entities(store, bucket)
+
+        all_params = (
+            {
+                'action': 'wbgetentities',
+                'format': 'json',
+                'props': ENTITY_PROPS,
+                'ids': '|'.join(bucket),
+            }
+            for bucket in _make_buckets(stale)
+        )
+        for _, response_body in api_client.run_stream(transport, all_params):
+            entities = _check_entities(response_body)
+
+            # If the sanity check went wrong,
+            # we treat the bucket as if there were no entities
+            if entities is None:
+                continue
 
+            entity_cache.save(store, entities.values(), time.time())
+            yield entities
 
-# This function will be consumed by `get_data_for_linker`:
-# it enables parallel processing for Wikidata buckets
+
+# Cheap batch check of stored entities revisions.
+# Return QIDs of those that didn't change upstream
+def _check_revisions(store, qids, transport) -> Set[str]:
+    revisions = entity_cache.get_revisions(store, qids)
+    now = time.time()
+
+    # Recently checked entities are trusted as they are
+    fresh = {
+        qid
+        for qid, (_, checked) in revisions.items()
+        if now - checked < constants.WD_ENTITY_CACHE_TTL
+    }
+    to_check = [qid for qid in revisions if qid not in fresh]
+
+    all_params = (
+        {
+            'action': 'wbgetentities',
+            'format': 'json',
+            'props': 'info',
+            'ids': '|'.join(bucket),
+        }
+        for bucket in _make_buckets(to_check)
+    )
+    for _, response_body in api_client.run_stream(transport, all_params):
+        entities = _check_entities(response_body)
+        if entities is None:
+            continue
+
+        unchanged = [
+            qid
+            for qid, entity in entities.items()
+            if qid in revisions and entity.get('lastrevid') == revisions[qid][0]
+        ]
+        entity_cache.touch(store, unchanged, now)
+        fresh.update(unchanged)
+
+    return fresh
+
+
+# This function will be consumed by `get_data_for_linker`
 def _process_bucket(
-    bucket,
-    request_params,
+    entities,
     url_pids,
     ext_id_pids_to_urls,
     qids_and_tids,
     needs,
     counters,
+    transport=None,
 ) -> List[Dict]:
-    entities = _sanity_check(bucket, request_params)
+    result = []
 
-    # If the sanity check went wrong,
-    # we treat the bucket as if there were no entities,
-    # and return an empty list
-    if entities is None:
-        return []
+    # Resolve labels of all items referenced in the bucket at once,
+    # instead of one request per item
+    labels = _lookup_labels(_referenced_items(entities, needs), transport)
 
-    result = []
+    for qid, entity in entities.items():
+        processed = process_entity(
+            qid,
+            entity,
+            url_pids,
+            ext_id_pids_to_urls,
+            qids_and_tids,
+            needs,
+            counters,
+            lookup_label=labels.get,
+        )
+        if processed is not None:
+            result.append(processed)
 
-    for qid in entities:
-        processed = {}
+    return result
 
-        # Stick target IDs if given
-        if qids_and_tids:
-            tids = qids_and_tids.get(qid)
-            if tids:
-                processed[keys.TID] = list(tids[keys.TID])
 
-        entity = entities[qid]
+# QIDs of items whose labels are linker values, see `_handle_expected_claims`
+def _referenced_items(entities, needs) -> Set[str]:
+    # Occupations are kept as QIDs
+    expected_pids = _expected_linker_pids(needs) - {vocabulary.OCCUPATION}
+    items = set()
 
-        # Claims
-        claims = entity.get('claims')
-        if not claims:
-            LOGGER.info('Skipping QID with no claims: %s', qid)
-            counters[0] += 1
-            continue
+    for entity in entities.values():
+        claims = entity.get('claims') or {}
+        for pid in expected_pids.intersection(claims.keys()):
+            for pid_claim in claims[pid]:
+                value = (
+                    pid_claim.get('mainsnak', {}).get('datavalue', {}).get('value')
+                )
+                if isinstance(value, dict) and value.get('id'):
+                    items.add(value['id'])
 
-        # Labels
-        labels = entity.get('labels')
-        if not labels:
-            LOGGER.info('Skipping QID with no labels: %s', qid)
-            counters[1] += 1
-            continue
-        processed[keys.QID] = qid
-        processed[keys.NAME] = _return_monolingual_strings(qid, labels)
-
-        # Aliases
-        aliases = entity.get('aliases')
-        if aliases:
-            # Merge them into labels
-            processed[keys.NAME].update(_return_aliases(qid, aliases))
-        else:
-            LOGGER.debug('%s has no aliases', qid)
-            counters[2] += 1
-        # Convert set to list for JSON serialization
-        processed[keys.NAME] = list(processed[keys.NAME])
-
-        # Descriptions
-        descriptions = entity.get('descriptions')
-        if descriptions:
-            processed[keys.DESCRIPTION] = list(
-                _return_monolingual_strings(qid, descriptions)
-            )
-        else:
-            LOGGER.debug('%s has no descriptions', qid)
-            counters[3] += 1
-
-        # Sitelinks
-        sitelinks = entity.get('sitelinks')
-        if sitelinks:
-            processed[keys.URL] = _return_sitelinks(sitelinks)
-        else:
-            LOGGER.debug('%s has no sitelinks', qid)
-            processed[keys.URL] = set()
-            counters[4] += 1
-
-        # Third-party URLs
-        processed[keys.URL].update(
-            _return_third_party_urls(qid, claims, url_pids, counters)
-        )
+    return items
+
+
+def process_entity(
+    qid: str,
+    entity: Dict,
+    url_pids: Set[str],
+    ext_id_pids_to_urls: Dict,
+    qids_and_tids: Optional[Dict],
+    needs: Tuple[bool, bool, bool],
+    counters: List[int],
+    lookup_label: Callable[[str], Optional[Set[str]]] = None,
+) -> Optional[Dict]:
+    """Process a Wikidata entity into a record for the linker.
+
+    :param qid: a QID
+    :param entity: the entity JSON, as returned by the Wikidata API
+    :param url_pids: a set of PIDs holding URL values
+    :param ext_id_pids_to_urls: a
+      ``{PID: {formatter_URL: (id_regex, url_regex,)} }`` dict
+    :param qids_and_tids: a ``{QID: {'tid': {catalog_ID_set} }`` dict,
+      or ``None`` for classification
+    :param needs: catalog-specific data needs, as returned by
+      :func:`get_linker_needs`
+    :param counters: a list of 7 counters of missing data,
+      see :func:`get_data_for_linker`
+    :param lookup_label: (optional) a function that returns the set of labels
+      of a given QID. Default: call the Wikidata API
+    :return: the record, or ``None`` if the entity has no claims or labels
+    """
+    processed = {}
+
+    # Stick target IDs if given
+    if qids_and_tids:
+        tids = qids_and_tids.get(qid)
+        if tids:
+            processed[keys.TID] = list(tids[keys.TID])
+
+    # Claims
+    claims = entity.get('claims')
+    if not claims:
+        LOGGER.info('Skipping QID with no claims: %s', qid)
+        counters[0] += 1
+        return None
 
-        # External ID URLs
-        processed[keys.URL].update(
-            _return_ext_id_urls(qid, claims, ext_id_pids_to_urls, counters)
+    # Labels
+    labels = entity.get('labels')
+    if not labels:
+        LOGGER.info('Skipping QID with no labels: %s', qid)
+        counters[1] += 1
+        return None
+    processed[keys.QID] = qid
+    processed[keys.NAME] = _return_monolingual_strings(qid, labels)
+
+    # Aliases
+    aliases = entity.get('aliases')
+    if aliases:
+        # Merge them into labels
+        processed[keys.NAME].update(_return_aliases(qid, aliases))
+    else:
+        LOGGER.debug('%s has no aliases', qid)
+        counters[2] += 1
+    # Convert set to list for JSON serialization
+    processed[keys.NAME] = list(processed[keys.NAME])
+
+    # Descriptions
+    descriptions = entity.get('descriptions')
+    if descriptions:
+        processed[keys.DESCRIPTION] = list(
+            _return_monolingual_strings(qid, descriptions)
         )
-        # Convert set to list for JSON serialization
-        processed[keys.URL] = list(processed[keys.URL])
+    else:
+        LOGGER.debug('%s has no descriptions', qid)
+        counters[3] += 1
+
+    # Sitelinks
+    sitelinks = entity.get('sitelinks')
+    if sitelinks:
+        processed[keys.URL] = _return_sitelinks(sitelinks)
+    else:
+        LOGGER.debug('%s has no sitelinks', qid)
+        processed[keys.URL] = set()
+        counters[4] += 1
+
+    # Third-party URLs
+    processed[keys.URL].update(
+        _return_third_party_urls(qid, claims, url_pids, counters)
+    )
 
-        # Expected claims
-        processed.update(_return_claims_for_linker(qid, claims, needs, counters))
+    # External ID URLs
+    processed[keys.URL].update(
+        _return_ext_id_urls(qid, claims, ext_id_pids_to_urls, counters)
+    )
+    # Convert set to list for JSON serialization
+    processed[keys.URL] = list(processed[keys.URL])
 
-        result.append(processed)
+    # Expected claims
+    processed.update(
+        _return_claims_for_linker(qid, claims, needs, counters, lookup_label)
+    )
 
-    return result
+    return processed
 
 
 def _return_monolingual_strings(qid, strings):
@@ -618,26 +862,9 @@ def _return_third_party_urls(qid, claims, url_pids, counters):
     return to_return
 
 
-def _return_claims_for_linker(qid, claims, needs, counters):
-    # Unpack needs
-    needs_occupation, needs_genre, needs_publication_date = needs
+def _return_claims_for_linker(qid, claims, needs, counters, lookup_label=None):
     to_return = defaultdict(set)
-    expected_pids = set(vocabulary.LINKER_PIDS.keys())
-
-    if not needs_occupation:
-        expected_pids.remove(vocabulary.OCCUPATION)
-
-    if not needs_genre:
-        expected_pids.remove(vocabulary.GENRE)
-
-    # If we need publication dates, it means we are dealing
-    # with works, so remove birth and death dates
-    if needs_publication_date:
-        expected_pids.remove(vocabulary.DATE_OF_BIRTH)
-        expected_pids.remove(vocabulary.DATE_OF_DEATH)
-    else:
-        expected_pids.remove(vocabulary.PUBLICATION_DATE)
-
+    expected_pids = _expected_linker_pids(needs)
     available = expected_pids.intersection(claims.keys())
 
     if available:
@@ -645,7 +872,7 @@ def _return_claims_for_linker(qid, claims, needs, counters):
         for pid in available:
             for pid_claim in claims[pid]:
                 handled = _handle_expected_claims(
-                    expected_pids, qid, pid, pid_claim, to_return
+                    expected_pids, qid, pid, pid_claim, to_return, lookup_label
                 )
 
                 if not handled:
@@ -658,7 +885,31 @@ def _return_claims_for_linker(qid, claims, needs, counters):
     return {field: list(values) for field, values in to_return.items()}
 
 
-def _handle_expected_claims(expected_pids, qid, pid, pid_claim, to_return):
+def _expected_linker_pids(needs):
+    # Unpack needs
+    needs_occupation, needs_genre, needs_publication_date = needs
+    expected_pids = set(vocabulary.LINKER_PIDS.keys())
+
+    if not needs_occupation:
+        expected_pids.remove(vocabulary.OCCUPATION)
+
+    if not needs_genre:
+        expected_pids.remove(vocabulary.GENRE)
+
+    # If we need publication dates, it means we are dealing
+    # with works, so remove birth and death dates
+    if needs_publication_date:
+        expected_pids.remove(vocabulary.DATE_OF_BIRTH)
+        expected_pids.remove(vocabulary.DATE_OF_DEATH)
+    else:
+        expected_pids.remove(vocabulary.PUBLICATION_DATE)
+
+    return expected_pids
+
+
+def _handle_expected_claims(
+    expected_pids, qid, pid, pid_claim, to_return, lookup_label=None
+):
     value = _extract_value_from_claim(pid_claim, pid, qid)
     if not value:
         return False
@@ -681,7 +932,7 @@ def _handle_expected_claims(expected_pids, qid, pid, pid_claim, to_return):
         # since we don't need to extract labels
         parsed_value = value.get('id')
     else:
-        parsed_value = parse_value(value)
+        parsed_value = parse_value(value, lookup_label)
 
     if not parsed_value:
         return False
@@ -773,17 +1024,6 @@ def _yield_expected_values(qid, claims, expected_pids, count, include_pid=False)
                     yield qid, value
 
 
-def _prepare_request(qids, props):
-    build_session()
-    qid_buckets = _make_buckets(qids)
-    request_params = {
-        'action': 'wbgetentities',
-        'format': 'json',
-        'props': props,
-    }
-    return qid_buckets, request_params
-
-
 # API login step 1:
 # get the login token, using the given HTTP session
 def _get_login_token(session: requests.Session) -> str:
@@ -873,53 +1113,14 @@ def _get_credentials_from_file() -> Tuple[Union[str, None], Union[str, None]]:
 
 
 def _make_request(params):
-    session = requests.Session()
-    session.cookies = build_session().cookies
-
-    while True:
-        response = None
-        try:
-            response = session.get(
-                WIKIDATA_API_URL,
-                params=params,
-                headers={'User-Agent': constants.HTTP_USER_AGENT},
-            )
-            log_request_data(response, LOGGER)
-        except (RequestException, Exception) as error:
-            if isinstance(error, RequestException):
-                LOGGER.warning(
-                    'Connection broken, retrying the request to the Wikidata API'
-                )
-            else:
-                LOGGER.error(
-                    'Unexpected error, retrying the request to '
-                    'the Wikidata API anyway. '
-                    'Reason: %s',
-                    error,
-                )
-            connection_is_ok = False
-        else:
-            connection_is_ok = True
+    return api_client.get(_get_transport(), params)
 
-        if connection_is_ok:
-            break
-
-    if not response.ok or response is None:
-        LOGGER.warning(
-            'Skipping failed %s to the Wikidata API. Reason: %d %s - Full URL: %s',
-            response.request.method,
-            response.status_code,
-            response.reason,
-            response.request.url,
-        )
-        return None
 
-    LOGGER.debug(
-        'Successful %s to the Wikidata API. Status code: %d',
-        response.request.method,
-        response.status_code,
-    )
-    return response.json()
+# One pool of keep-alive connections for the whole process,
+# sharing cookies with the authenticated session
+@lru_cache()
+def _get_transport() -> api_client.AiohttpTransport:
+    return api_client.AiohttpTransport(WIKIDATA_API_URL, build_session().cookies)
 
 
 def _extract_value_from_claim(pid_claim, pid, qid):
@@ -991,8 +1192,9 @@ def _make_buckets(qids):
         if len(current_bucket) >= BUCKET_SIZE:
             buckets.append(current_bucket)
             current_bucket = []
-    buckets.append(current_bucket)
-    LOGGER.info(
+    if current_bucket:
+        buckets.append(current_bucket)
+    LOGGER.debug(
         'Made %d buckets of size %d out of %d QIDs to comply with the Wikidata API limits',
         len(buckets),
         BUCKET_SIZE,
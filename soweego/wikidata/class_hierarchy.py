@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Persistent store of Wikidata class hierarchies, built in bulk
+from *subclass of* (`P279 <https://www.wikidata.org/wiki/Property:P279>`_)
+edges.
+
+The store answers subclass and superclass closure queries offline,
+without hitting the SPARQL endpoint.
+It is a folder of `NumPy <https://numpy.org/>`_ arrays holding
+the hierarchy graph in
+`compressed sparse row <https://en.wikipedia.org/wiki/Sparse_matrix#Compressed_sparse_row_(CSR,_CRS_or_Yale_format)>`_
+format: arrays are memory-mapped, so parallel processes share the same data.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import logging
+import os
+import shutil
+import time
+from functools import lru_cache
+from re import search
+from typing import Iterable, Optional, Set, Tuple
+
+import numpy as np
+
+from soweego.commons import constants
+from soweego.wikidata import sparql_queries, vocabulary
+
+LOGGER = logging.getLogger(__name__)
+
+NODES = 'nodes.npy'
+PARENTS_INDPTR = 'parents_indptr.npy'
+PARENTS = 'parents.npy'
+CHILDREN_INDPTR = 'children_indptr.npy'
+CHILDREN = 'children.npy'
+IN_SUBTREE = 'in_subtree.npy'
+
+
+class ClassHierarchy:
+    """A class hierarchy graph.
+
+    Nodes are numeric QIDs, sorted. Superclasses (parents) and
+    subclasses (children) of each node are stored as adjacency lists
+    in compressed sparse row format.
+
+    Nodes include the superclasses of the root class, but those only hold
+    the subclasses that lead to the root. Hence, a class is *in* the
+    hierarchy only if it is in the subtree of the root: its closure is then
+    complete.
+    """
+
+    def __init__(
+        self,
+        nodes: np.ndarray,
+        parents_indptr: np.ndarray,
+        parents: np.ndarray,
+        children_indptr: np.ndarray,
+        children: np.ndarray,
+        in_subtree: np.ndarray,
+    ):
+        self.nodes = nodes
+        self.parents_indptr = parents_indptr
+        self.parents = parents
+        self.children_indptr = children_indptr
+        self.children = children
+        self.in_subtree = in_subtree
+        # Process-local memo of closures
+        self._closures = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, qid: str):
+        position = self._position(qid)
+        return position is not None and bool(self.in_subtree[position])
+
+    def subclasses_of(self, qid: str) -> Set[str]:
+        """Get subclasses of a given class, including itself,
+        like the ``wdt:P279*`` SPARQL property path.
+
+        :param qid: a Wikidata ontology class,
+          like `Q5 <https://www.wikidata.org/wiki/Q5>`_
+        :return: the QIDs of subclasses
+        """
+        return self._reachable(qid, self.children_indptr, self.children)
+
+    def superclasses_of(self, qid: str) -> Set[str]:
+        """Get superclasses of a given class, including itself,
+        like the ``wdt:P279*`` SPARQL property path.
+
+        :param qid: a Wikidata ontology class,
+          like `Q5 <https://www.wikidata.org/wiki/Q5>`_
+        :return: the QIDs of superclasses
+        """
+        return self._reachable(qid, self.parents_indptr, self.parents)
+
+    def closure(self, qid: str) -> Set[str]:
+        """Get both subclasses and superclasses of a given class,
+        including itself.
+
+        :param qid: a Wikidata ontology class,
+          like `Q5 <https://www.wikidata.org/wiki/Q5>`_
+        :return: the QIDs of subclasses and superclasses
+        """
+        if qid not in self._closures:
+            self._closures[qid] = self.subclasses_of(qid) | self.superclasses_of(qid)
+
+        return self._closures[qid]
+
+    def _position(self, qid: str) -> Optional[int]:
+        number = _qid_to_number(qid)
+        if number is None:
+            return None
+
+        position = int(np.searchsorted(self.nodes, number))
+        if position < len(self.nodes) and self.nodes[position] == number:
+            return position
+
+        return None
+
+    def _reachable(self, qid: str, indptr: np.ndarray, indices: np.ndarray) -> Set[str]:
+        start = self._position(qid)
+        if start is None:
+            LOGGER.debug('%s is not in the class hierarchy', qid)
+            return {qid}
+
+        return {
+            f'Q{self.nodes[node]}'
+            for node in _reachable_positions(start, indptr, indices)
+        }
+
+
+def build(path: str, root_qid: str = vocabulary.OCCUPATION_QID) -> ClassHierarchy:
+    """Build a class hierarchy store in bulk through one SPARQL query,
+    and persist it. The query skips cached responses, unless offline.
+
+    :param path: an output folder path
+    :param root_qid: (optional) the root class of the hierarchy.
+      Occupations by default
+    :return: the class hierarchy
+    """
+    # The store lives as long as the cached query response:
+    # building it from a stale response would extend its life
+    edges = sparql_queries.subclass_edges(root_qid, fresh=True)
+    hierarchy = _from_edges(edges, root_qid)
+
+    # Write to a temporary folder first, so that
+    # a failure won't leave a broken store behind
+    tmp_path = f'{path}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    for file_name, array in (
+        (NODES, hierarchy.nodes),
+        (PARENTS_INDPTR, hierarchy.parents_indptr),
+        (PARENTS, hierarchy.parents),
+        (CHILDREN_INDPTR, hierarchy.children_indptr),
+        (CHILDREN, hierarchy.children),
+        (IN_SUBTREE, hierarchy.in_subtree),
+    ):
+        np.save(os.path.join(tmp_path, file_name), array)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+    LOGGER.info(
+        "Class hierarchy with %d classes dumped to '%s'", len(hierarchy), path
+    )
+
+    return hierarchy
+
+
+@lru_cache()
+def load(path: str) -> ClassHierarchy:
+    """Load a class hierarchy store through memory mapping.
+    This happens only once per process.
+
+    :param path: a folder path as passed to :func:`build`
+    :return: the class hierarchy
+    """
+    LOGGER.info("Loading class hierarchy from '%s' ...", path)
+
+    return ClassHierarchy(
+        *(
+            np.load(os.path.join(path, file_name), mmap_mode='r')
+            for file_name in (
+                NODES,
+                PARENTS_INDPTR,
+                PARENTS,
+                CHILDREN_INDPTR,
+                CHILDREN,
+                IN_SUBTREE,
+            )
+        )
+    )
+
+
+def exists(path: str) -> bool:
+    """Check whether a class hierarchy store is available.
+
+    :param path: a folder path as passed to :func:`build`
+    :return: ``True`` if the store exists
+    """
+    # Stores built before subtree flags were added lack them
+    return all(
+        os.path.isfile(os.path.join(path, file_name))
+        for file_name in (NODES, IN_SUBTREE)
+    )
+
+
+def is_stale(path: str, ttl: float) -> bool:
+    """Check whether a class hierarchy store should be (re)built.
+
+    :param path: a folder path as passed to :func:`build`
+    :param ttl: the store time to live, in seconds
+    :return: ``True`` if the store doesn't exist, or is older than *ttl*
+    """
+    if not exists(path):
+        return True
+
+    # The store is written once, so its age is the one of any file
+    age = time.time() - os.path.getmtime(os.path.join(path, NODES))
+    return age > ttl
+
+
+def _from_edges(edges: Iterable[Tuple[str, str]], root_qid: str) -> ClassHierarchy:
+    subclasses, superclasses = [], []
+    for subclass, superclass in edges:
+        subclass, superclass = _qid_to_number(subclass), _qid_to_number(superclass)
+        if subclass is None or superclass is None:
+            continue
+        subclasses.append(subclass)
+        superclasses.append(superclass)
+
+    subclasses = np.array(subclasses, dtype=np.int64)
+    superclasses = np.array(superclasses, dtype=np.int64)
+
+    nodes = np.union1d(subclasses, superclasses)
+    subclasses = np.searchsorted(nodes, subclasses)
+    superclasses = np.searchsorted(nodes, superclasses)
+
+    parents_indptr, parents = _adjacency(subclasses, superclasses, len(nodes))
+    children_indptr, children = _adjacency(superclasses, subclasses, len(nodes))
+
+    # Only the subtree of the root has complete children lists
+    in_subtree = np.zeros(len(nodes), dtype=bool)
+    root = _qid_to_number(root_qid)
+    root_position = int(np.searchsorted(nodes, root))
+    if root_position < len(nodes) and nodes[root_position] == root:
+        in_subtree[
+            list(_reachable_positions(root_position, children_indptr, children))
+        ] = True
+
+    LOGGER.info(
+        'Built class hierarchy: %d classes, %d in the subtree of %s, '
+        '%d subclass edges',
+        len(nodes),
+        in_subtree.sum(),
+        root_qid,
+        len(parents),
+    )
+
+    return ClassHierarchy(
+        nodes, parents_indptr, parents, children_indptr, children, in_subtree
+    )
+
+
+def _reachable_positions(
+    start: int, indptr: np.ndarray, indices: np.ndarray
+) -> Set[int]:
+    seen, frontier = {start}, [start]
+    while frontier:
+        node = frontier.pop()
+        for neighbor in indices[indptr[node] : indptr[node + 1]]:
+            neighbor = int(neighbor)
+            if neighbor not in seen:
+                seen.add(neighbor)
+                frontier.append(neighbor)
+
+    return seen
+
+
+def _adjacency(
+    sources: np.ndarray, targets: np.ndarray, n_nodes: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=n_nodes))
+
+    return indptr, targets[order].astype(np.int32)
+
+
+def _qid_to_number(qid: str) -> Optional[int]:
+    match = search(constants.QID_REGEX, qid or '')
+    if not match:
+        return None
+
+    return int(match.group()[1:])
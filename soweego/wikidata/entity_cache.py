@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Persistent store of Wikidata entities as returned by the
+`wbgetentities <https://www.wikidata.org/w/api.php?action=help&modules=wbgetentities>`_
+Web API module.
+
+Entities are kept in a SQLite database, keyed by QID along with
+their latest revision ID, so that callers can tell which ones changed
+upstream and only refresh those.
+
+Labels of items referenced by claim values, like genres or countries,
+are kept apart with their retrieval time only:
+the linker needs nothing else from them.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import json
+import logging
+import os
+import sqlite3
+import zlib
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from soweego.commons import constants
+
+LOGGER = logging.getLogger(__name__)
+
+# Keep below the SQLite limit of host parameters per query
+_MAX_PARAMETERS = 500
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS entities (
+    qid TEXT PRIMARY KEY,
+    lastrevid INTEGER NOT NULL,
+    checked REAL NOT NULL,
+    entity BLOB NOT NULL
+)'''
+_LABELS_SCHEMA = '''CREATE TABLE IF NOT EXISTS labels (
+    qid TEXT PRIMARY KEY,
+    checked REAL NOT NULL,
+    labels BLOB NOT NULL
+)'''
+
+# Where the default store lives, see `set_directory`
+_directory = constants.WORK_DIR
+
+
+def set_directory(directory: str) -> None:
+    """Set the directory holding the default store, typically
+    the input/output one of the running command.
+    Default: :data:`~soweego.commons.constants.WORK_DIR`
+
+    :param directory: a directory path
+    """
+    global _directory
+    _directory = directory
+
+
+@contextmanager
+def connect(path: str = None) -> Iterator[sqlite3.Connection]:
+    """Open the entity store, creating it if needed.
+
+    :param path: (optional) path to the SQLite database.
+      Default: the one in the directory given to :func:`set_directory`
+    :return: the context manager yielding the store connection
+    """
+    if path is None:
+        path = os.path.join(_directory, constants.WD_ENTITY_CACHE)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    # Callers may consume generators that hold the connection
+    # from threads other than the one that opened it
+    connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    try:
+        # Readers don't block the writer
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(_SCHEMA)
+        connection.execute(_LABELS_SCHEMA)
+        yield connection
+    finally:
+        connection.close()
+
+
+def get_revisions(
+    connection: sqlite3.Connection, qids: Iterable[str]
+) -> Dict[str, Tuple[int, float]]:
+    """Get revision metadata of stored entities.
+
+    :param connection: an entity store connection
+    :param qids: QIDs to look up
+    :return: a ``{QID: (lastrevid, last check timestamp)}`` dict.
+      QIDs not in the store are left out
+    """
+    revisions = {}
+    for chunk in _chunks(qids):
+        rows = connection.execute(
+            'SELECT qid, lastrevid, checked FROM entities '
+            f'WHERE qid IN ({_placeholders(chunk)})',
+            chunk,
+        )
+        revisions.update((qid, (revid, checked)) for qid, revid, checked in rows)
+
+    return revisions
+
+
+def get_entities(connection: sqlite3.Connection, qids: Iterable[str]) -> Dict[str, Dict]:
+    """Get stored entities.
+
+    :param connection: an entity store connection
+    :param qids: QIDs to look up
+    :return: a ``{QID: entity}`` dict.
+      QIDs not in the store are left out
+    """
+    entities = {}
+    for chunk in _chunks(qids):
+        rows = connection.execute(
+            f'SELECT qid, entity FROM entities WHERE qid IN ({_placeholders(chunk)})',
+            chunk,
+        )
+        entities.update(
+            (qid, json.loads(zlib.decompress(blob))) for qid, blob in rows
+        )
+
+    return entities
+
+
+def save(
+    connection: sqlite3.Connection, entities: Iterable[Dict], checked: float
+) -> int:
+    """Store entities, replacing previous revisions.
+
+    Entities with no revision ID, e.g., missing ones, are skipped.
+
+    :param connection: an entity store connection
+    :param entities: entities as returned by *wbgetentities*
+      with the ``info`` property
+    :param checked: timestamp of the request that returned the entities
+    :return: the amount of stored entities
+    """
+    rows = [
+        (
+            entity['id'],
+            entity['lastrevid'],
+            checked,
+            zlib.compress(json.dumps(entity, ensure_ascii=False).encode('utf-8')),
+        )
+        for entity in entities
+        if entity.get('id') and entity.get('lastrevid')
+    ]
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO entities (qid, lastrevid, checked, entity) '
+            'VALUES (?, ?, ?, ?)',
+            rows,
+        )
+
+    return len(rows)
+
+
+def touch(connection: sqlite3.Connection, qids: Iterable[str], checked: float) -> None:
+    """Mark stored entities as up to date.
+
+    :param connection: an entity store connection
+    :param qids: QIDs whose revision was just checked
+    :param checked: timestamp of the check
+    """
+    with connection:
+        for chunk in _chunks(qids):
+            connection.execute(
+                f'UPDATE entities SET checked = ? WHERE qid IN ({_placeholders(chunk)})',
+                [checked] + chunk,
+            )
+
+
+def get_labels(
+    connection: sqlite3.Connection, qids: Iterable[str]
+) -> Dict[str, Tuple[float, Dict]]:
+    """Get stored labels.
+
+    :param connection: an entity store connection
+    :param qids: QIDs to look up
+    :return: a ``{QID: (retrieval timestamp, labels)}`` dict,
+      where labels are as returned by *wbgetentities*.
+      QIDs not in the store are left out
+    """
+    labels = {}
+    for chunk in _chunks(qids):
+        rows = connection.execute(
+            'SELECT qid, checked, labels FROM labels '
+            f'WHERE qid IN ({_placeholders(chunk)})',
+            chunk,
+        )
+        labels.update(
+            (qid, (checked, json.loads(zlib.decompress(blob))))
+            for qid, checked, blob in rows
+        )
+
+    return labels
+
+
+def save_labels(
+    connection: sqlite3.Connection, labels: Dict[str, Dict], checked: float
+) -> None:
+    """Store labels, replacing previous ones.
+
+    :param connection: an entity store connection
+    :param labels: a ``{QID: labels}`` dict,
+      where labels are as returned by *wbgetentities*
+    :param checked: timestamp of the request that returned the labels
+    """
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO labels (qid, checked, labels) VALUES (?, ?, ?)',
+            (
+                (
+                    qid,
+                    checked,
+                    zlib.compress(
+                        json.dumps(item_labels, ensure_ascii=False).encode('utf-8')
+                    ),
+                )
+                for qid, item_labels in labels.items()
+            ),
+        )
+
+
+def _chunks(qids: Iterable[str]) -> Iterator[List[str]]:
+    chunk = []
+    for qid in qids:
+        chunk.append(qid)
+        if len(chunk) == _MAX_PARAMETERS:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _placeholders(chunk):
+    return ', '.join('?' * len(chunk))
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Offline data source for the linker: a Wikidata
+`JSON dump <https://www.wikidata.org/wiki/Wikidata:Database_download#JSON_dumps_(recommended)>`_,
+as an alternative to the `Web API <https://www.wikidata.org/w/api.php>`_.
+
+Dump lines are split into batches and decoded in parallel.
+Only lines of relevant items undergo full JSON decoding.
+Output records are the same as those of
+:func:`get_data_for_linker() <soweego.wikidata.api_requests.get_data_for_linker>`.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import bz2
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Pool
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+from tqdm import tqdm
+
+from soweego.commons import constants
+from soweego.wikidata import api_requests, vocabulary
+
+LOGGER = logging.getLogger(__name__)
+
+# Dump lines per parallel decoding task
+BATCH_SIZE = 1000
+
+# The item ID comes right after the entity type at the beginning of each line,
+# e.g., {"type":"item","id":"Q42","labels": ...
+ITEM_ID_REGEX = re.compile(rb'"id":"(Q\d+)"')
+# Where to look for the item ID in a line
+ITEM_ID_WINDOW = 100
+
+# Per-process state of pool workers, see `_init_worker`
+_worker_state = {}
+
+
+def get_data_for_linker(
+    dump_path: str,
+    catalog: str,
+    entity: str,
+    qids: Set[str],
+    url_pids: Set[str],
+    ext_id_pids_to_urls: Dict,
+    qids_and_tids: Dict,
+    fileout: TextIO,
+    subset_path: str,
+) -> None:
+    """Collect relevant data for linking Wikidata to a given catalog
+    from a Wikidata JSON dump.
+    Dump the result to a given output stream.
+
+    It works in 3 steps:
+
+    1. extract entities of the given QIDs from the dump into a subset file
+    2. extract labels of items referenced by their statements from the dump
+       into a labels file
+    3. process entities of the subset as
+       :func:`get_data_for_linker() <soweego.wikidata.api_requests.get_data_for_linker>`
+       does, looking up labels in the labels file
+
+    Subset and labels files are named after a digest of the given QIDs
+    and of the dump path, size, and modification time.
+    They are kept: later runs with the same QIDs and dump skip steps 1 and 2.
+
+    This function uses multiprocessing.
+
+    :param dump_path: path to a Wikidata JSON dump,
+      either complete like ``latest-all.json.gz`` or filtered.
+      Plain, gzip, and bzip2 files are supported
+    :param catalog: ``{'discogs', 'imdb', 'musicbrainz'}``.
+      A supported catalog
+    :param entity: ``{'actor', 'band', 'director', 'musician', 'producer',
+      'writer', 'audiovisual_work', 'musical_work'}``.
+      A supported entity
+    :param qids: a set of QIDs
+    :param url_pids: a set of PIDs holding URL values.
+      Returned by :py:func:`soweego.wikidata.sparql_queries.url_pids`
+    :param ext_id_pids_to_urls: a
+      ``{PID: {formatter_URL: (id_regex, url_regex,)} }`` dict.
+      Returned by
+      :py:func:`soweego.wikidata.sparql_queries.external_id_pids_and_urls`
+    :param qids_and_tids: a ``{QID: {'tid': {catalog_ID_set} }`` dict.
+      Populated by
+      :py:func:`soweego.commons.data_gathering.gather_target_ids`
+    :param fileout: a file stream open for writing
+    :param subset_path: path to the gzipped JSON Lines file
+      where entities of the given QIDs are stored
+    """
+    qids = set(qids)
+    extension = constants.WD_SET_JSONL_EXTENSION
+    digest = _subset_digest(dump_path, qids)
+    subset_path = subset_path.replace(extension, f'_{digest}{extension}')
+    labels_path = subset_path.replace(extension, f'_labels{extension}')
+
+    # 1. Entities subset
+    if os.path.isfile(subset_path) and os.path.isfile(labels_path):
+        LOGGER.info("Will reuse existing dump subset: '%s'", subset_path)
+    else:
+        referenced = extract_entities(dump_path, qids, subset_path)
+
+        # 2. Labels of referenced items
+        extract_labels(dump_path, referenced, labels_path)
+
+    labels = {}
+    with gzip.open(labels_path, 'rt') as fin:
+        for line in fin:
+            qid, item_labels = json.loads(line)
+            labels[qid] = set(item_labels)
+
+    # 3. Process entities, like `api_requests.get_data_for_linker`.
+    # See `_process_entities` for counter indices
+    counters = [0] * 7
+    needs = api_requests.get_linker_needs(catalog, entity)
+    initializer_args = (
+        {
+            'labels': labels,
+            'url_pids': url_pids,
+            'ext_id_pids_to_urls': ext_id_pids_to_urls,
+            'qids_and_tids': qids_and_tids,
+            'needs': needs,
+        },
+    )
+
+    LOGGER.info("Processing entities from dump subset '%s' ...", subset_path)
+    with gzip.open(subset_path, 'rb') as fin, Pool(
+        initializer=_init_worker, initargs=initializer_args
+    ) as pool:
+        for processed, batch_counters in pool.imap(
+            _process_entities, tqdm(_batches(fin), desc='Batches')
+        ):
+            fileout.write(processed)
+            fileout.flush()
+            counters = [sum(pair) for pair in zip(counters, batch_counters)]
+
+    LOGGER.info(
+        'QIDs: got %d with no expected claims, %d with no labels, '
+        '%d with no aliases, %d with no descriptions, %d with no sitelinks, '
+        '%d with no third-party links, %d with no external ID links',
+        *counters,
+    )
+
+
+def extract_entities(dump_path: str, qids: Set[str], subset_path: str) -> Set[str]:
+    """Extract entities of given QIDs from a Wikidata JSON dump.
+
+    :param dump_path: path to a Wikidata JSON dump
+    :param qids: a set of QIDs
+    :param subset_path: path to the output gzipped JSON Lines file
+    :return: QIDs of items referenced by statements
+      that the linker needs, see
+      :data:`LINKER_PIDS <soweego.wikidata.vocabulary.LINKER_PIDS>`
+    """
+    LOGGER.info("Extracting %d entities from dump '%s' ...", len(qids), dump_path)
+
+    referenced, found = set(), 0
+    tmp_path = f'{subset_path}.tmp'
+    with _open_dump(dump_path) as dump, gzip.open(tmp_path, 'wb') as fout, Pool(
+        initializer=_init_worker, initargs=({'qids': qids},)
+    ) as pool:
+        for lines, batch_referenced in pool.imap(
+            _select_entities, tqdm(_batches(dump), desc='Batches')
+        ):
+            fout.writelines(lines)
+            referenced.update(batch_referenced)
+            found += len(lines)
+
+    os.replace(tmp_path, subset_path)
+
+    LOGGER.info(
+        "Extracted %d entities referencing %d items to '%s'",
+        found,
+        len(referenced),
+        subset_path,
+    )
+    if found < len(qids):
+        LOGGER.warning(
+            '%d QIDs not found in the dump, perhaps it is outdated',
+            len(qids) - found,
+        )
+
+    return referenced
+
+
+def extract_labels(dump_path: str, qids: Set[str], labels_path: str) -> None:
+    """Extract labels of given QIDs from a Wikidata JSON dump.
+
+    :param dump_path: path to a Wikidata JSON dump
+    :param qids: a set of QIDs
+    :param labels_path: path to the output gzipped JSON Lines file,
+      one ``[QID, [labels]]`` array per line
+    """
+    LOGGER.info(
+        "Extracting labels of %d items from dump '%s' ...", len(qids), dump_path
+    )
+
+    tmp_path = f'{labels_path}.tmp'
+    with _open_dump(dump_path) as dump, gzip.open(tmp_path, 'wt') as fout, Pool(
+        initializer=_init_worker, initargs=({'qids': qids},)
+    ) as pool:
+        for lines in pool.imap(_select_labels, tqdm(_batches(dump), desc='Batches')):
+            fout.write(lines)
+
+    os.replace(tmp_path, labels_path)
+
+    LOGGER.info("Labels dumped to '%s'", labels_path)
+
+
+def _subset_digest(dump_path: str, qids: Set[str]) -> str:
+    # A newer or different dump must not reuse a previous extraction
+    dump_stat = os.stat(dump_path)
+    fingerprint = '\n'.join(
+        [
+            os.path.abspath(dump_path),
+            str(dump_stat.st_size),
+            str(dump_stat.st_mtime_ns),
+            *sorted(qids),
+        ]
+    )
+
+    return hashlib.sha1(fingerprint.encode()).hexdigest()[:12]
+
+
+@contextmanager
+def _open_dump(dump_path: str) -> Iterator[BinaryIO]:
+    # Decompression is the bottleneck of a single reader:
+    # use parallel decompressors when available
+    if dump_path.endswith('.gz'):
+        program = shutil.which('pigz')
+        fallback = gzip.open
+    elif dump_path.endswith('.bz2'):
+        program = shutil.which('lbzip2')
+        fallback = bz2.open
+    else:
+        program, fallback = None, open
+
+    if program is None:
+        with fallback(dump_path, 'rb') as dump:
+            yield dump
+        return
+
+    LOGGER.info("Decompressing dump through '%s'", program)
+    command = [program, '-dc', dump_path]
+    with subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1 << 20) as process:
+        try:
+            yield process.stdout
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+
+        # A corrupt or truncated dump would look like a complete one
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def _batches(lines: Iterator[bytes]) -> Iterator[List[bytes]]:
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _init_worker(state):
+    _worker_state.update(state)
+
+
+def _decode_selected(line: bytes, qids: Set[str]) -> Optional[Tuple[str, Dict]]:
+    # Skip full JSON decoding of irrelevant lines
+    match = ITEM_ID_REGEX.search(line, 0, ITEM_ID_WINDOW)
+    if match is None:
+        return None
+
+    qid = match.group(1).decode()
+    if qid not in qids:
+        return None
+
+    # Dump lines are array elements: strip trailing comma and newline
+    return qid, json.loads(line.rstrip(b',\r\n'))
+
+
+def _select_entities(batch: List[bytes]) -> Tuple[List[bytes], Set[str]]:
+    qids = _worker_state['qids']
+    lines, referenced = [], set()
+
+    for line in batch:
+        decoded = _decode_selected(line, qids)
+        if decoded is None:
+            continue
+
+        qid, entity = decoded
+        lines.append(line.rstrip(b',\r\n') + b'\n')
+
+        # Item values need labels, except for occupations: QIDs are enough
+        claims = entity.get('claims', {})
+        for pid in vocabulary.LINKER_PIDS.keys() - {vocabulary.OCCUPATION}:
+            for pid_claim in claims.get(pid, []):
+                value = (
+                    pid_claim.get('mainsnak', {}).get('datavalue', {}).get('value')
+                )
+                if isinstance(value, dict) and value.get('id'):
+                    referenced.add(value['id'])
+
+    return lines, referenced
+
+
+def _select_labels(batch: List[bytes]) -> str:
+    qids = _worker_state['qids']
+    lines = []
+
+    for line in batch:
+        decoded = _decode_selected(line, qids)
+        if decoded is None:
+            continue
+
+        qid, entity = decoded
+        labels = [
+            label['value']
+            for label in entity.get('labels', {}).values()
+            if label.get('value')
+        ]
+        lines.append(json.dumps([qid, labels], ensure_ascii=False) + '\n')
+
+    return ''.join(lines)
+
+
+def _process_entities(batch: List[bytes]) -> Tuple[str, List[int]]:
+    labels = _worker_state['labels']
+    # Same indices as in `api_requests.get_data_for_linker`
+    counters = [0] * 7
+    lookup_label = partial(_lookup_label, labels)
+    result = []
+
+    for line in batch:
+        entity = json.loads(line)
+        qid = entity.get('id')
+        processed = api_requests.process_entity(
+            qid,
+            entity,
+            _worker_state['url_pids'],
+            _worker_state['ext_id_pids_to_urls'],
+            _worker_state['qids_and_tids'],
+            _worker_state['needs'],
+            counters,
+            lookup_label=lookup_label,
+        )
+        if processed is not None:
+            result.append(json.dumps(processed, ensure_ascii=False) + '\n')
+
+    return ''.join(result), counters
+
+
+def _lookup_label(labels: Dict[str, Set[str]], qid: str) -> Optional[Set[str]]:
+    item_labels = labels.get(qid)
+    if not item_labels:
+        LOGGER.info('No label for %s', qid)
+        return None
+
+    return item_labels
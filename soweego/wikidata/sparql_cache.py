@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of Wikidata SPARQL endpoint responses.
+
+Entries are keyed by the normalized query text and the response format,
+and store the raw response body along with its retrieval time,
+so that callers can decide upon freshness.
+"""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+from soweego.commons import constants
+
+LOGGER = logging.getLogger(__name__)
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    body BLOB NOT NULL
+)'''
+
+# Whether to only serve cached responses, see `set_offline`
+_offline = False
+# Where the cache lives, see `set_directory`
+_directory = constants.WORK_DIR
+# Background revalidation may write concurrently
+_lock = threading.Lock()
+
+
+def set_offline(offline: bool) -> None:
+    """Switch the offline mode: when on, responses to cached query types
+    come from the cache regardless of their age,
+    and the endpoint is never queried for them.
+
+    :param offline: whether to turn the offline mode on or off
+    """
+    global _offline
+    _offline = offline
+
+
+def set_directory(directory: str) -> None:
+    """Set the directory holding the cache, typically
+    the input/output one of the running command.
+    Default: :data:`~soweego.commons.constants.WORK_DIR`
+
+    :param directory: a directory path
+    """
+    global _directory
+    _directory = directory
+
+
+def is_offline() -> bool:
+    """Tell whether the offline mode is on, see :func:`set_offline`.
+
+    :return: the offline mode status
+    """
+    return _offline
+
+
+def make_key(query: str, response_format: str) -> str:
+    """Build a cache key for a query.
+
+    Whitespace is normalized, so that queries that only differ
+    in layout share the same entry.
+
+    :param query: a SPARQL query
+    :param response_format: the MIME type of the response
+    :return: the hexadecimal SHA-256 digest of the normalized query
+    """
+    normalized = ' '.join(query.split())
+
+    return hashlib.sha256(f'{response_format}\n{normalized}'.encode()).hexdigest()
+
+
+def get(key: str) -> Optional[Tuple[float, str]]:
+    """Get a cached response.
+
+    :param key: a cache key as returned by :func:`make_key`
+    :return: the ``(retrieval timestamp, response body)`` pair,
+      or ``None`` if there is no entry
+    """
+    with _lock, _connect() as connection:
+        row = connection.execute(
+            'SELECT fetched, body FROM responses WHERE key = ?', (key,)
+        ).fetchone()
+
+    if row is None:
+        return None
+
+    fetched, body = row
+    return fetched, zlib.decompress(body).decode('utf-8')
+
+
+def put(key: str, query: str, body: str, fetched: float) -> None:
+    """Cache a response, replacing a previous one.
+
+    :param key: a cache key as returned by :func:`make_key`
+    :param query: the SPARQL query, for inspection purposes
+    :param body: the response body
+    :param fetched: the retrieval timestamp
+    """
+    with _lock, _connect() as connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO responses (key, query, fetched, body) '
+            'VALUES (?, ?, ?, ?)',
+            (key, query, fetched, zlib.compress(body.encode('utf-8'))),
+        )
+
+    LOGGER.debug('Cached SPARQL response with key %s', key)
+
+
+@contextmanager
+def _connect():
+    path = os.path.join(_directory, constants.SPARQL_CACHE)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    connection = sqlite3.connect(path, timeout=60)
+    try:
+        connection.execute(_SCHEMA)
+        # Commit on success, roll back on failure
+        with connection:
+            yield connection
+    finally:
+        connection.close()
@@ -9,19 +9,23 @@ __version__ = '1.0'
 __license__ = 'GPL-3.0'
 __copyright__ = 'Copyleft 2018, Hjfocs'
 
+import json
 import logging
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from csv import DictReader
-from random import random
+from itertools import chain
 from re import search
-from typing import Dict, Iterator, Set, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
 
 import requests
 from requests import get
 
 from soweego.commons import constants, keys
 from soweego.commons.logging import log_request_data
-from soweego.wikidata import vocabulary
+from soweego.wikidata import api_client, sparql_cache, vocabulary
 
 LOGGER = logging.getLogger(__name__)
 
@@ -29,9 +33,30 @@ LOGGER = logging.getLogger(__name__)
 WIKIDATA_SPARQL_ENDPOINT = 'https://query.wikidata.org/sparql'
 DEFAULT_RESPONSE_FORMAT = 'text/tab-separated-values'
 JSON_RESPONSE_FORMAT = 'application/json'
+# The endpoint kills queries after 60 seconds
+REQUEST_TIMEOUT = 70
+# Bytes read at a time from streamed responses
+STREAM_CHUNK_SIZE = 1 << 16
+# Worth a retry: too many requests, or query timeout
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Cached query types, see `constants.SPARQL_CACHE_TTL`
+PIDS_QUERY = 'pids'
+CLASS_HIERARCHY_QUERY = 'class_hierarchy'
+
+# How often range workers of a paged query check whether
+# the consumer stopped, in seconds
+_POLL_INTERVAL = 0.5
+# Marks the end of a QID range, see `_run_paged_query`
+_RANGE_DONE = object()
+
+# Queries being refreshed in the background, see `_revalidate`
+_revalidating = set()
+_revalidating_lock = threading.Lock()
 
 # Bindings
 ITEM_BINDING = '?item'
+SUPERCLASS_BINDING = '?superclass'
 IDENTIFIER_BINDING = '?identifier'
 PROPERTY_BINDING = '?property'
 LINK_BINDING = '?link'
@@ -114,6 +139,21 @@ SUPERCLASSES_OF_TEMPLATE = (
     + ITEM_BINDING
     + ' . }'
 )
+# All subclass edges between descendants of a root class
+# and their ancestors
+SUBCLASS_EDGES_TEMPLATE = (
+    'SELECT DISTINCT '
+    + ITEM_BINDING
+    + ' '
+    + SUPERCLASS_BINDING
+    + ' WHERE { ?descendant wdt:P279* wd:%s . ?descendant wdt:P279* '
+    + ITEM_BINDING
+    + ' . '
+    + ITEM_BINDING
+    + ' wdt:P279 '
+    + SUPERCLASS_BINDING
+    + ' . }'
+)
 
 URL_PIDS_QUERY = (
     'SELECT ?property WHERE { '
@@ -134,7 +174,9 @@ def external_id_pids_and_urls() -> Iterator[Dict]:
         'their formatter URLs and regexps ...'
     )
     result_set = _make_request(
-        EXT_ID_PIDS_AND_URLS_TEMPLATE, response_format=JSON_RESPONSE_FORMAT
+        EXT_ID_PIDS_AND_URLS_TEMPLATE,
+        response_format=JSON_RESPONSE_FORMAT,
+        cache_as=PIDS_QUERY,
     )
 
     for result in result_set['results']['bindings']:
@@ -230,7 +272,8 @@ def run_query(
       like `Q5 <https://www.wikidata.org/wiki/Q5>`_
     :param catalog_pid: a Wikidata property for identifiers,
       like `P1953 <https://www.wikidata.org/wiki/Property:P1953>`_
-    :param result_per_page: a page size. Use ``0`` to switch paging off
+    :param result_per_page: a page size. Use ``0`` to switch paging off.
+      Pages are sorted by QID and fetched in parallel over ranges of QIDs
     :return: the query result generator, yielding
       ``(QID, identifier_or_URL)`` pairs, or
       ``QID`` strings only, depending on *query_type*
@@ -304,7 +347,9 @@ def subclasses_of(qid: str) -> Set[str]:
     :return: the QIDs of subclasses
     """
     LOGGER.info('Retrieving subclasses of %s ...', qid)
-    result_set = _make_request(SUBCLASSES_OF_TEMPLATE % qid)
+    result_set = _make_request(
+        SUBCLASSES_OF_TEMPLATE % qid, cache_as=CLASS_HIERARCHY_QUERY
+    )
 
     return set(_get_valid_qid(result).group() for result in result_set)
 
@@ -317,18 +362,57 @@ def superclasses_of(qid: str) -> Set[str]:
     :return: the QIDs of superclasses
     """
     LOGGER.info('Retrieving superclasses of %s ...', qid)
-    result_set = _make_request(SUPERCLASSES_OF_TEMPLATE % qid)
+    result_set = _make_request(
+        SUPERCLASSES_OF_TEMPLATE % qid, cache_as=CLASS_HIERARCHY_QUERY
+    )
 
     return set(_get_valid_qid(result).group() for result in result_set)
 
 
+def subclass_edges(qid: str, fresh: bool = False) -> Iterator[Tuple[str, str]]:
+    """Retrieve all *subclass of* edges in the hierarchy of a given
+    Wikidata ontology class, i.e., edges between its subclasses and
+    their superclasses.
+
+    :param qid: a Wikidata ontology class,
+      like `Q12737077 <https://www.wikidata.org/wiki/Q12737077>`_
+    :param fresh: (optional) whether to fetch a fresh response,
+      even if the cached one is still valid. The cached response
+      is still used in offline mode, or if the endpoint fails
+    :return: the generator yielding ``(subclass_QID, superclass_QID)`` pairs
+    """
+    LOGGER.info('Retrieving subclass edges in the hierarchy of %s ...', qid)
+    result_set = _make_request(
+        SUBCLASS_EDGES_TEMPLATE % qid, cache_as=CLASS_HIERARCHY_QUERY, fresh=fresh
+    )
+
+    if not result_set or result_set == 'empty':
+        LOGGER.warning('No subclass edges in the hierarchy of %s', qid)
+        return
+
+    for result in result_set:
+        subclass = _get_valid_qid(result)
+        if not subclass:
+            continue
+
+        superclass = search(constants.QID_REGEX, result.get(SUPERCLASS_BINDING, ''))
+        if not superclass:
+            LOGGER.warning(
+                'Skipping malformed query result: no valid superclass in %s',
+                result,
+            )
+            continue
+
+        yield subclass.group(), superclass.group()
+
+
 def url_pids() -> Iterator[str]:
     """Retrieve Wikidata properties holding URL values.
 
     :return: the PIDs generator
     """
     LOGGER.info('Retrieving PIDs with URL values ...')
-    result_set = _make_request(URL_PIDS_QUERY)
+    result_set = _make_request(URL_PIDS_QUERY, cache_as=PIDS_QUERY)
 
     for result in result_set:
         valid_pid = _get_valid_pid(result)
@@ -379,72 +463,222 @@ def _get_valid_qid(result):
     return qid
 
 
-def _make_request(query, response_format=DEFAULT_RESPONSE_FORMAT):
-    try:
-        response = get(
-            WIKIDATA_SPARQL_ENDPOINT,
-            params={'query': query},
-            headers={
-                'Accept': response_format,
-                'User-Agent': constants.HTTP_USER_AGENT,
-            },
+def _make_request(
+    query, response_format=DEFAULT_RESPONSE_FORMAT, cache_as=None, fresh=False
+):
+    # `cache_as` is a query type in `constants.SPARQL_CACHE_TTL`:
+    # if given, the response goes through the cache.
+    # `fresh` skips cached responses that are not expired yet
+    if cache_as is None:
+        # Tabular results can be huge: parse them as they arrive
+        if response_format == DEFAULT_RESPONSE_FORMAT:
+            return _stream(query)
+
+        body = _fetch(query, response_format)
+    else:
+        body = _fetch_cached(query, response_format, cache_as, fresh)
+
+    if body is None:
+        return None
+
+    if response_format == JSON_RESPONSE_FORMAT:
+        LOGGER.debug('Returning JSON results ...')
+        return json.loads(body)
+
+    response_body = body.splitlines()
+    if len(response_body) == 1:
+        LOGGER.debug('Got an empty result set from query: %s', query)
+        return 'empty'
+
+    LOGGER.debug('Got %d results', len(response_body) - 1)
+    return DictReader(response_body, delimiter='\t')
+
+
+def _fetch_cached(query, response_format, query_type, fresh=False):
+    key = sparql_cache.make_key(query, response_format)
+    entry = sparql_cache.get(key)
+
+    if entry is None:
+        # Callers can't do without a response
+        if sparql_cache.is_offline():
+            err_msg = (
+                f'Offline mode: no cached response for {query_type} query. '
+                f'Run once without offline mode to cache it. Query: {query}'
+            )
+            LOGGER.critical(err_msg)
+            raise LookupError(err_msg)
+
+        return _fetch_and_cache(key, query, response_format)
+
+    fetched, body = entry
+    age = time.time() - fetched
+    ttl = constants.SPARQL_CACHE_TTL[query_type]
+
+    if sparql_cache.is_offline() or (age < ttl and not fresh):
+        LOGGER.debug('Using cached response for query: %s', query)
+        return body
+
+    # Stale while revalidate
+    if not fresh and age < ttl + constants.SPARQL_CACHE_STALE_WINDOW:
+        LOGGER.info(
+            'Using stale cached response, will refresh it in the background. '
+            'Query: %s',
+            query,
         )
-        log_request_data(response, LOGGER)
+        _revalidate(key, query, response_format)
+        return body
 
-    except requests.exceptions.ConnectionError:
-        wait_time = random()
+    fresh = _fetch_and_cache(key, query, response_format)
+    if fresh is None:
         LOGGER.warning(
-            'There was a connection error, ' 'will retry after %f seconds ...',
-            wait_time,
+            'Using outdated cached response, since the endpoint failed. Query: %s',
+            query,
         )
+        return body
 
-        # Block the current thread for `wait_time` seconds
-        time.sleep(wait_time)
+    return fresh
 
-        # Retry the request and return result
-        return _make_request(query, response_format)
 
-    if response.ok:
-        LOGGER.debug(
-            'Successful GET to the Wikidata SPARQL endpoint. Status code: %d',
-            response.status_code,
-        )
+def _fetch_and_cache(key, query, response_format):
+    fetched = time.time()
+    body = _fetch(query, response_format)
+
+    if body is not None:
+        sparql_cache.put(key, query, body, fetched)
+
+    return body
+
+
+def _revalidate(key, query, response_format):
+    # Only one refresh per query at a time
+    with _revalidating_lock:
+        if key in _revalidating:
+            return
+        _revalidating.add(key)
+
+    def refresh():
+        try:
+            _fetch_and_cache(key, query, response_format)
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(key)
+
+    threading.Thread(target=refresh, name='sparql-revalidate', daemon=True).start()
+
+
+def _stream(query):
+    response = _send(query, DEFAULT_RESPONSE_FORMAT, stream=True)
+    if response is None:
+        return None
+
+    lines = (
+        line.decode('utf-8')
+        for line in response.iter_lines(chunk_size=STREAM_CHUNK_SIZE)
+    )
+    header, first = next(lines, None), next(lines, None)
+    if first is None:
+        response.close()
+        LOGGER.debug('Got an empty result set from query: %s', query)
+        return 'empty'
+
+    return _read_tsv(response, chain((header, first), lines))
+
+
+def _read_tsv(response, lines):
+    # The whole body is never held in memory.
+    # A connection broken halfway raises an error,
+    # rather than silently truncating results
+    results = 0
+    try:
+        for result in DictReader(lines, delimiter='\t'):
+            results += 1
+            yield result
+    finally:
+        response.close()
+
+    LOGGER.debug('Got %d results', results)
+
+
+def _fetch(query, response_format):
+    response = _send(query, response_format)
+
+    return None if response is None else response.text
+
+
+def _send(query, response_format, stream=False):
+    for attempt in range(constants.SPARQL_MAX_RETRIES + 1):
+        try:
+            response = get(
+                WIKIDATA_SPARQL_ENDPOINT,
+                params={'query': query},
+                headers={
+                    'Accept': response_format,
+                    'User-Agent': constants.HTTP_USER_AGENT,
+                },
+                timeout=REQUEST_TIMEOUT,
+                stream=stream,
+            )
+            log_request_data(response, LOGGER)
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            wait_time = api_client.backoff_delay(attempt)
+            LOGGER.warning(
+                'There was a connection error, will retry after %f seconds ...',
+                wait_time,
+            )
+
+            # Block the current thread for `wait_time` seconds
+            time.sleep(wait_time)
+            continue
+
+        if response.ok:
+            LOGGER.debug(
+                'Successful GET to the Wikidata SPARQL endpoint. Status code: %d',
+                response.status_code,
+            )
+
+            return response
+
+        # Too many requests:
+        # there can't be more than 5 concurrent requests per IP.
+        # See https://stackoverflow.com/a/42590757/2234619
+        # and https://github.com/wikimedia/puppet/blob/837d10e240932b8042b81acf31a8808f603b08bb/modules/wdqs/templates/nginx.erb#L85
+        # Server errors are typically query timeouts.
+        # We wait as told by the server, or back off, then retry
+        # Release the connection of a streamed response
+        response.close()
+
+        if response.status_code in RETRY_STATUSES:
+            retry_after = response.headers.get('Retry-After', '')
+            wait_time = (
+                float(retry_after)
+                if retry_after.isdigit()
+                else api_client.backoff_delay(attempt)
+            )
+            LOGGER.warning(
+                'The GET to the Wikidata SPARQL endpoint failed with '
+                'status code %d, will retry after %f seconds ...',
+                response.status_code,
+                wait_time,
+            )
+
+            # Block the current thread for `wait_time` seconds
+            time.sleep(wait_time)
+            continue
 
-        if response_format == JSON_RESPONSE_FORMAT:
-            LOGGER.debug('Returning JSON results ...')
-            return response.json()
-
-        response_body = response.text.splitlines()
-        if len(response_body) == 1:
-            LOGGER.debug('Got an empty result set from query: %s', query)
-            return 'empty'
-
-        LOGGER.debug('Got %d results', len(response_body) - 1)
-        return DictReader(response_body, delimiter='\t')
-
-    # Too many requests:
-    # there can't be more than 5 concurrent requests per IP.
-    # See https://stackoverflow.com/a/42590757/2234619
-    # and https://github.com/wikimedia/puppet/blob/837d10e240932b8042b81acf31a8808f603b08bb/modules/wdqs/templates/nginx.erb#L85
-    # We just wait a bit and retry
-    if response.status_code == 429:
-        # Random value between 0 and 1
-        wait_time = random()
         LOGGER.warning(
-            'Exceeded concurrent queries limit, ' 'will retry after %f seconds ...',
-            wait_time,
+            'The GET to the Wikidata SPARQL endpoint went wrong. '
+            'Reason: %d %s - Query: %s',
+            response.status_code,
+            response.reason,
+            query,
         )
-
-        # Block the current thread for `wait_time` seconds
-        time.sleep(wait_time)
-        # Retry the request and return result
-        return _make_request(query, response_format)
+        return None
 
     LOGGER.warning(
-        'The GET to the Wikidata SPARQL endpoint went wrong. '
-        'Reason: %d %s - Query: %s',
-        response.status_code,
-        response.reason,
+        'Giving up the GET to the Wikidata SPARQL endpoint after %d retries. '
+        'Query: %s',
+        constants.SPARQL_MAX_RETRIES,
         query,
     )
     return None
@@ -482,47 +716,166 @@ def _parse_query_result(query_type, result_set):
             yield valid_qid.group(), identifier_or_link
 
 
+# Paging is deterministic and never skips rows:
+# - the QID space is split into ranges that run in parallel,
+#   within the endpoint limit of concurrent requests;
+# - each range is paged with a keyset, i.e., results are sorted
+#   by QID number, and every page starts after the last QID
+#   of the previous one, instead of an `OFFSET`;
+# - a failed page is retried, and the whole query fails
+#   if the endpoint keeps failing.
+# Completed pages are yielded as soon as they arrive, through a bounded
+# queue: ranges are never held whole in memory
 def _run_paged_query(result_per_page, query):
     if result_per_page == 0:
         LOGGER.info('Running query without paging: %s', query)
         result_set = _make_request(query)
 
-        if not result_set:
-            LOGGER.error('The query went wrong')
-            yield {}
+        if result_set is None:
+            _give_up(query)
 
         if result_set == 'empty':
             LOGGER.warning('Empty result')
-            yield {}
+            return
 
-        for result in result_set:
-            yield result
-    else:
-        LOGGER.info(
-            'Running paged query with %d results per page: %s',
-            result_per_page,
-            query,
-        )
-        pages = 0
-
-        while True:
-            LOGGER.info('Page #%d', pages)
-            query_builder = [
-                query,
-                f'OFFSET {result_per_page * pages} LIMIT {result_per_page}',
-            ]
-            result_set = _make_request(' '.join(query_builder))
-
-            if not result_set:
-                LOGGER.error('Skipping page %d because the query went wrong', pages)
-                pages += 1
-                continue
+        yield from result_set
+        return
+
+    ranges = _qid_ranges()
+    LOGGER.info(
+        'Running paged query with %d results per page over %d QID ranges: %s',
+        result_per_page,
+        len(ranges),
+        query,
+    )
+
+    pages = queue.Queue(maxsize=constants.SPARQL_PAGE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def run_range(lower, upper):
+        try:
+            # The consumer may stop before queued ranges start
+            if stop.is_set():
+                return
+
+            for page in _run_qid_range(query, lower, upper, result_per_page):
+                if not _put_page(pages, page, stop):
+                    return
+        except Exception as error:
+            _put_page(pages, error, stop)
+        finally:
+            _put_page(pages, _RANGE_DONE, stop)
+
+    with ThreadPoolExecutor(
+        max_workers=constants.SPARQL_MAX_CONCURRENT_REQUESTS
+    ) as executor:
+        for lower, upper in ranges:
+            executor.submit(run_range, lower, upper)
+
+        try:
+            running = len(ranges)
+            while running:
+                page = pages.get()
+
+                if page is _RANGE_DONE:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            # Also release workers when the caller stops consuming early
+            stop.set()
+
+
+def _run_qid_range(
+    query: str, lower: int, upper: Optional[int], result_per_page: int
+) -> Iterator[List[Dict]]:
+    results, last, page_size = 0, lower - 1, result_per_page
+
+    while True:
+        page_query = _keyset_page(query, last, upper, page_size)
+        result_set = _make_request(page_query)
+
+        if result_set is None:
+            _give_up(page_query)
+
+        if result_set == 'empty':
+            break
+
+        page = list(result_set)
+        if len(page) < page_size:
+            results += len(page)
+            yield page
+            break
+
+        # A full page may cut the results of its last item:
+        # leave them to the next page
+        last_number = _qid_number(page[-1])
+        complete = [result for result in page if _qid_number(result) < last_number]
+        if not complete:
+            # One item fills the whole page
+            page_size *= 2
+            continue
+
+        results += len(complete)
+        yield complete
+        last, page_size = _qid_number(complete[-1]), result_per_page
+
+    LOGGER.info(
+        'QID range [%d, %s): got %d results',
+        lower,
+        upper if upper is not None else '∞',
+        results,
+    )
+
+
+def _put_page(pages, page, stop):
+    while not stop.is_set():
+        try:
+            pages.put(page, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _qid_ranges() -> List[Tuple[int, Optional[int]]]:
+    size = constants.SPARQL_QID_RANGE_BOUND // constants.SPARQL_QID_RANGES
+    bounds = [i * size for i in range(constants.SPARQL_QID_RANGES)]
+
+    # The last range is open, so that new items are never missed
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def _keyset_page(query, last, upper, page_size):
+    # Turn the item IRI into its QID number,
+    # e.g., http://www.wikidata.org/entity/Q42 -> 42
+    keyset = [
+        f'BIND(xsd:integer(STRAFTER(STR({ITEM_BINDING}), "/entity/Q")) AS ?item_number)',
+        f'FILTER(?item_number > {last}',
+    ]
+    if upper is not None:
+        keyset.append(f'&& ?item_number < {upper}')
+    keyset.append(')')
+
+    # Templates end with the closing brace of the WHERE clause
+    where_end = query.rindex('}')
+
+    return (
+        f'{query[:where_end]} {" ".join(keyset)} {query[where_end:]} '
+        f'ORDER BY ?item_number LIMIT {page_size}'
+    )
+
+
+def _qid_number(result):
+    qid = _get_valid_qid(result)
 
-            if result_set == 'empty':
-                LOGGER.info('Paging finished. Total pages: %d', pages)
-                break
+    return int(qid.group()[1:]) if qid else -1
 
-            for result in result_set:
-                yield result
 
-            pages += 1
+def _give_up(query):
+    err_msg = f'The Wikidata SPARQL endpoint keeps failing, giving up query: {query}'
+    LOGGER.critical(err_msg)
+    raise requests.exceptions.RetryError(err_msg)
@@ -22,6 +22,8 @@ SANDBOX_3 = 'Q15397819'
 # Properties used to get instances
 INSTANCE_OF = 'P31'
 OCCUPATION = 'P106'
+# Property used to build class hierarchies
+SUBCLASS_OF = 'P279'
 
 # References node terms
 # 'based on heuristic' was introduced upon community discussion
@@ -57,6 +59,9 @@ OFFICIAL_WEBSITE = 'P856'
 # https://www.wikidata.org/wiki/Wikidata:Project_chat/Archive/2021/08#URLs_statistics_for_Discogs_(Q504063)_and_MusicBrainz_(Q14005)
 EXACT_MATCH = 'P2888'
 
+# Root class of occupations
+OCCUPATION_QID = 'Q12737077'
+
 # Class QID of supported entities
 # People
 ACTOR_QID = 'Q33999'
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Parity of the batched feature kernels in :mod:`soweego.linker.features`
+with the per-pair implementations they replaced."""
+
+__author__ = 'Marco Fossati'
+__email__ = 'fossati@spaziodati.eu'
+__version__ = '1.0'
+__license__ = 'GPL-3.0'
+__copyright__ = 'Copyleft 2021, Hjfocs'
+
+import itertools
+import random
+
+import jellyfish
+import numpy as np
+import pandas as pd
+import pytest
+
+from soweego.commons import constants, text_utils
+from soweego.linker import features
+
+SEED = 1984
+N_RECORDS = 40
+N_PAIRS = 400
+TOKENS = ['the', 'band', 'john', 'smith', 'jon', 'smyth', 'orchestra', 'x']
+FREQUENCIES = ['A', 'M', 'D', 'H', 'T', 'S']
+
+
+# Per-pair implementations, as they were before the batched kernels.
+# They take a (source list, target list) pair
+
+
+def _pair_has_any_null(pair):
+    if not all(pair):
+        return True
+
+    source_is_null, target_is_null = pd.isna(pair[0]), pd.isna(pair[1])
+    if isinstance(source_is_null, np.ndarray):
+        source_is_null = source_is_null.all()
+    if isinstance(target_is_null, np.ndarray):
+        target_is_null = target_is_null.all()
+
+    return bool(source_is_null or target_is_null)
+
+
+def _levenshtein(pair, missing_value):
+    if _pair_has_any_null(pair):
+        return np.nan
+
+    scores = []
+    for source in pair[0]:
+        for target in pair[1]:
+            try:
+                scores.append(
+                    1
+                    - jellyfish.levenshtein_distance(source, target)
+                    / np.max([len(source), len(target)])
+                )
+            except TypeError:
+                if pd.isnull(source) or pd.isnull(target):
+                    scores.append(missing_value)
+                else:
+                    raise
+
+    return max(scores)
+
+
+def _similar_dates(pair):
+    if _pair_has_any_null(pair):
+        return np.nan
+
+    best = 0
+    for source, target in itertools.product(*pair):
+        s_precision = constants.PD_PERIOD_PRECISIONS.index(source.freq.name)
+        t_precision = constants.PD_PERIOD_PRECISIONS.index(target.freq.name)
+        lowest_prec = min(s_precision, t_precision)
+        current_result = 0
+
+        for min_required_prec, d_attr in enumerate(
+            ['year', 'month', 'day', 'hour', 'minute', 'second']
+        ):
+            if lowest_prec >= min_required_prec and getattr(
+                source, d_attr
+            ) == getattr(target, d_attr):
+                current_result += 1
+            else:
+                break
+
+        best = max(best, (current_result / (lowest_prec + 1)))
+
+    return best
+
+
+def _shared_tokens(pair):
+    if _pair_has_any_null(pair):
+        return np.nan
+
+    source_set, target_set = set(pair[0]), set()
+    for value in pair[1]:
+        if value:
+            target_set.update(filter(None, value.split()))
+
+    intersection = source_set.intersection(target_set)
+    count_total = len(source_set.union(target_set))
+    count_low_score_words = len(
+        text_utils.BAND_NAME_LOW_SCORE_WORDS.intersection(intersection)
+    )
+
+    return (
+        (len(intersection) - (count_low_score_words * 0.9)) / count_total
+        if count_total > 0
+        else np.nan
+    )
+
+
+def _shared_tokens_plus(pair, stop_words):
+    if _pair_has_any_null(pair):
+        return np.nan
+
+    s_item, t_item = (
+        {token for value in values for token in value.lower().split()}
+        for values in pair
+    )
+    if stop_words:
+        s_item -= stop_words
+        t_item -= stop_words
+
+    min_length = min(len(s_item), len(t_item))
+    if min_length != 0:
+        return len(s_item & t_item) / min_length
+
+    return np.nan
+
+
+def _reference(per_pair, source_column, target_column, missing_value):
+    scores = pd.Series(
+        [per_pair(pair) for pair in zip(source_column, target_column)],
+        dtype=float,
+    )
+    return features.fillna(scores, missing_value).to_numpy()
+
+
+# Random input: pairs of Wikidata and target records,
+# with a consistent value per record as in real feature extraction
+
+
+def _pairs_columns(rng, make_value, make_target_value=None):
+    make_target_value = make_target_value or make_value
+    wikidata = {f'Q{i}': make_value(rng) for i in range(N_RECORDS)}
+    target = {f'T{i}': make_target_value(rng) for i in range(N_RECORDS)}
+    index = pd.MultiIndex.from_tuples(
+        sorted(
+            {
+                (rng.choice(list(wikidata)), rng.choice(list(target)))
+                for _ in range(N_PAIRS)
+            }
+        )
+    )
+    source_column = pd.Series(
+        [wikidata[qid] for qid in index.get_level_values(0)], index=index
+    )
+    target_column = pd.Series(
+        [target[tid] for tid in index.get_level_values(1)], index=index
+    )
+
+    return source_column, target_column
+
+
+def _maybe_null(make_list):
+    def make_value(rng):
+        draw = rng.random()
+        if draw < 0.1:
+            return np.nan
+        if draw < 0.15:
+            return []
+        return make_list(rng)
+
+    return make_value
+
+
+def _strings(rng):
+    return [
+        ' '.join(rng.choices(TOKENS, k=rng.randint(1, 3)))
+        for _ in range(rng.randint(1, 4))
+    ]
+
+
+def _dates(rng):
+    return [
+        pd.Period(
+            year=rng.randint(1990, 1992),
+            month=rng.randint(1, 2),
+            day=rng.randint(1, 2),
+            hour=rng.randint(0, 1),
+            minute=rng.randint(0, 1),
+            second=rng.randint(0, 1),
+            freq=rng.choice(FREQUENCIES),
+        )
+        for _ in range(rng.randint(1, 3))
+    ]
+
+
+@pytest.fixture
+def rng():
+    return random.Random(SEED)
+
+
+@pytest.mark.parametrize('missing_value', [0.0, 0.5])
+def test_levenshtein_parity(rng, missing_value):
+    source, target = _pairs_columns(rng, _maybe_null(_strings))
+    feature = features.SimilarStrings(
+        'a', 'b', algorithm='levenshtein', missing_value=missing_value
+    )
+
+    np.testing.assert_allclose(
+        feature._compute_vectorized(source, target).to_numpy(),
+        _reference(
+            lambda pair: _levenshtein(pair, missing_value),
+            source,
+            target,
+            missing_value,
+        ),
+    )
+
+
+def test_similar_dates_parity(rng):
+    source, target = _pairs_columns(rng, _maybe_null(_dates))
+    feature = features.SimilarDates('a', 'b', missing_value=0.25)
+
+    np.testing.assert_allclose(
+        feature._compute_vectorized(source, target).to_numpy(),
+        _reference(_similar_dates, source, target, 0.25),
+    )
+
+
+def test_shared_tokens_parity(rng):
+    def tokens(rng):
+        return rng.sample(TOKENS, rng.randint(1, 4))
+
+    source, target = _pairs_columns(
+        rng, _maybe_null(tokens), _maybe_null(_strings)
+    )
+    feature = features.SharedTokens('a', 'b', missing_value=0.0)
+
+    np.testing.assert_allclose(
+        feature._compute_vectorized(source, target).to_numpy(),
+        _reference(_shared_tokens, source, target, 0.0),
+    )
+
+
+@pytest.mark.parametrize('stop_words', [None, {'the', 'band'}])
+def test_shared_tokens_plus_parity(rng, stop_words):
+    source, target = _pairs_columns(rng, _maybe_null(_strings))
+    feature = features.SharedTokensPlus(
+        'a', 'b', missing_value=0.0, stop_words=stop_words
+    )
+
+    np.testing.assert_allclose(
+        feature._compute_vectorized(source, target).to_numpy(),
+        _reference(
+            lambda pair: _shared_tokens_plus(pair, stop_words),
+            source,
+            target,
+            0.0,
+        ),
+    )
+
+
+# Edge cases, as documented in the feature classes
+
+
+@pytest.mark.parametrize(
+    'feature, value',
+    [
+        (
+            features.SimilarStrings(
+                'a', 'b', algorithm='levenshtein', missing_value=0.5
+            ),
+            'john',
+        ),
+        (features.SimilarDates('a', 'b', missing_value=0.5), pd.Period('1990')),
+    ],
+)
+def test_empty_lists_get_missing_value(feature, value):
+    # Same as with the per-pair implementations
+    source = pd.Series([[], [value], []])
+    target = pd.Series([[value], [], []])
+
+    assert feature._compute_vectorized(source, target).tolist() == [0.5] * 3
+
+
+def test_levenshtein_nan_elements_propagate():
+    # A null element scores `missing_value`: if that is NaN,
+    # the whole pair gets NaN, whatever the element order
+    feature = features.SimilarStrings('a', 'b', algorithm='levenshtein')
+    feature.missing_value = np.nan
+    scores = feature.levenshtein_similarity(
+        pd.Series([['john', None], [None, 'john']]),
+        pd.Series([['john'], ['john']]),
+    )
+
+    assert scores.isna().all()